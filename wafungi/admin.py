@@ -1,7 +1,11 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.db import transaction
 from django.utils.html import format_html
+from django.utils import timezone
 from .models import *
+from .availability_utils import booking_changed, invalidate_availability
+from .summary_utils import update_rows
 
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
@@ -73,6 +77,13 @@ class BookingAdmin(admin.ModelAdmin):
     list_filter = ('status', 'payment_status', 'start_date', 'created_at')
     search_fields = ('client__username', 'musician__username', 'notes')
     date_hierarchy = 'start_date'
+    list_select_related = ('client', 'musician', 'instrument_listing')
+    
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # Listing choices are labelled with their instrument type
+        if db_field.name == 'instrument_listing':
+            kwargs['queryset'] = InstrumentListing.objects.select_related('instrument')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
     
     def musician_or_instrument(self, obj):
         if obj.musician:
@@ -85,12 +96,24 @@ class BookingAdmin(admin.ModelAdmin):
     actions = ['mark_as_confirmed', 'mark_as_completed']
     
     def mark_as_confirmed(self, request, queryset):
-        updated = queryset.update(status='confirmed')
+        with transaction.atomic():
+            bookings = list(queryset)  # before the update takes them out of a status filter
+            updated = update_rows(Booking, [booking.pk for booking in bookings],
+                                  status='confirmed', updated_at=timezone.now())
+            for booking in bookings:
+                booking_changed(booking)
+            invalidate_availability()
         self.message_user(request, f'{updated} bookings marked as confirmed.')
     mark_as_confirmed.short_description = 'Mark selected bookings as confirmed'
     
     def mark_as_completed(self, request, queryset):
-        updated = queryset.update(status='completed')
+        with transaction.atomic():
+            bookings = list(queryset)  # before the update takes them out of a status filter
+            updated = update_rows(Booking, [booking.pk for booking in bookings],
+                                  status='completed', updated_at=timezone.now())
+            for booking in bookings:
+                booking_changed(booking)
+            invalidate_availability()
         self.message_user(request, f'{updated} bookings marked as completed.')
     mark_as_completed.short_description = 'Mark selected bookings as completed'
 
@@ -115,7 +138,7 @@ class NotificationAdmin(admin.ModelAdmin):
     actions = ['mark_as_read']
     
     def mark_as_read(self, request, queryset):
-        updated = queryset.update(is_read=True)
+        updated = update_rows(Notification, queryset.values_list('pk', flat=True), is_read=True)
         self.message_user(request, f'{updated} notifications marked as read.')
     mark_as_read.short_description = 'Mark selected notifications as read'
 
@@ -154,15 +177,30 @@ class EventApplicationAdmin(admin.ModelAdmin):
     actions = ['mark_as_accepted', 'mark_as_declined']
     
     def mark_as_accepted(self, request, queryset):
-        updated = queryset.update(status='accepted')
+        updated = update_rows(EventApplication, queryset.values_list('pk', flat=True), status='accepted')
         self.message_user(request, f'{updated} applications marked as accepted.')
     mark_as_accepted.short_description = 'Mark selected applications as accepted'
     
     def mark_as_declined(self, request, queryset):
-        updated = queryset.update(status='declined')
+        updated = update_rows(EventApplication, queryset.values_list('pk', flat=True), status='declined')
         self.message_user(request, f'{updated} applications marked as declined.')
     mark_as_declined.short_description = 'Mark selected applications as declined'
 
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ('checkout_request_id', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'received_at')
+    search_fields = ('checkout_request_id',)
+    date_hierarchy = 'received_at'
+    readonly_fields = ('payload', 'received_at', 'processed_at', 'last_error')
+    
+    actions = ['retry_now']
+    
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status='processed').update(status='pending', next_attempt_at=timezone.now())
+        self.message_user(request, f'{updated} callbacks queued for processing.')
+    retry_now.short_description = 'Retry selected callbacks now'
+
 # Customize admin site
 admin.site.site_header = 'WAFUNGI-NATION Administration'
 admin.site.site_title = 'WAFUNGI-NATION Admin'
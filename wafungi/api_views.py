@@ -1,9 +1,21 @@
+from django.conf import settings
 from django.http import JsonResponse
+from django.utils.cache import patch_cache_control
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
-from .models import Notification, MusicianProfile, InstrumentListing, Booking, Event, Genre, Instrument
+from .models import Notification, MusicianProfile, InstrumentListing
+from .availability_utils import RESOLUTIONS, IntervalIndex, cached_busy_bitmaps, is_free
+from .listing_utils import (
+    application_listing, booking_listing, event_listing, instrument_listing, musician_listing,
+)
+from .mpesa_utils import get_http_pool_stats
+from .pagination_utils import cursor_page
+from .summary_utils import apply
+from .typeahead_utils import get_suggestions
 import json
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time
 
 @login_required
 def get_notifications(request):
@@ -30,13 +42,32 @@ def get_notifications(request):
 @require_POST
 def mark_notification_read(request, notification_id):
     """API endpoint to mark a notification as read"""
-    try:
-        notification = Notification.objects.get(id=notification_id, user=request.user)
-        notification.is_read = True
-        notification.save()
-        return JsonResponse({'success': True})
-    except Notification.DoesNotExist:
+    notifications = Notification.objects.filter(id=notification_id, user=request.user)
+    # One UPDATE instead of a load, a save and the summary read-backs around it
+    updated = notifications.filter(is_read=False).update(is_read=True)
+    if updated:
+        apply({(request.user.pk, 'unread_notifications'): -updated})
+    elif not notifications.exists():
         return JsonResponse({'success': False, 'error': 'Notification not found'}, status=404)
+    return JsonResponse({'success': True})
+
+def _requested_slot(request):
+    """(start, end) from ISO ``start``/``end`` query parameters, None unless both are valid"""
+    try:
+        start = parse_datetime(request.GET.get('start', ''))
+        end = parse_datetime(request.GET.get('end', ''))
+    except ValueError:
+        return None
+    if start is None or end is None or start >= end:
+        return None
+    if timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    if timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    return start, end
+
+def _busy_data(busy, resource_id):
+    return [{'start': start.isoformat(), 'end': end.isoformat()} for start, end in busy.busy_intervals(resource_id)]
 
 @login_required
 def get_musician_availability(request, musician_id):
@@ -48,26 +79,19 @@ def get_musician_availability(request, musician_id):
         start_date = timezone.now()
         end_date = start_date + timezone.timedelta(days=30)
         
-        bookings = Booking.objects.filter(
-            musician=musician.user,
-            start_date__gte=start_date,
-            end_date__lte=end_date,
-            status__in=['confirmed', 'pending']
-        ).values('start_date', 'end_date')
-        
-        # Format bookings for calendar
-        booking_data = []
-        for booking in bookings:
-            booking_data.append({
-                'start': booking['start_date'].isoformat(),
-                'end': booking['end_date'].isoformat(),
-            })
+        # Busy time overlapping the window, overlapping bookings merged
+        busy = IntervalIndex.load('musician', [musician.user_id], start_date, end_date)
+        booking_data = _busy_data(busy, musician.user_id)
         
-        return JsonResponse({
+        data = {
             'success': True,
             'availability_status': musician.availability_status,
             'bookings': booking_data
-        })
+        }
+        slot = _requested_slot(request)
+        if slot:
+            data['is_free'] = is_free('musician', musician.user_id, *slot)
+        return JsonResponse(data)
     except MusicianProfile.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Musician not found'}, status=404)
 
@@ -81,111 +105,71 @@ def get_instrument_availability(request, instrument_id):
         start_date = timezone.now()
         end_date = start_date + timezone.timedelta(days=30)
         
-        bookings = Booking.objects.filter(
-            instrument_listing=instrument,
-            start_date__gte=start_date,
-            end_date__lte=end_date,
-            status__in=['confirmed', 'pending']
-        ).values('start_date', 'end_date')
+        # Busy time overlapping the window, overlapping bookings merged
+        busy = IntervalIndex.load('instrument', [instrument.id], start_date, end_date)
+        booking_data = _busy_data(busy, instrument.id)
         
-        # Format bookings for calendar
-        booking_data = []
-        for booking in bookings:
-            booking_data.append({
-                'start': booking['start_date'].isoformat(),
-                'end': booking['end_date'].isoformat(),
-            })
-        
-        return JsonResponse({
+        data = {
             'success': True,
             'is_available': instrument.is_available,
             'bookings': booking_data
-        })
+        }
+        slot = _requested_slot(request)
+        if slot:
+            data['is_free'] = is_free('instrument', instrument.id, *slot)
+        return JsonResponse(data)
     except InstrumentListing.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Instrument not found'}, status=404)
 
+MAX_AVAILABILITY_IDS = 100
+MAX_AVAILABILITY_DAYS = 62
+
+@login_required
+def batch_availability(request):
+    """
+    API endpoint with busy bitmaps for many musicians or instruments at once
+    
+    ``?kind=musician|instrument&ids=1,2,3&start=YYYY-MM-DD&days=14&resolution=hour|day``.
+    Each bitmap is a hex number whose bit i is set when slot i is booked,
+    slot 0 starting at midnight of ``start``.
+    """
+    kind = request.GET.get('kind', 'musician')
+    resolution = request.GET.get('resolution', 'day')
+    if kind not in ('musician', 'instrument') or resolution not in RESOLUTIONS:
+        return JsonResponse({'success': False, 'error': 'Unknown kind or resolution'}, status=400)
+    try:
+        ids = sorted({int(value) for value in request.GET.get('ids', '').split(',') if value.strip()})
+        days = max(1, min(int(request.GET.get('days', 14)), MAX_AVAILABILITY_DAYS))
+        start_day = parse_date(request.GET['start']) if request.GET.get('start') else timezone.localdate()
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid ids, days or start'}, status=400)
+    if not ids or len(ids) > MAX_AVAILABILITY_IDS or start_day is None:
+        return JsonResponse({'success': False, 'error': f'Give 1 to {MAX_AVAILABILITY_IDS} ids and a valid start'}, status=400)
+    
+    start = timezone.make_aware(datetime.combine(start_day, time.min))
+    slots = days * (24 if resolution == 'hour' else 1)
+    bitmaps = cached_busy_bitmaps(kind, ids, start, slots, resolution)
+    width = (slots + 3) // 4
+    return JsonResponse({
+        'success': True,
+        'kind': kind,
+        'start': start.isoformat(),
+        'resolution': resolution,
+        'slots': slots,
+        'busy': {str(resource_id): f'{bitmap:0{width}x}' for resource_id, bitmap in bitmaps.items()},
+    })
+
 @login_required
 def search_api(request):
-    """API endpoint for search suggestions"""
+    """API endpoint for search suggestions, answered from the in-memory typeahead index"""
     query = request.GET.get('q', '')
     
     if not query or len(query) < 2:
         return JsonResponse({'results': []})
     
-    from django.db.models import Q
-    
-    # Search musicians
-    musicians = MusicianProfile.objects.filter(
-        Q(stage_name__icontains=query) |
-        Q(user__first_name__icontains=query) |
-        Q(user__last_name__icontains=query)
-    )[:5]
-    
-    # Search instruments
-    instruments = InstrumentListing.objects.filter(
-        Q(brand__icontains=query) |
-        Q(model__icontains=query) |
-        Q(instrument__name__icontains=query)
-    )[:5]
-    
-    # Search events
-    events = Event.objects.filter(
-        Q(title__icontains=query) |
-        Q(description__icontains=query)
-    )[:5]
-    
-    # Search genres
-    genres = Genre.objects.filter(name__icontains=query)[:5]
-    
-    # Search instrument types
-    instrument_types = Instrument.objects.filter(name__icontains=query)[:5]
-    
-    results = []
-    
-    # Format results
-    for musician in musicians:
-        results.append({
-            'type': 'musician',
-            'id': musician.id,
-            'name': musician.stage_name or f"{musician.user.first_name} {musician.user.last_name}",
-            'url': f"/musicians/{musician.id}/",
-            'image': musician.user.profile_picture.url if musician.user.profile_picture else None,
-        })
-    
-    for instrument in instruments:
-        results.append({
-            'type': 'instrument',
-            'id': instrument.id,
-            'name': f"{instrument.brand} {instrument.model}",
-            'url': f"/instruments/{instrument.id}/",
-            'image': instrument.image.url if instrument.image else None,
-        })
-    
-    for event in events:
-        results.append({
-            'type': 'event',
-            'id': event.id,
-            'name': event.title,
-            'url': f"/events/{event.id}/",
-        })
-    
-    for genre in genres:
-        results.append({
-            'type': 'genre',
-            'id': genre.id,
-            'name': genre.name,
-            'url': f"/musicians/?genre={genre.id}",
-        })
-    
-    for instrument_type in instrument_types:
-        results.append({
-            'type': 'instrument_type',
-            'id': instrument_type.id,
-            'name': instrument_type.name,
-            'url': f"/instruments/?instrument={instrument_type.id}",
-        })
-    
-    return JsonResponse({'results': results})
+    response = JsonResponse({'results': get_suggestions(query)})
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'TYPEAHEAD_CACHE_TIMEOUT', 300))
+    return response
 
 @login_required
 @require_POST
@@ -211,3 +195,123 @@ def send_message_to_owner(request):
         return JsonResponse({'success': False, 'error': 'Instrument not found'}, status=404)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@login_required
+def mpesa_pool_stats(request):
+    """API endpoint exposing Daraja connection pool reuse (staff only)"""
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'error': 'Access denied'}, status=403)
+    
+    return JsonResponse({'success': True, 'pools': get_http_pool_stats()})
+
+# Listing APIs: keyset pagination with opaque cursors, same filters as the pages
+
+MAX_PAGE_SIZE = 100
+
+def _page_size(request, default):
+    try:
+        return max(1, min(int(request.GET.get('limit', default)), MAX_PAGE_SIZE))
+    except ValueError:
+        return default
+
+def _listing_response(request, listing, serialize, default_size):
+    """Serialize one cursor page; ``?cursor=`` fetches the next one, ``?count=1`` adds a total"""
+    page = cursor_page(request, listing.queryset, listing.ordering, _page_size(request, default_size))
+    results = []
+    for obj in page:
+        item = serialize(obj)
+        if getattr(obj, 'distance_km', None) is not None:
+            item['distance_km'] = round(obj.distance_km, 1)  # near/radius searches
+        results.append(item)
+    data = {
+        'results': results,
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+    }
+    if page.count is not None:
+        data['count'] = page.count
+    return JsonResponse(data)
+
+def _musician_data(musician):
+    return {
+        'id': musician.id,
+        'name': musician.stage_name or f"{musician.user.first_name} {musician.user.last_name}",
+        'location': musician.user.location,
+        'town': musician.user.town,
+        'hourly_rate': str(musician.hourly_rate),
+        'rating': str(musician.rating),
+        'total_gigs': musician.total_gigs,
+        'genres': [genre.name for genre in musician.genres.all()],
+        'instruments': [instrument.name for instrument in musician.instruments.all()],
+        'url': f"/musicians/{musician.id}/",
+    }
+
+def _instrument_data(listing):
+    return {
+        'id': listing.id,
+        'name': f"{listing.brand} {listing.model}",
+        'instrument': listing.instrument.name,
+        'condition': listing.condition,
+        'daily_rate': str(listing.daily_rate),
+        'location': listing.location,
+        'town': listing.town,
+        'url': f"/instruments/{listing.id}/",
+    }
+
+def _event_data(event):
+    return {
+        'id': event.id,
+        'title': event.title,
+        'event_type': event.event_type,
+        'date': event.date.isoformat(),
+        'location': event.location,
+        'town': event.town,
+        'budget_min': str(event.budget_min),
+        'budget_max': str(event.budget_max),
+        'url': f"/events/{event.id}/",
+    }
+
+def _booking_data(booking):
+    return {
+        'id': booking.id,
+        'status': booking.status,
+        'payment_status': booking.payment_status,
+        'start_date': booking.start_date.isoformat(),
+        'end_date': booking.end_date.isoformat(),
+        'total_amount': str(booking.total_amount),
+        'created_at': booking.created_at.isoformat(),
+        'url': f"/bookings/{booking.id}/",
+    }
+
+def _application_data(application):
+    return {
+        'id': application.id,
+        'event': {'id': application.event.id, 'title': application.event.title},
+        'status': application.status,
+        'proposed_rate': str(application.proposed_rate),
+        'applied_at': application.applied_at.isoformat(),
+    }
+
+def musicians_api(request):
+    """API endpoint listing musicians like search_musicians"""
+    return _listing_response(request, musician_listing(request.GET), _musician_data, 12)
+
+def instruments_api(request):
+    """API endpoint listing instruments like search_instruments"""
+    return _listing_response(request, instrument_listing(request.GET), _instrument_data, 12)
+
+def events_api(request):
+    """API endpoint listing upcoming events like browse_events"""
+    return _listing_response(request, event_listing(request.GET), _event_data, 12)
+
+@login_required
+def bookings_api(request):
+    """API endpoint listing the user's bookings like my_bookings"""
+    return _listing_response(request, booking_listing(request.user), _booking_data, 10)
+
+@login_required
+def applications_api(request):
+    """API endpoint listing a musician's event applications like my_applications"""
+    if request.user.user_type != 'musician':
+        return JsonResponse({'success': False, 'error': 'Access denied'}, status=403)
+    return _listing_response(request, application_listing(request.user), _application_data, 10)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WafungiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'wafungi'
+
+    def ready(self):
+        from . import checks, signals, timing_utils  # noqa: F401
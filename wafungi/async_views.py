@@ -0,0 +1,239 @@
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect, aget_object_or_404
+from django.urls import reverse
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.contrib import messages
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+import asyncio
+import json
+import logging
+
+from .models import Booking, PaymentTransaction
+from .mpesa_async import aprocess_mpesa_payment, averify_payment_status
+from .mpesa_utils import UNAVAILABLE_MESSAGE, apayments_available
+from .payment_events import aget_payment_version, wait_for_payment_update
+from .payment_utils import CANCELLED_RESULT_CODES, complete_payment, fail_payment, process_callback_inbox
+
+logger = logging.getLogger(__name__)
+
+arender = sync_to_async(render)
+
+# Milliseconds browsers wait before asking for a payment's status again
+STATUS_RETRY_MS = 3000
+
+@login_required
+async def payment_process_async(request, booking_id):
+    """Process payment for booking without blocking a worker on Daraja I/O"""
+    user = await request.auser()
+    booking = await aget_object_or_404(Booking, id=booking_id, client=user)
+
+    if booking.payment_status:
+        messages.info(request, 'This booking has already been paid for.')
+        return redirect('booking_detail', booking.id)
+
+    if booking.status != 'confirmed':
+        messages.error(request, 'This booking must be confirmed before payment.')
+        return redirect('booking_detail', booking.id)
+
+    if not await apayments_available():
+        if request.method == 'POST':
+            messages.error(request, UNAVAILABLE_MESSAGE)
+        return await arender(request, 'wafungi/payment.html', {'booking': booking, 'payments_unavailable': True})
+
+    if request.method == 'POST':
+        mpesa_number = request.POST.get('mpesa_number')
+
+        if not mpesa_number:
+            messages.error(request, 'Please provide your M-Pesa phone number.')
+            return await arender(request, 'wafungi/payment.html', {'booking': booking})
+
+        # Validate phone number format
+        mpesa_number = ''.join(filter(str.isdigit, mpesa_number))
+        if len(mpesa_number) != 9:
+            messages.error(request, 'Please enter a valid 9-digit phone number (e.g., 712345678).')
+            return await arender(request, 'wafungi/payment.html', {'booking': booking})
+
+        try:
+            payment_result = await aprocess_mpesa_payment(
+                phone_number=mpesa_number,
+                amount=float(booking.total_amount),
+                booking_id=booking.id,
+            )
+
+            if payment_result['success']:
+                transaction = await PaymentTransaction.objects.acreate(
+                    booking=booking,
+                    checkout_request_id=payment_result['checkout_request_id'],
+                    merchant_request_id=payment_result.get('merchant_request_id', ''),
+                    phone_number=f"254{mpesa_number}",
+                    amount=booking.total_amount,
+                    status='pending',
+                    mpesa_response=payment_result
+                )
+
+                messages.success(request,
+                    f"Payment request sent successfully! Please check your phone for the M-Pesa prompt and enter your PIN to complete the payment. "
+                    f"Transaction ID: {payment_result['checkout_request_id']}")
+
+                return redirect('payment_status_async', booking.id, transaction.checkout_request_id)
+            elif payment_result.get('error_code') == 'SERVICE_UNAVAILABLE':
+                messages.error(request, UNAVAILABLE_MESSAGE)
+                return await arender(request, 'wafungi/payment.html', {'booking': booking, 'payments_unavailable': True})
+            else:
+                error_message = payment_result.get('error', 'Payment failed')
+                messages.error(request, f'Payment failed: {error_message}')
+                logger.error(f"Payment failed for booking {booking.id}: {payment_result}")
+
+        except Exception as e:
+            messages.error(request, f'Payment processing error: {str(e)}')
+            logger.error(f"Payment processing error for booking {booking.id}: {str(e)}")
+
+    return await arender(request, 'wafungi/payment.html', {'booking': booking})
+
+@login_required
+async def payment_status_async(request, booking_id, checkout_request_id):
+    """Check payment status, querying Daraja without blocking while it is pending"""
+    user = await request.auser()
+    booking = await aget_object_or_404(Booking, id=booking_id, client=user)
+    transaction = await aget_object_or_404(PaymentTransaction,
+                                           booking=booking,
+                                           checkout_request_id=checkout_request_id)
+
+    # Apply this payment's callback now if the worker has not got to it yet
+    if transaction.status == 'pending':
+        await sync_to_async(process_callback_inbox)(checkout_request_id=checkout_request_id)
+        await transaction.arefresh_from_db()
+
+    if transaction.status == 'completed':
+        return redirect('payment_success', booking.id)
+
+    if request.method == 'POST' and request.POST.get('simulate_payment'):
+        await sync_to_async(complete_payment)(
+            transaction.checkout_request_id,
+            f'MPESA{booking.id}{timezone.now().strftime("%Y%m%d%H%M%S")}'
+        )
+        return redirect('payment_success', booking.id)
+
+    if transaction.status == 'pending':
+        status_result = await averify_payment_status(checkout_request_id)
+        result_code = status_result.get('result_code') if status_result.get('success') else None
+        if result_code is not None:
+            result_code = str(result_code)
+
+        if result_code == '0':
+            # The callback carries the receipt number; apply it if it has arrived meanwhile
+            if await _current_payment_status(transaction) != 'completed':
+                await sync_to_async(complete_payment)(checkout_request_id, status_result.get('transaction_id'))
+            return redirect('payment_success', booking.id)
+        elif result_code is not None:
+            await sync_to_async(fail_payment)(checkout_request_id, result_code, status_result.get('data'))
+            transaction.status = 'cancelled' if result_code in CANCELLED_RESULT_CODES else 'failed'
+            messages.error(request, f"Payment was not completed: {status_result.get('result_desc')}")
+
+    context = {
+        'booking': booking,
+        'transaction': transaction,
+        'checkout_request_id': checkout_request_id,
+    }
+
+    return await arender(request, 'wafungi/payment_status.html', context)
+
+async def _current_payment_status(transaction):
+    """Latest status, applying any callback for it that is still in the inbox"""
+    if transaction.status == 'pending':
+        await sync_to_async(process_callback_inbox)(checkout_request_id=transaction.checkout_request_id)
+    transaction.status = await PaymentTransaction.objects.filter(
+        pk=transaction.pk
+    ).values_list('status', flat=True).aget()
+    return transaction.status
+
+async def _next_payment_status(transaction, known_status, timeout):
+    """Wait up to ``timeout`` seconds for the status to differ from ``known_status``"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    # Read the version before the status so an update in between is not missed
+    version = await aget_payment_version(transaction.checkout_request_id)
+    status = await _current_payment_status(transaction)
+
+    while status == known_status:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        version = await wait_for_payment_update(transaction.checkout_request_id, version, remaining)
+        if version is None:
+            break
+        status = await _current_payment_status(transaction)
+
+    return status
+
+def _payment_status_payload(transaction, status):
+    payload = {'checkout_request_id': transaction.checkout_request_id, 'status': status}
+    if status == 'completed':
+        payload['redirect_url'] = reverse('payment_success', args=[transaction.booking_id])
+    return payload
+
+@login_required
+async def payment_status_events(request, booking_id, checkout_request_id):
+    """
+    Push payment status changes to the payment status page
+    
+    Long-polls by default: returns as soon as the status differs from the
+    ``status`` query parameter, or with ``changed: false`` after
+    MPESA_STATUS_LONGPOLL_TIMEOUT seconds. Clients sending
+    ``Accept: text/event-stream`` get a server-sent event stream instead.
+    Either way the request is woken when a callback for the payment arrives.
+    
+    Under WSGI every wait would hold a worker, so both answer with the
+    current status at once: the long-poll response carries ``retry_after``
+    seconds and the stream ends after its first event, leaving the browser
+    to ask again (a short poll).
+    """
+    user = await request.auser()
+    transaction = await aget_object_or_404(
+        PaymentTransaction.objects.only('id', 'booking_id', 'checkout_request_id', 'status'),
+        booking_id=booking_id, booking__client=user, checkout_request_id=checkout_request_id
+    )
+    known_status = request.GET.get('status', 'pending')
+    short_poll = not isinstance(request, ASGIRequest)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        timeout = 0 if short_poll else getattr(settings, 'MPESA_STATUS_STREAM_TIMEOUT', 300)
+        response = StreamingHttpResponse(_payment_status_stream(transaction, timeout), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    max_timeout = 0 if short_poll else getattr(settings, 'MPESA_STATUS_LONGPOLL_TIMEOUT', 25)
+    try:
+        timeout = min(float(request.GET.get('timeout', '')), max_timeout)
+    except ValueError:
+        timeout = max_timeout
+
+    status = await _next_payment_status(transaction, known_status, max(timeout, 0))
+    payload = _payment_status_payload(transaction, status)
+    payload['changed'] = status != known_status
+    if short_poll:
+        payload['retry_after'] = STATUS_RETRY_MS / 1000
+    return JsonResponse(payload)
+
+async def _payment_status_stream(transaction, timeout):
+    """Server-sent events for a payment until it settles or the stream times out"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    heartbeat = getattr(settings, 'MPESA_STATUS_HEARTBEAT', 15)
+
+    yield f'retry: {STATUS_RETRY_MS}\n\n'
+    status = await _current_payment_status(transaction)
+    yield f"event: status\ndata: {json.dumps(_payment_status_payload(transaction, status))}\n\n"
+
+    while status == 'pending' and loop.time() < deadline:
+        new_status = await _next_payment_status(transaction, status, min(heartbeat, deadline - loop.time()))
+        if new_status == status:
+            yield ': keep-alive\n\n'
+            continue
+        status = new_status
+        yield f"event: status\ndata: {json.dumps(_payment_status_payload(transaction, status))}\n\n"
@@ -0,0 +1,313 @@
+"""
+Availability of musicians and instrument listings
+
+A musician or listing is busy while a pending or confirmed booking covers
+the time. Bookings overlap when each starts before the other ends, which the
+(musician|instrument_listing, start_date, end_date) indexes answer directly.
+Questions about many resources at once load every busy interval in the
+window with one query into an IntervalIndex and answer from memory.
+
+Calendars get busy time as bitmaps, one bit per hour or day of a window, for
+many musicians or listings from one query. Bitmaps are cached per resource
+and window until a booking changes, which bumps a version in the cache.
+
+Days with a blocking booking are also materialized as BusyDay rows, updated
+whenever a booking is saved, so searches can filter on "free on" a date.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import Booking, BusyDay, InstrumentListing, User
+
+# Bookings that hold their slot
+BLOCKING_STATUSES = ('pending', 'confirmed')
+
+# Booking column per kind of resource
+RESOURCE_FIELDS = {
+    'musician': 'musician',
+    'instrument': 'instrument_listing',
+}
+
+# Booking lookup of the ids the APIs use: musician profile and listing ids
+PUBLIC_ID_LOOKUPS = {
+    'musician': 'musician__musicianprofile__id',
+    'instrument': 'instrument_listing_id',
+}
+
+RESOLUTIONS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+VERSION_KEY = 'availability:version'
+
+
+class BookingConflict(Exception):
+    """Raised when a booking would overlap one that already holds the slot"""
+
+    def __init__(self, conflicting):
+        super().__init__(f"Overlaps booking {conflicting.pk} ({conflicting.start_date} - {conflicting.end_date})")
+        self.conflicting = conflicting
+
+
+def overlapping(kind, resource_ids, start, end):
+    """Blocking bookings of the resources that overlap [start, end)"""
+    field = RESOURCE_FIELDS[kind]
+    return Booking.objects.filter(
+        **{f'{field}_id__in': list(resource_ids)},
+        status__in=BLOCKING_STATUSES,
+        start_date__lt=end,
+        end_date__gt=start,
+    )
+
+
+def is_free(kind, resource_id, start, end, exclude=None):
+    """
+    Whether the musician (user id) or listing has no blocking booking overlapping [start, end)
+
+    Args:
+        kind (str): 'musician' or 'instrument'
+        resource_id (int): Musician's user id or listing id
+        start, end (datetime): The slot
+        exclude (int, optional): Booking to ignore, e.g. the one being checked
+    """
+    bookings = overlapping(kind, [resource_id], start, end)
+    if exclude is not None:
+        bookings = bookings.exclude(pk=exclude)
+    return not bookings.exists()
+
+
+def free_among(kind, resource_ids, start, end):
+    """The resources in ``resource_ids`` that are free for the whole slot, in one query"""
+    field = RESOURCE_FIELDS[kind]
+    busy = set(overlapping(kind, resource_ids, start, end).values_list(f'{field}_id', flat=True))
+    return [resource_id for resource_id in resource_ids if resource_id not in busy]
+
+
+class IntervalIndex:
+    """
+    Busy intervals per resource, merged and sorted for bisection
+
+    Built from a single query over a window; is_free and busy_intervals are
+    then answered without touching the database.
+    """
+
+    def __init__(self, intervals=()):
+        by_resource = defaultdict(list)
+        for resource_id, start, end in intervals:
+            by_resource[resource_id].append((start, end))
+        self.starts = {}
+        self.ends = {}
+        for resource_id, spans in by_resource.items():
+            spans.sort()
+            merged = [list(spans[0])]
+            for start, end in spans[1:]:
+                if start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[resource_id] = [start for start, _ in merged]
+            self.ends[resource_id] = [end for _, end in merged]
+
+    @classmethod
+    def load(cls, kind, resource_ids, start, end):
+        """Index of the blocking bookings of ``resource_ids`` that touch [start, end)"""
+        field = RESOURCE_FIELDS[kind]
+        return cls(overlapping(kind, resource_ids, start, end).values_list(f'{field}_id', 'start_date', 'end_date'))
+
+    def busy_intervals(self, resource_id):
+        """Merged (start, end) busy intervals of a resource"""
+        return list(zip(self.starts.get(resource_id, ()), self.ends.get(resource_id, ())))
+
+    def is_free(self, resource_id, start, end):
+        starts = self.starts.get(resource_id)
+        if not starts:
+            return True
+        # Intervals are disjoint, so only the last one starting before ``end`` can overlap
+        position = bisect_left(starts, end) - 1
+        return position < 0 or self.ends[resource_id][position] <= start
+
+
+def book(booking):
+    """
+    Save a new booking unless its musician or instrument is taken for that time
+
+    The musician's user row or the listing row is locked first, so two
+    requests for the same slot are serialized and the second sees the first.
+
+    Raises:
+        BookingConflict: A pending or confirmed booking overlaps it
+    """
+    if booking.instrument_listing_id:
+        kind, resource_id, model = 'instrument', booking.instrument_listing_id, InstrumentListing
+    else:
+        kind, resource_id, model = 'musician', booking.musician_id, User
+
+    with transaction.atomic():
+        model.objects.select_for_update().filter(pk=resource_id).first()
+        conflicting = overlapping(kind, [resource_id], booking.start_date, booking.end_date).order_by('start_date').first()
+        if conflicting is not None:
+            raise BookingConflict(conflicting)
+        booking.save()
+    return booking
+
+
+def busy_bitmaps(kind, ids, start, slots, step):
+    """
+    Busy bitmap per resource over ``slots`` slots of length ``step`` from ``start``
+
+    Bit ``i`` is set when a pending or confirmed booking overlaps slot ``i``.
+    Every resource comes from one query over the window.
+
+    Args:
+        kind (str): 'musician' or 'instrument'
+        ids (list): Musician profile ids or listing ids
+        start (datetime): Start of the first slot
+        slots (int): Number of slots
+        step (timedelta): Slot length
+
+    Returns:
+        dict: Id -> int bitmap (0 when free throughout)
+    """
+    end = start + step * slots
+    lookup = PUBLIC_ID_LOOKUPS[kind]
+    bitmaps = dict.fromkeys(ids, 0)
+    rows = Booking.objects.filter(
+        **{f'{lookup}__in': list(ids)},
+        status__in=BLOCKING_STATUSES,
+        start_date__lt=end,
+        end_date__gt=start,
+    ).values_list(lookup, 'start_date', 'end_date')
+    for resource_id, booked_from, booked_until in rows:
+        first = max(0, (booked_from - start) // step)
+        last = min(slots, -(-(booked_until - start) // step))  # slot after the last one touched
+        if last > first:
+            bitmaps[resource_id] |= ((1 << (last - first)) - 1) << first
+    return bitmaps
+
+
+def cached_busy_bitmaps(kind, ids, start, slots, resolution):
+    """busy_bitmaps with one cache entry per resource and window; misses share one query"""
+    version = cache.get(VERSION_KEY, 0)
+    prefix = f"availability:{version}:{kind}:{resolution}:{start.isoformat()}:{slots}"
+    keys = {resource_id: f"{prefix}:{resource_id}" for resource_id in ids}
+    cached = cache.get_many(keys.values())
+    bitmaps = {resource_id: cached[key] for resource_id, key in keys.items() if key in cached}
+    missing = [resource_id for resource_id in ids if resource_id not in bitmaps]
+    if missing:
+        fresh = busy_bitmaps(kind, missing, start, slots, RESOLUTIONS[resolution])
+        cache.set_many(
+            {keys[resource_id]: bitmap for resource_id, bitmap in fresh.items()},
+            getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 300),
+        )
+        bitmaps.update(fresh)
+    return bitmaps
+
+
+def invalidate_availability():
+    """Expire every cached availability bitmap once the current transaction commits"""
+    def bump():
+        if not cache.add(VERSION_KEY, 1, timeout=None):
+            try:
+                cache.incr(VERSION_KEY)
+            except ValueError:
+                cache.set(VERSION_KEY, 1, timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def booking_days(start, end):
+    """Local dates that [start, end) touches"""
+    first = timezone.localtime(start).date()
+    last = timezone.localtime(end - timedelta(microseconds=1)).date()
+    return [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+
+def resource_of(booking):
+    """(kind, resource id) of the musician or listing a booking is for, None for neither"""
+    if booking.instrument_listing_id:
+        return 'instrument', booking.instrument_listing_id
+    if booking.musician_id:
+        return 'musician', booking.musician_id
+    return None
+
+
+def refresh_busy_days(kind, resource_id, days):
+    """
+    Bring the BusyDay rows of one musician (user id) or listing up to date for ``days``
+
+    Recomputed from the blocking bookings of those days rather than
+    counted up and down, so repeated or out-of-order updates cannot drift.
+    """
+    if not days:
+        return
+    field = RESOURCE_FIELDS[kind]
+    days = set(days)
+    window_start = timezone.make_aware(datetime.combine(min(days), time.min))
+    window_end = timezone.make_aware(datetime.combine(max(days) + timedelta(days=1), time.min))
+    busy = set()
+    for start, end in overlapping(kind, [resource_id], window_start, window_end).values_list('start_date', 'end_date'):
+        busy.update(day for day in booking_days(start, end) if day in days)
+
+    with transaction.atomic():
+        rows = BusyDay.objects.filter(**{f'{field}_id': resource_id, 'day__in': days})
+        rows.exclude(day__in=busy).delete()
+        existing = set(rows.values_list('day', flat=True))
+        BusyDay.objects.bulk_create(
+            [BusyDay(**{f'{field}_id': resource_id, 'day': day}) for day in busy - existing],
+            ignore_conflicts=True,
+        )
+
+
+def booking_footprint(booking):
+    """(resource, days) a booking blocks or would block, resource None for neither"""
+    return resource_of(booking), booking_days(booking.start_date, booking.end_date)
+
+
+def booking_changed(booking, previous=None):
+    """
+    Update the busy days a booking covers after it was created, confirmed or cancelled
+
+    ``previous`` is the booking's booking_footprint() before an edit; the
+    days it no longer covers (or its old musician or listing) are refreshed
+    too, so a moved or shortened booking frees them.
+    """
+    resource, days = booking_footprint(booking)
+    days = set(days)
+    if previous is not None:
+        old_resource, old_days = previous
+        if old_resource == resource:
+            days.update(old_days)
+        elif old_resource:
+            refresh_busy_days(*old_resource, old_days)
+    if resource:
+        refresh_busy_days(*resource, days)
+
+
+def free_on(queryset, kind, day):
+    """
+    Musician profiles or listings without a blocking booking on ``day``
+
+    An anti-join against BusyDay on its (day, resource) index.
+    """
+    if kind == 'musician':
+        busy = BusyDay.objects.filter(day=day, musician=OuterRef('user_id'))
+    else:
+        busy = BusyDay.objects.filter(day=day, instrument_listing=OuterRef('pk'))
+    return queryset.filter(~Exists(busy))
+
+
+def busy_ids_on(kind, day):
+    """Musician profile or listing ids with a blocking booking on ``day``"""
+    if kind == 'musician':
+        return list(BusyDay.objects.filter(day=day, musician__musicianprofile__isnull=False).values_list(
+            'musician__musicianprofile__id', flat=True
+        ))
+    return list(BusyDay.objects.filter(day=day, instrument_listing__isnull=False).values_list('instrument_listing_id', flat=True))
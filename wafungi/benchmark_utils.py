@@ -0,0 +1,215 @@
+"""
+Repeatable benchmarks of hot views and utilities
+
+Each benchmark is a zero-argument callable run against whatever data is in
+the database (see the generate_fake_data command). measure() runs it with
+the request timing collector active, so every iteration reports its latency
+and query count; results are summarized into latency percentiles, saved as
+JSON baselines and compared against an earlier baseline to flag regressions.
+"""
+import gc
+import json
+import statistics
+import time
+from itertools import count
+
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from .email_utils import send_email_with_template
+from .management.commands.load_test_payments import percentile
+from .models import Booking, Genre, Instrument, User
+from .pdf_utils import generate_payment_receipt_pdf
+from .timing_utils import collect_timings
+
+# Dashboards benchmarked, one sample user each
+DASHBOARD_USER_TYPES = ('musician', 'organizer', 'instrument_owner', 'client')
+
+BASELINE_FORMAT = 1
+
+
+def _get(client, url, params=None):
+    def run():
+        response = client.get(url, params or {})
+        if response.status_code != 200:
+            raise AssertionError(f"GET {url} returned {response.status_code}")
+    return run
+
+
+def _client(user=None):
+    client = Client()
+    if user is not None:
+        client.force_login(user)
+    return client
+
+
+def _mpesa_callback(client):
+    sequence = count()
+
+    def run():
+        checkout_request_id = f'ws_CO_BENCH_{time.time_ns()}_{next(sequence)}'
+        payload = {'Body': {'stkCallback': {
+            'MerchantRequestID': 'bench', 'CheckoutRequestID': checkout_request_id,
+            'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+        }}}
+        response = client.post(reverse('mpesa_callback'), json.dumps(payload), content_type='application/json')
+        if response.json().get('ResultCode') != 0:
+            raise AssertionError('mpesa_callback did not acknowledge')
+    return run
+
+
+def _payment_receipt_pdf(booking):
+    def run():
+        generate_payment_receipt_pdf(booking, 'BENCH0000001', timezone.now())
+    return run
+
+
+def _confirmation_email(booking):
+    context = {
+        'booking': booking,
+        'client': booking.client,
+        'recipient': booking.client,
+        'is_client': True,
+        'musician': booking.musician,
+        'instrument_listing': booking.instrument_listing,
+    }
+
+    def run():
+        if not send_email_with_template(f"Booking Confirmation - {booking.id}", 'booking_confirmation',
+                                        context, [booking.client.email or 'bench@example.com']):
+            raise AssertionError('send_email_with_template failed')
+    return run
+
+
+def build_benchmarks():
+    """
+    Benchmarks runnable against the current data, by name
+
+    Benchmarks whose sample data is missing (e.g. no organizer yet) are left out.
+
+    Returns:
+        dict: Name -> zero-argument callable
+    """
+    anonymous = _client()
+    genre = Genre.objects.order_by('pk').first()
+    instrument = Instrument.objects.order_by('pk').first()
+    benchmarks = {
+        'home': _get(anonymous, reverse('home')),
+        'search_musicians': _get(anonymous, reverse('search_musicians')),
+        'search_instruments': _get(anonymous, reverse('search_instruments')),
+        'browse_events': _get(anonymous, reverse('browse_events')),
+        'mpesa_callback': _mpesa_callback(anonymous),
+    }
+    if genre is not None:
+        benchmarks['search_musicians_filtered'] = _get(
+            anonymous, reverse('search_musicians'), {'q': genre.name, 'genre': genre.pk}
+        )
+    if instrument is not None:
+        benchmarks['search_instruments_filtered'] = _get(
+            anonymous, reverse('search_instruments'), {'q': instrument.name, 'instrument': instrument.pk}
+        )
+
+    signed_in = None
+    for user_type in DASHBOARD_USER_TYPES:
+        user = User.objects.filter(user_type=user_type, is_active=True).order_by('pk').first()
+        if user is None or (user_type == 'musician' and not hasattr(user, 'musicianprofile')):
+            continue
+        signed_in = _client(user)
+        benchmarks[f'dashboard_{user_type}'] = _get(signed_in, reverse('dashboard'))
+    if signed_in is not None:
+        benchmarks['search_api'] = _get(signed_in, reverse('search_api'), {'q': genre.name[:4] if genre else 'gui'})
+
+    booking = Booking.objects.select_related(
+        'client', 'musician', 'instrument_listing__instrument', 'instrument_listing__owner'
+    ).filter(payment_status=True).order_by('pk').first()
+    if booking is not None:
+        benchmarks['generate_payment_receipt_pdf'] = _payment_receipt_pdf(booking)
+        benchmarks['send_email_with_template'] = _confirmation_email(booking)
+    return benchmarks
+
+
+def measure(run, iterations, warmup=2):
+    """
+    Latency (ms) and query count of each of ``iterations`` runs, after ``warmup`` unrecorded ones
+
+    Like timeit, garbage collection is held off while a run is timed.
+
+    Returns:
+        dict: Latency percentiles, mean, min and max in ms, and median and max query counts
+    """
+    for _ in range(warmup):
+        run()
+    latencies, queries = [], []
+    for _ in range(iterations):
+        gc.collect()
+        gc.disable()
+        try:
+            with collect_timings() as timings:
+                started = time.perf_counter()
+                run()
+                latencies.append((time.perf_counter() - started) * 1000)
+        finally:
+            gc.enable()
+        queries.append(timings.queries)
+    return {
+        'iterations': iterations,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'mean_ms': round(statistics.fmean(latencies), 2),
+        'min_ms': round(min(latencies), 2),
+        'max_ms': round(max(latencies), 2),
+        'queries': statistics.median_low(queries),
+        'queries_max': max(queries),
+    }
+
+
+def dataset_summary():
+    """Row counts saved with a baseline, so comparisons across datasets stand out"""
+    return {
+        'users': User.objects.count(),
+        'bookings': Booking.objects.count(),
+    }
+
+
+def baseline(results):
+    return {
+        'format': BASELINE_FORMAT,
+        'created_at': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'dataset': dataset_summary(),
+        'results': results,
+    }
+
+
+def compare(results, base, threshold=0.2, min_delta_ms=2.0, metric='p50_ms'):
+    """
+    Benchmarks slower than the baseline by more than ``threshold``, or running more queries
+
+    A slowdown must also exceed ``min_delta_ms``, so noise on millisecond-fast
+    benchmarks does not count.
+
+    Args:
+        results (dict): Name -> measure() output of this run
+        base (dict): A saved baseline()
+        threshold (float): Allowed relative slowdown, 0.2 for 20%
+        min_delta_ms (float): Allowed absolute slowdown in ms
+        metric (str): Latency statistic compared
+
+    Returns:
+        list: (name, description) of each regression
+    """
+    regressions = []
+    for name, result in results.items():
+        before = base['results'].get(name)
+        if before is None:
+            continue
+        slower = result[metric] - before[metric]
+        if before[metric] > 0 and slower > before[metric] * threshold and slower > min_delta_ms:
+            change = result[metric] / before[metric] - 1
+            regressions.append((name, f"{metric} {before[metric]:.2f} -> {result[metric]:.2f}ms (+{change:.0%})"))
+        if result['queries'] > before['queries']:
+            regressions.append((name, f"queries {before['queries']} -> {result['queries']}"))
+    return regressions
@@ -0,0 +1,173 @@
+"""
+iCalendar (.ics) feeds of a user's bookings
+
+Each user gets a secret feed URL carrying a signed token, so calendar apps
+can subscribe without a session. Feeds carry an ETag and Last-Modified taken
+from one aggregate query over the user's bookings and the events, listings
+and users they show; a poll that matches is answered with 304 before anything
+is rendered. Rendered feeds are streamed and cached under their ETag, so an
+unchanged feed is rendered once.
+"""
+import hashlib
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .listing_utils import booking_listing
+from .models import User
+
+TOKEN_SALT = 'wafungi.calendar.feed'
+
+# Past bookings kept in the feed
+HISTORY_DAYS = 90
+
+# Bump when the feed's content changes shape, to retire cached feeds and ETags
+FEED_FORMAT = 1
+
+STATUS_MAP = {
+    'pending': 'TENTATIVE',
+    'confirmed': 'CONFIRMED',
+    'completed': 'CONFIRMED',
+    'cancelled': 'CANCELLED',
+}
+
+# Related rows whose fields are rendered into the feed
+FEED_RELATIONS = ('event', 'instrument_listing', 'client', 'musician')
+
+
+def feed_token(user):
+    """Signed token identifying the user in their feed URL"""
+    return signing.Signer(salt=TOKEN_SALT).sign(str(user.pk))
+
+
+def user_for_token(token):
+    """Active user a feed token was issued to, None for a bad token"""
+    try:
+        user_id = signing.Signer(salt=TOKEN_SALT).unsign(token)
+    except signing.BadSignature:
+        return None
+    return User.objects.filter(pk=user_id, is_active=True).first()
+
+
+def feed_bookings(user):
+    """Bookings in a user's feed: played, rented out or made, from HISTORY_DAYS ago on"""
+    since = timezone.now() - timedelta(days=HISTORY_DAYS)
+    return booking_listing(user).queryset.filter(end_date__gte=since)
+
+
+def feed_validators(user):
+    """
+    ETag and Last-Modified of a user's feed, from one aggregate query
+
+    The feed also shows the event, the listing and the other party's name, so
+    their rows' modification times count alongside the bookings'. The count is
+    part of the ETag so deleted bookings change it too.
+
+    Returns:
+        tuple: (etag, last_modified datetime or None)
+    """
+    summary = feed_bookings(user).aggregate(
+        total=Count('id'),
+        booking_modified=Max('updated_at'),
+        **{f'{field}_modified': Max(f'{field}__updated_at') for field in FEED_RELATIONS},
+    )
+    stamps = [summary[f'{name}_modified'] for name in ('booking', *FEED_RELATIONS)]
+    latest = max(filter(None, stamps), default=None)
+    fingerprint = ':'.join([str(FEED_FORMAT), str(user.pk), str(summary['total']),
+                            *(stamp.isoformat() if stamp else '' for stamp in stamps)])
+    return f'"{hashlib.md5(fingerprint.encode()).hexdigest()}"', latest
+
+
+def _escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Content line folded at 75 octets, as RFC 5545 requires"""
+    data = line.encode()
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end -= 1  # never split a UTF-8 sequence
+        parts.append(data[start:end].decode())
+        start, limit = end, 74  # continuation lines start with a space
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _stamp(value):
+    return value.astimezone(dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def booking_summary(booking, user):
+    if booking.instrument_listing_id:
+        listing = booking.instrument_listing
+        return f"Rental: {listing.brand} {listing.model}"
+    if booking.event_id:
+        return f"Gig: {booking.event.title}"
+    other = booking.client if booking.musician_id == user.pk else booking.musician
+    return f"Booking with {other.get_full_name() or other.username}" if other else "Booking"
+
+
+def booking_event_lines(booking, user, host):
+    yield 'BEGIN:VEVENT'
+    yield f'UID:booking-{booking.pk}@{host}'
+    yield f'DTSTAMP:{_stamp(booking.updated_at)}'
+    yield f'LAST-MODIFIED:{_stamp(booking.updated_at)}'
+    yield f'DTSTART:{_stamp(booking.start_date)}'
+    yield f'DTEND:{_stamp(booking.end_date)}'
+    yield f'SUMMARY:{_escape(booking_summary(booking, user))}'
+    yield f'STATUS:{STATUS_MAP.get(booking.status, "TENTATIVE")}'
+    description = f"Status: {booking.get_status_display()}. {'Paid' if booking.payment_status else 'Awaiting payment'}."
+    if booking.notes:
+        description += f"\n{booking.notes}"
+    yield f'DESCRIPTION:{_escape(description)}'
+    if booking.event_id and booking.event.location:
+        yield f'LOCATION:{_escape(booking.event.location)}'
+    elif booking.instrument_listing_id and booking.instrument_listing.location:
+        yield f'LOCATION:{_escape(booking.instrument_listing.location)}'
+    yield 'END:VEVENT'
+
+
+def iter_feed(user, host):
+    """
+    The user's feed as a stream of folded, CRLF-terminated lines
+
+    Bookings are read in chunks, so long histories are never held in memory.
+    """
+    yield from map(_fold, ('BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//WAFUNGI-NATION//Bookings//EN',
+                           'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+                           f'X-WR-CALNAME:{_escape("WAFUNGI-NATION bookings")}'))
+    bookings = feed_bookings(user).order_by('start_date', 'id')
+    for booking in bookings.iterator(chunk_size=500):
+        yield from map(_fold, booking_event_lines(booking, user, host))
+    yield _fold('END:VCALENDAR')
+
+
+def cached_feed(user, etag, host):
+    """
+    Rendered feed for ``etag``: a cached string, or a stream that caches itself when done
+
+    Returns:
+        str or iterator
+    """
+    key = f"calendar:{user.pk}:{hashlib.md5(f'{etag}:{host}'.encode()).hexdigest()}"
+    body = cache.get(key)
+    if body is not None:
+        return body
+
+    def stream():
+        chunks = []
+        for chunk in iter_feed(user, host):
+            chunks.append(chunk)
+            yield chunk
+        cache.set(key, ''.join(chunks), getattr(settings, 'CALENDAR_FEED_CACHE_TIMEOUT', 3600))
+
+    return stream()
@@ -0,0 +1,47 @@
+"""
+System checks for settings that only work as intended in a multi-process deployment
+"""
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.checks import Tags, Warning, register
+
+# Backends whose data never leaves the process
+PER_PROCESS_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# Settings naming a cache alias whose state every worker must see
+SHARED_CACHE_SETTINGS = {
+    'MPESA_BREAKER_CACHE_ALIAS': 'Daraja circuit breaker state',
+}
+
+
+def is_per_process(alias):
+    """Whether the cache alias is backed by memory private to this process"""
+    backend = settings.CACHES.get(alias, {}).get('BACKEND', '')
+    return backend in PER_PROCESS_CACHE_BACKENDS
+
+
+@register(Tags.caches)
+def check_shared_caches(app_configs, **kwargs):
+    """Warn when state meant to be shared between workers lives in a per-process cache"""
+    if settings.DEBUG:
+        return []
+    warnings = []
+    for setting, purpose in SHARED_CACHE_SETTINGS.items():
+        alias = getattr(settings, setting, None)
+        if not alias:
+            continue
+        try:
+            caches[alias]
+        except InvalidCacheBackendError:
+            warnings.append(Warning(f"{setting} names an unknown cache alias {alias!r}.", id='wafungi.W002'))
+            continue
+        if is_per_process(alias):
+            warnings.append(Warning(
+                f"{purpose} is kept in the per-process cache {alias!r}, so each worker tracks it separately.",
+                hint=f"Set REDIS_URL, or point {setting} at a shared cache backend.",
+                id='wafungi.W001',
+            ))
+    return warnings
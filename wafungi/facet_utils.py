@@ -0,0 +1,423 @@
+"""
+Facet counts for the musician and instrument search pages
+
+Each facet value (a genre, an instrument type, a condition, a location) keeps
+a bitmap of the searchable objects that have it: a Python int with bit ``pk``
+set. Counting a facet under the current filters is then an AND and a
+popcount per value, without any COUNT queries. Counts are disjunctive: a
+facet's own filter is left out when counting its values, so picking a genre
+still shows how many musicians every other genre would give.
+
+Bitmaps are built in one pass per model on first use. A save or delete of a
+musician, listing, genre or instrument type then patches the bits of that one
+object in place, like the typeahead index, and bumps a version in the cache
+so that other processes rebuild. The bump only reaches them through a shared
+cache (REDIS_URL); with the default per-process cache they rebuild after
+SEARCH_INDEX_MAX_AGE seconds instead, so counts - and the 'total' - may lag
+behind and are never shown as a result count.
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .geo_utils import normalize_location
+from .models import Genre, Instrument, InstrumentListing, MusicianProfile
+
+VERSION_KEY = 'facets:version'
+
+# Most common locations listed as facet values
+LOCATION_FACET_SIZE = 10
+
+
+def to_bitmap(ids):
+    """Bitmap with the bits of ``ids`` set, built in linear time"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for object_id in ids:
+        buffer[object_id >> 3] |= 1 << (object_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class FacetIndex:
+    """Bitmaps per facet value over one kind of searchable object"""
+
+    def __init__(self, everything, postings, labels, prices=(), location_texts=None):
+        self.everything = everything
+        self.postings = postings  # facet -> {value: bitmap}; locations by gazetteer town when known
+        self.labels = labels  # facet -> {value: display name}
+        self.location_texts = location_texts or {}  # location as typed -> bitmap
+        self.prices = sorted(prices)  # (price, id)
+        self.price_values = [price for price, _ in self.prices]
+        self.price_of = {object_id: price for price, object_id in self.prices}
+
+    def remove(self, object_id):
+        """Clear ``object_id`` from every bitmap"""
+        mask = ~(1 << object_id)
+        self.everything &= mask
+        for facet, postings in self.postings.items():
+            for value, posting in list(postings.items()):
+                if posting >> object_id & 1:
+                    postings[value] = posting & mask
+                    # Genres and instrument types stay listed while empty, towns do not
+                    if facet == 'location' and not postings[value]:
+                        del postings[value]
+        for location, posting in list(self.location_texts.items()):
+            if posting >> object_id & 1:
+                posting &= mask
+                if posting:
+                    self.location_texts[location] = posting
+                else:
+                    del self.location_texts[location]
+        price = self.price_of.pop(object_id, None)
+        if price is not None:
+            position = bisect_left(self.prices, (price, object_id))
+            del self.prices[position]
+            del self.price_values[position]
+
+    def add(self, object_id, values, location=None, town=None, price=None):
+        """
+        Set the bits of a searchable object, replacing whatever it had
+
+        Args:
+            object_id (int): Object id
+            values (dict): Facet -> the object's values, other than location
+            location (str, optional): Location as typed
+            town (str, optional): Gazetteer town of ``location``
+            price (optional): Daily rate, for the price filter
+        """
+        self.remove(object_id)
+        bit = 1 << object_id
+        self.everything |= bit
+        for facet, facet_values in values.items():
+            postings = self.postings[facet]
+            for value in facet_values:
+                postings[value] = postings.get(value, 0) | bit
+        if location:
+            postings = self.postings['location']
+            key = town or location.strip()
+            postings[key] = postings.get(key, 0) | bit
+            self.location_texts[location] = self.location_texts.get(location, 0) | bit
+        if price is not None:
+            position = bisect_right(self.prices, (price, object_id))
+            self.prices.insert(position, (price, object_id))
+            self.price_values.insert(position, price)
+            self.price_of[object_id] = price
+
+    def set_label(self, facet, value, name):
+        """Add or rename a facet value such as a genre"""
+        self.labels[facet][value] = name
+        self.postings[facet].setdefault(value, 0)
+
+    def remove_value(self, facet, value):
+        self.labels[facet].pop(value, None)
+        self.postings[facet].pop(value, None)
+
+    def price_at_most(self, limit):
+        """Objects priced at or below ``limit``"""
+        return to_bitmap(object_id for _, object_id in self.prices[:bisect_right(self.price_values, limit)])
+
+    def location_matches(self, text):
+        """Objects in the town ``text`` names, else whose location contains it, like the listing filter"""
+        town = normalize_location(text)
+        if town:
+            return self.postings['location'].get(town, 0)
+        text = text.lower()
+        bitmap = 0
+        for location, posting in self.location_texts.items():
+            if text in location.lower():
+                bitmap |= posting
+        return bitmap
+
+    def counts(self, selected, restrict=None):
+        """
+        Facet counts for the objects matching the selected facet values
+
+        Args:
+            selected (dict): Facet -> selected value; 'location' is a substring
+            restrict (int, optional): Bitmap the results are limited to, e.g. search matches
+
+        Returns:
+            dict: Facet -> list of {'value', 'name', 'count'}, plus 'total'
+        """
+        filters = {}
+        for facet, value in selected.items():
+            if value in (None, ''):
+                continue
+            if facet == 'location':
+                filters[facet] = self.location_matches(value)
+            else:
+                filters[facet] = self.postings[facet].get(value, 0)
+
+        base = self.everything if restrict is None else self.everything & restrict
+        matching = base
+        for bitmap in filters.values():
+            matching &= bitmap
+
+        facets = {'total': matching.bit_count()}
+        for facet, postings in self.postings.items():
+            scope = base
+            for other, bitmap in filters.items():
+                if other != facet:
+                    scope &= bitmap
+            values = [
+                {'value': value, 'name': self.labels[facet].get(value, value), 'count': (posting & scope).bit_count()}
+                for value, posting in postings.items()
+            ]
+            if facet == 'location':
+                values = sorted((v for v in values if v['count']), key=lambda v: (-v['count'], v['name']))
+                values = values[:LOCATION_FACET_SIZE]
+            elif facet != 'condition':
+                values.sort(key=lambda v: v['name'])
+            facets[facet] = values
+        return facets
+
+
+def _to_bitmaps(postings):
+    return {value: to_bitmap(ids) for value, ids in postings.items()}
+
+
+def build_musician_index():
+    postings = {'genre': defaultdict(list), 'instrument': defaultdict(list), 'location': defaultdict(list)}
+    location_texts = defaultdict(list)
+    everything = []
+    for profile_id, location, town in MusicianProfile.objects.filter(
+        user__is_active=True, availability_status=True
+    ).values_list('id', 'user__location', 'user__town').iterator(chunk_size=5000):
+        everything.append(profile_id)
+        if location:
+            postings['location'][town or location.strip()].append(profile_id)
+            location_texts[location].append(profile_id)
+
+    for facet, through, column in (
+        ('genre', MusicianProfile.genres.through, 'genre_id'),
+        ('instrument', MusicianProfile.instruments.through, 'instrument_id'),
+    ):
+        for profile_id, value in through.objects.values_list('musicianprofile_id', column).iterator(chunk_size=5000):
+            postings[facet][value].append(profile_id)
+
+    labels = {
+        'genre': dict(Genre.objects.values_list('id', 'name')),
+        'instrument': dict(Instrument.objects.values_list('id', 'name')),
+        'location': {},
+    }
+    # Values nobody has yet still show up, with a zero count
+    for facet in ('genre', 'instrument'):
+        for value in labels[facet]:
+            postings[facet].setdefault(value, [])
+    return FacetIndex(
+        to_bitmap(everything),
+        {facet: _to_bitmaps(p) for facet, p in postings.items()},
+        labels,
+        location_texts=_to_bitmaps(location_texts),
+    )
+
+
+def build_instrument_index():
+    postings = {
+        'instrument': defaultdict(list),
+        # Conditions stay in quality order
+        'condition': defaultdict(list, {value: [] for value, _ in InstrumentListing.CONDITION_CHOICES}),
+        'location': defaultdict(list),
+    }
+    location_texts = defaultdict(list)
+    everything = []
+    prices = []
+    for listing_id, instrument_id, condition, location, town, daily_rate in InstrumentListing.objects.filter(
+        is_available=True
+    ).values_list('id', 'instrument_id', 'condition', 'location', 'town', 'daily_rate').iterator(chunk_size=5000):
+        everything.append(listing_id)
+        prices.append((daily_rate, listing_id))
+        postings['instrument'][instrument_id].append(listing_id)
+        postings['condition'][condition].append(listing_id)
+        if location:
+            postings['location'][town or location.strip()].append(listing_id)
+            location_texts[location].append(listing_id)
+
+    labels = {
+        'instrument': dict(Instrument.objects.values_list('id', 'name')),
+        'condition': dict(InstrumentListing.CONDITION_CHOICES),
+        'location': {},
+    }
+    for value in labels['instrument']:
+        postings['instrument'].setdefault(value, [])
+    return FacetIndex(
+        to_bitmap(everything),
+        {facet: _to_bitmaps(p) for facet, p in postings.items()},
+        labels,
+        prices,
+        location_texts=_to_bitmaps(location_texts),
+    )
+
+
+def read_musician(profile_id):
+    """The arguments to FacetIndex.add for a musician, or None when hidden from search"""
+    row = MusicianProfile.objects.filter(
+        pk=profile_id, user__is_active=True, availability_status=True
+    ).values_list('user__location', 'user__town').first()
+    if row is None:
+        return None
+    location, town = row
+    values = {
+        'genre': list(MusicianProfile.genres.through.objects.filter(
+            musicianprofile_id=profile_id).values_list('genre_id', flat=True)),
+        'instrument': list(MusicianProfile.instruments.through.objects.filter(
+            musicianprofile_id=profile_id).values_list('instrument_id', flat=True)),
+    }
+    return {'values': values, 'location': location, 'town': town}
+
+
+def read_listing(listing_id):
+    """The arguments to FacetIndex.add for a listing, or None when not available"""
+    row = InstrumentListing.objects.filter(pk=listing_id, is_available=True).values_list(
+        'instrument_id', 'condition', 'location', 'town', 'daily_rate'
+    ).first()
+    if row is None:
+        return None
+    instrument_id, condition, location, town, daily_rate = row
+    values = {'instrument': [instrument_id], 'condition': [condition]}
+    return {'values': values, 'location': location, 'town': town, 'price': daily_rate}
+
+
+FACET_BUILDERS = {
+    'musician': build_musician_index,
+    'instrument': build_instrument_index,
+}
+
+FACET_READERS = {
+    'musician': read_musician,
+    'instrument': read_listing,
+}
+
+# Facet values with a label, and the indexes that list them
+LABELLED_FACETS = {
+    'genre': ('musician',),
+    'instrument': ('musician', 'instrument'),
+}
+
+_indexes = {}
+_expires_at = {}
+_version = None
+_lock = threading.Lock()
+
+
+def get_facet_index(kind):
+    global _version
+    with _lock:
+        version = cache.get(VERSION_KEY, 0)
+        if version != _version:
+            _indexes.clear()
+            _version = version
+        now = time.monotonic()
+        if kind not in _indexes or now >= _expires_at[kind]:
+            _indexes[kind] = FACET_BUILDERS[kind]()
+            _expires_at[kind] = now + getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+        return _indexes[kind]
+
+
+def _bump_version():
+    if not cache.add(VERSION_KEY, 1, timeout=None):
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, 1, timeout=None)
+    return cache.get(VERSION_KEY, 0)
+
+
+def _patch(kinds, apply):
+    """Apply a change to this process's indexes of ``kinds`` and tell other processes"""
+    global _version
+    with _lock:
+        if cache.get(VERSION_KEY, 0) != _version:
+            # Already behind another process: rebuild instead of patching
+            _indexes.clear()
+        for kind in kinds:
+            if kind in _indexes:
+                apply(_indexes[kind])
+        # Our own indexes are already current
+        _version = _bump_version()
+
+
+def facet_object_changed(kind, object_id):
+    """Update a musician's or listing's facet bits once the current transaction commits"""
+    def update():
+        row = FACET_READERS[kind](object_id)
+        if row is None:
+            _patch((kind,), lambda index: index.remove(object_id))
+        else:
+            _patch((kind,), lambda index: index.add(object_id, **row))
+
+    transaction.on_commit(update)
+
+
+def facet_value_changed(facet, value, name):
+    """Add or rename a genre or instrument type once the current transaction commits"""
+    transaction.on_commit(lambda: _patch(LABELLED_FACETS[facet], lambda index: index.set_label(facet, value, name)))
+
+
+def facet_value_removed(facet, value):
+    transaction.on_commit(lambda: _patch(LABELLED_FACETS[facet], lambda index: index.remove_value(facet, value)))
+
+
+def invalidate_facets():
+    """Drop every process's facet bitmaps once the current transaction commits"""
+    def reset():
+        global _version
+        with _lock:
+            _indexes.clear()
+            _version = _bump_version()
+
+    transaction.on_commit(reset)
+
+
+def _as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _restriction(index, ids, exclude_ids):
+    restrict = None if ids is None else to_bitmap(ids)
+    if exclude_ids:
+        restrict = (index.everything if restrict is None else restrict) & ~to_bitmap(exclude_ids)
+    return restrict
+
+
+def musician_facets(genre=None, instrument=None, location=None, ids=None, exclude_ids=None):
+    """
+    Genre, instrument and location counts for the musician search filters
+
+    Args:
+        genre, instrument: Selected ids (query string values)
+        location (str): Location text, a town or part of a location
+        ids (list, optional): Search matches to count within
+        exclude_ids (list, optional): Ids left out, e.g. musicians booked on the chosen day
+
+    Returns:
+        dict: See FacetIndex.counts
+    """
+    index = get_facet_index('musician')
+    return index.counts(
+        {'genre': _as_id(genre), 'instrument': _as_id(instrument), 'location': location},
+        restrict=_restriction(index, ids, exclude_ids),
+    )
+
+
+def instrument_facets(instrument=None, condition=None, location=None, max_price=None, ids=None, exclude_ids=None):
+    """Instrument type, condition and location counts for the instrument search filters"""
+    index = get_facet_index('instrument')
+    restrict = _restriction(index, ids, exclude_ids)
+    if max_price is not None:
+        affordable = index.price_at_most(max_price)
+        restrict = affordable if restrict is None else restrict & affordable
+    return index.counts(
+        {'instrument': _as_id(instrument), 'condition': condition, 'location': location},
+        restrict=restrict,
+    )
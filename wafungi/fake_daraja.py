@@ -0,0 +1,350 @@
+"""
+Local stand-in for the Safaricom Daraja API
+
+Implements the OAuth, STK Push and STK Push query endpoints closely enough to
+exercise MPesaAPI and AsyncMPesaAPI offline, and can deliver the asynchronous
+result callbacks to our /mpesa/callback/. Latency, failure rates, customer
+cancellations and duplicate callbacks are configurable for load testing.
+Start it in-process from tests with ``FakeDarajaServer`` or standalone with
+``manage.py run_fake_daraja``.
+"""
+import base64
+import heapq
+import json
+import random
+import secrets
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+AUTH_PATH = '/oauth/v1/generate'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+QUERY_PATH = '/mpesa/stkpushquery/v1/query'
+
+
+class FakeDarajaState:
+    """
+    Tokens issued, STK requests received, call counters and behaviour knobs
+    
+    Args:
+        latency (float): Seconds added to every response
+        latency_jitter (float): Extra random latency, up to this many seconds
+        failure_rate (float): Fraction of requests answered with a 503
+        cancel_rate (float): Fraction of STK pushes the customer cancels (1032)
+        callback_delay (float): Seconds between an STK push and its result;
+            queries return "being processed" until then
+        send_callbacks (bool): POST results to the CallBackURL of each push
+        callback_url (str): Send callbacks here instead of the CallBackURL
+        duplicate_rate (float): Fraction of callbacks delivered twice
+        callback_workers (int): Concurrent callback deliveries
+    """
+
+    def __init__(self, consumer_key=None, consumer_secret=None, token_lifetime=3599,
+                 latency=0, latency_jitter=0, failure_rate=0, cancel_rate=0,
+                 callback_delay=0, send_callbacks=False, callback_url=None,
+                 duplicate_rate=0, callback_workers=8):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.token_lifetime = token_lifetime
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.failure_rate = failure_rate
+        self.cancel_rate = cancel_rate
+        self.callback_delay = callback_delay
+        self.send_callbacks = send_callbacks
+        self.callback_url = callback_url
+        self.duplicate_rate = duplicate_rate
+        self.callback_workers = callback_workers
+        self.tokens = set()
+        self.stk_requests = {}
+        self.counts = {'oauth': 0, 'stk_push': 0, 'query': 0, 'injected_failures': 0,
+                       'callbacks': 0, 'duplicate_callbacks': 0, 'callback_errors': 0}
+        self.callback_latencies = []
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def simulate_network(self):
+        """Sleep for the configured latency; True if this request should fail"""
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay:
+            time.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.count('injected_failures')
+            return True
+        return False
+
+    def issue_token(self):
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.counts['oauth'] += 1
+            self.tokens.add(token)
+        return token
+
+    def check_credentials(self, header):
+        if not header.startswith('Basic '):
+            return False
+        if self.consumer_key is None:
+            return True
+        try:
+            key, _, secret = base64.b64decode(header[6:]).decode().partition(':')
+        except (ValueError, UnicodeDecodeError):
+            return False
+        return key == self.consumer_key and secret == self.consumer_secret
+
+    def check_token(self, header):
+        return header.startswith('Bearer ') and header[7:] in self.tokens
+
+    def record_stk_push(self, payload):
+        checkout_request_id = f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{secrets.token_hex(6)}"
+        merchant_request_id = f"{secrets.randbelow(90000) + 10000}-{secrets.randbelow(9000000) + 1000000}-1"
+        if self.cancel_rate and random.random() < self.cancel_rate:
+            result_code, result_desc = '1032', 'Request cancelled by user'
+        else:
+            result_code, result_desc = '0', 'The service request is processed successfully.'
+        with self.lock:
+            self.counts['stk_push'] += 1
+            self.stk_requests[checkout_request_id] = {
+                'merchant_request_id': merchant_request_id,
+                'payload': payload,
+                'result_code': result_code,
+                'result_desc': result_desc,
+                'receipt_number': 'S' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=9)),
+                'completes_at': time.time() + self.callback_delay,
+            }
+        return checkout_request_id, merchant_request_id
+
+    def callback_body(self, checkout_request_id):
+        """The stkCallback Daraja would POST for a finished STK push"""
+        stk = self.stk_requests[checkout_request_id]
+        callback = {
+            'MerchantRequestID': stk['merchant_request_id'],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': int(stk['result_code']),
+            'ResultDesc': stk['result_desc'],
+        }
+        if stk['result_code'] == '0':
+            payload = stk['payload']
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': payload.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': stk['receipt_number']},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(payload.get('PhoneNumber') or 0)},
+            ]}
+        return {'Body': {'stkCallback': callback}}
+
+
+class CallbackDispatcher:
+    """Delivers STK results to the callback URL once their delay has passed"""
+
+    def __init__(self, state):
+        self.state = state
+        self.queue = []
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=state.callback_workers, thread_name_prefix='fake-daraja-callback')
+        self.session = requests.Session()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='fake-daraja-dispatcher', daemon=True)
+        self.thread.start()
+
+    def schedule(self, checkout_request_id):
+        stk = self.state.stk_requests[checkout_request_id]
+        url = self.state.callback_url or stk['payload'].get('CallBackURL')
+        deliveries = 2 if self.state.duplicate_rate and random.random() < self.state.duplicate_rate else 1
+        with self.condition:
+            for attempt in range(deliveries):
+                heapq.heappush(self.queue, (stk['completes_at'] + attempt * 0.05, checkout_request_id, url, attempt > 0))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.queue or self.queue[0][0] > time.time()):
+                    self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+                if self.stopped:
+                    return
+                _, checkout_request_id, url, duplicate = heapq.heappop(self.queue)
+            self.executor.submit(self.deliver, checkout_request_id, url, duplicate)
+
+    def deliver(self, checkout_request_id, url, duplicate):
+        started = time.monotonic()
+        try:
+            response = self.session.post(url, json=self.state.callback_body(checkout_request_id), timeout=30)
+            ok = response.status_code == 200 and response.json().get('ResultCode') == 0
+        except (requests.RequestException, ValueError):
+            ok = False
+        elapsed = time.monotonic() - started
+
+        with self.state.lock:
+            self.state.counts['callbacks'] += 1
+            if duplicate:
+                self.state.counts['duplicate_callbacks'] += 1
+            if not ok:
+                self.state.counts['callback_errors'] += 1
+            self.state.callback_latencies.append(elapsed)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FakeDarajaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeDaraja/1.0'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return None
+
+    def send_unavailable(self):
+        self.send_json(503, {'errorCode': '503.001.01', 'errorMessage': 'Service Unavailable'})
+
+    def do_GET(self):
+        if urlparse(self.path).path != AUTH_PATH:
+            return self.send_json(404, {'errorMessage': 'Not found'})
+
+        if self.state.simulate_network():
+            return self.send_unavailable()
+
+        if not self.state.check_credentials(self.headers.get('Authorization', '')):
+            return self.send_json(400, {'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'})
+
+        self.send_json(200, {
+            'access_token': self.state.issue_token(),
+            'expires_in': str(self.state.token_lifetime),
+        })
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path not in (STK_PUSH_PATH, QUERY_PATH):
+            return self.send_json(404, {'errorMessage': 'Not found'})
+
+        # Always consume the body so the keep-alive connection stays usable
+        payload = self.read_json()
+
+        if not self.state.check_token(self.headers.get('Authorization', '')):
+            return self.send_json(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+
+        if payload is None:
+            return self.send_json(400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid JSON'})
+
+        if self.state.simulate_network():
+            return self.send_unavailable()
+
+        if path == STK_PUSH_PATH:
+            self.handle_stk_push(payload)
+        else:
+            self.handle_query(payload)
+
+    def handle_stk_push(self, payload):
+        checkout_request_id, merchant_request_id = self.state.record_stk_push(payload)
+        if self.server.dispatcher is not None:
+            self.server.dispatcher.schedule(checkout_request_id)
+        self.send_json(200, {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+    def handle_query(self, payload):
+        with self.state.lock:
+            self.state.counts['query'] += 1
+        stk = self.state.stk_requests.get(payload.get('CheckoutRequestID'))
+        if stk is None or stk.get('completes_at', 0) > time.time():
+            return self.send_json(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+
+        self.send_json(200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': stk['merchant_request_id'],
+            'CheckoutRequestID': payload.get('CheckoutRequestID'),
+            'ResultCode': stk['result_code'],
+            'ResultDesc': stk['result_desc'],
+        })
+
+
+class FakeDarajaServer:
+    """
+    Threaded fake Daraja server bound to a local port
+
+    Usage::
+
+        with FakeDarajaServer() as daraja, override_settings(**daraja.settings()):
+            MPesaAPI().stk_push(...)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, **state_options):
+        self.state = FakeDarajaState(**state_options)
+        self.httpd = ThreadingHTTPServer((host, port), FakeDarajaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.httpd.dispatcher = CallbackDispatcher(self.state) if self.state.send_callbacks else None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def settings(self):
+        """Setting overrides that point the M-Pesa clients at this server"""
+        return {
+            'MPESA_BASE_URL': self.base_url,
+            'MPESA_AUTH_URL': f"{self.base_url}{AUTH_PATH}?grant_type=client_credentials",
+            'MPESA_STK_PUSH_URL': f"{self.base_url}{STK_PUSH_PATH}",
+            'MPESA_QUERY_URL': f"{self.base_url}{QUERY_PATH}",
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-daraja', daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.close()
+
+    def close(self):
+        """Release the socket and stop delivering callbacks"""
+        self.httpd.server_close()
+        if self.httpd.dispatcher is not None:
+            self.httpd.dispatcher.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
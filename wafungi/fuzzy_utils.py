@@ -0,0 +1,244 @@
+"""
+Typo-tolerant matching for musician and instrument searches
+
+Used when the full-text index finds nothing, so "guiter" or "yamah sax"
+still return guitarists and Yamaha saxophones. Matching runs over the
+search document titles, which hold the stage name and user names of
+musicians and the brand, model and instrument type of listings:
+
+* PostgreSQL: pg_trgm word similarity over a GIN trigram index
+* anything else: an in-process index from trigrams to title words
+
+Every query term has to resemble some word of the title. Both engines stop
+after FUZZY_SEARCH_BUDGET_MS and return what they have (PostgreSQL: nothing).
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
+
+from .models import SearchDocument
+
+logger = logging.getLogger(__name__)
+
+FUZZY_KINDS = ('musician', 'instrument')
+
+
+def trigrams(word):
+    """Trigrams of a word padded like pg_trgm: two spaces in front, one behind"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """Title words of one kind, with trigram postings to find words resembling a term"""
+
+    def __init__(self):
+        self.word_objects = defaultdict(set)
+        self.word_trigrams = {}
+        self.trigram_words = defaultdict(set)
+        self.documents = {}
+
+    def add(self, object_id, title):
+        from .search_utils import tokenize  # search_utils imports this module
+
+        self.remove(object_id)
+        words = set(tokenize(title))
+        self.documents[object_id] = words
+        for word in words:
+            if word not in self.word_trigrams:
+                grams = trigrams(word)
+                self.word_trigrams[word] = grams
+                for gram in grams:
+                    self.trigram_words[gram].add(word)
+            self.word_objects[word].add(object_id)
+
+    def remove(self, object_id):
+        for word in self.documents.pop(object_id, ()):
+            objects = self.word_objects[word]
+            objects.discard(object_id)
+            if not objects:
+                del self.word_objects[word]
+                for gram in self.word_trigrams.pop(word):
+                    self.trigram_words[gram].discard(word)
+                    if not self.trigram_words[gram]:
+                        del self.trigram_words[gram]
+
+    def similar_words(self, term, threshold):
+        """{word: similarity} for indexed words resembling ``term``"""
+        grams = trigrams(term)
+        shared = defaultdict(int)
+        for gram in grams:
+            for word in self.trigram_words.get(gram, ()):
+                shared[word] += 1
+
+        matches = {}
+        for word, count in shared.items():
+            score = count / (len(grams) + len(self.word_trigrams[word]) - count)
+            if word.startswith(term):
+                score = 1.0  # still typing
+            if score >= threshold:
+                matches[word] = score
+        return matches
+
+    def search(self, terms, limit, threshold, deadline):
+        scores = None
+        for term in terms:
+            term_scores = defaultdict(float)
+            for word, score in self.similar_words(term, threshold).items():
+                for object_id in self.word_objects[word]:
+                    term_scores[object_id] = max(term_scores[object_id], score)
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {object_id: score + term_scores[object_id]
+                          for object_id, score in scores.items() if object_id in term_scores}
+            if not scores:
+                return []
+            if time.perf_counter() > deadline:
+                logger.warning(f"Fuzzy search over budget after {terms.index(term) + 1}/{len(terms)} terms")
+                break
+        return sorted(scores, key=lambda object_id: (-scores[object_id], object_id))[:limit]
+
+
+class PythonTrigramBackend:
+    """
+    In-process trigram indexes, loaded from the search documents on first use
+
+    Like the full-text PythonBackend, changes made by this process are applied
+    in place and other processes reload after a version bump in the cache,
+    or after SEARCH_INDEX_MAX_AGE seconds when the cache is not shared.
+    """
+
+    name = 'python'
+    VERSION_KEY = 'search:fuzzy-index-version'
+
+    def __init__(self):
+        self.indexes = {}
+        self.version = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def index(self, kind):
+        with self.lock:
+            version = cache.get(self.VERSION_KEY, 0)
+            now = time.monotonic()
+            if version != self.version or now >= self.expires_at:
+                self.indexes = {}
+                self.version = version
+                self.expires_at = now + getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+            index = self.indexes.get(kind)
+            if index is None:
+                index = TrigramIndex()
+                for object_id, title in SearchDocument.objects.filter(kind=kind).values_list(
+                    'object_id', 'title'
+                ).iterator(chunk_size=2000):
+                    index.add(object_id, title)
+                self.indexes[kind] = index
+            return index
+
+    def search(self, kind, terms, limit, threshold, budget):
+        index = self.index(kind)
+        with self.lock:
+            return index.search(terms, limit, threshold, time.perf_counter() + budget)
+
+    def bump_version(self):
+        if not cache.add(self.VERSION_KEY, 1, timeout=None):
+            try:
+                cache.incr(self.VERSION_KEY)
+            except ValueError:
+                cache.set(self.VERSION_KEY, 1, timeout=None)
+        self.version = cache.get(self.VERSION_KEY, 0)
+
+    def document_changed(self, kind, object_id, title):
+        with self.lock:
+            if kind in self.indexes:
+                self.indexes[kind].add(object_id, title)
+            self.bump_version()
+
+    def document_removed(self, kind, object_id):
+        with self.lock:
+            if kind in self.indexes:
+                self.indexes[kind].remove(object_id)
+            self.bump_version()
+
+    def reset(self):
+        with self.lock:
+            self.indexes = {}
+            self.bump_version()
+
+
+class PostgresTrigramBackend:
+    name = 'postgres'
+
+    def search(self, kind, terms, limit, threshold, budget):
+        conditions = ' AND '.join(['%s <%% title'] * len(terms))
+        ranking = ' + '.join(['word_similarity(%s, title)'] * len(terms))
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT set_config('statement_timeout', %s, true), "
+                    "set_config('pg_trgm.word_similarity_threshold', %s, true)",
+                    [str(max(int(budget * 1000), 1)), str(threshold)],
+                )
+                cursor.execute(
+                    f"SELECT object_id FROM wafungi_searchdocument WHERE kind = %s AND {conditions} "
+                    f"ORDER BY {ranking} DESC, object_id LIMIT %s",
+                    [kind, *terms, *terms, limit],
+                )
+                return [row[0] for row in cursor.fetchall()]
+        except DatabaseError as e:
+            logger.warning(f"Fuzzy search for {terms} abandoned: {e}")
+            return []
+
+
+_python_backend = PythonTrigramBackend()
+_postgres_backend = PostgresTrigramBackend()
+
+
+def get_fuzzy_backend():
+    if connection.vendor == 'postgresql' and getattr(settings, 'SEARCH_BACKEND', 'auto') in ('auto', 'postgres'):
+        return _postgres_backend
+    return _python_backend
+
+
+def document_changed(kind, object_id, title):
+    if kind in FUZZY_KINDS:
+        _python_backend.document_changed(kind, object_id, title)
+
+
+def document_removed(kind, object_id):
+    if kind in FUZZY_KINDS:
+        _python_backend.document_removed(kind, object_id)
+
+
+def reset():
+    _python_backend.reset()
+
+
+def fuzzy_search_ids(kind, terms, limit=None):
+    """
+    Ids of ``kind`` objects whose titles resemble every term, best match first
+
+    Args:
+        kind (str): 'musician' or 'instrument'
+        terms (list): Tokenized query
+        limit (int, optional): Maximum ids, SEARCH_MAX_RESULTS by default
+
+    Returns:
+        list: Object ids; empty when nothing is similar enough
+    """
+    if kind not in FUZZY_KINDS or not terms:
+        return []
+    return get_fuzzy_backend().search(
+        kind,
+        terms,
+        limit or getattr(settings, 'SEARCH_MAX_RESULTS', 1000),
+        getattr(settings, 'FUZZY_SEARCH_THRESHOLD', 0.3),
+        getattr(settings, 'FUZZY_SEARCH_BUDGET_MS', 50) / 1000,
+    )
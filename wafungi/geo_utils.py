@@ -0,0 +1,218 @@
+"""
+Kenyan town gazetteer and grid-bucket proximity search
+
+Free-text locations ("Nairobi CBD", "nbi", "Westlands, Nairobi") are
+normalized to a gazetteer town with coordinates when saved. Every located
+row also stores the grid cell (GRID_SIZE degrees, about 11 km) its
+coordinates fall in, so a radius query becomes an indexed ``geo_cell IN
+(...)`` over the cells covering the circle. Distances are computed by the
+database for all candidates at once (equirectangular approximation, plenty
+at city scale) and used both to drop rows outside the radius and to sort.
+"""
+import math
+import re
+
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Sqrt
+
+from .search_utils import tokenize
+
+KM_PER_DEGREE = 111.32
+GRID_SIZE = 0.1
+
+# Grid cells above which a radius query filters on the coordinates instead
+MAX_CELLS = 400
+
+# Radii tried in turn by nearest(), in km
+NEAREST_RADII = (10, 25, 50, 100, 250, 500, 1500)
+
+# Town: (latitude, longitude)
+TOWNS = {
+    'Nairobi': (-1.2921, 36.8219),
+    'Mombasa': (-4.0435, 39.6682),
+    'Kisumu': (-0.0917, 34.7680),
+    'Nakuru': (-0.3031, 36.0800),
+    'Eldoret': (0.5143, 35.2698),
+    'Thika': (-1.0333, 37.0693),
+    'Ruiru': (-1.1466, 36.9609),
+    'Kiambu': (-1.1714, 36.8356),
+    'Kikuyu': (-1.2463, 36.6629),
+    'Limuru': (-1.1136, 36.6425),
+    'Ngong': (-1.3527, 36.6699),
+    'Athi River': (-1.4563, 36.9784),
+    'Kitengela': (-1.4760, 36.9610),
+    'Kajiado': (-1.8524, 36.7768),
+    'Machakos': (-1.5177, 37.2634),
+    'Kitui': (-1.3667, 38.0167),
+    'Mwingi': (-0.9349, 38.0606),
+    'Wote': (-1.7833, 37.6333),
+    'Emali': (-2.0833, 37.4667),
+    'Naivasha': (-0.7167, 36.4333),
+    'Gilgil': (-0.4929, 36.3185),
+    'Molo': (-0.2489, 35.7322),
+    'Narok': (-1.0833, 35.8667),
+    'Nyahururu': (0.0333, 36.3667),
+    'Nyeri': (-0.4201, 36.9476),
+    'Karatina': (-0.4833, 37.1333),
+    "Murang'a": (-0.7210, 37.1526),
+    'Kerugoya': (-0.4989, 37.2803),
+    'Embu': (-0.5310, 37.4506),
+    'Meru': (0.0463, 37.6559),
+    'Nanyuki': (0.0167, 37.0667),
+    'Isiolo': (0.3546, 37.5822),
+    'Marsabit': (2.3284, 37.9899),
+    'Maralal': (1.0968, 36.6980),
+    'Kericho': (-0.3689, 35.2863),
+    'Bomet': (-0.7813, 35.3416),
+    'Kisii': (-0.6817, 34.7667),
+    'Nyamira': (-0.5633, 34.9358),
+    'Homa Bay': (-0.5273, 34.4571),
+    'Migori': (-1.0634, 34.4731),
+    'Siaya': (0.0607, 34.2881),
+    'Busia': (0.4608, 34.1115),
+    'Kakamega': (0.2827, 34.7519),
+    'Mumias': (0.3350, 34.4881),
+    'Vihiga': (0.0765, 34.7229),
+    'Bungoma': (0.5635, 34.5606),
+    'Webuye': (0.6167, 34.7667),
+    'Kitale': (1.0157, 35.0062),
+    'Kapsabet': (0.2039, 35.1050),
+    'Iten': (0.6703, 35.5081),
+    'Kabarnet': (0.4919, 35.7430),
+    'Lodwar': (3.1191, 35.5973),
+    'Garissa': (-0.4532, 39.6461),
+    'Wajir': (1.7471, 40.0573),
+    'Mandera': (3.9366, 41.8670),
+    'Hola': (-1.4989, 40.0303),
+    'Voi': (-3.3961, 38.5561),
+    'Kwale': (-4.1737, 39.4521),
+    'Ukunda': (-4.2875, 39.5661),
+    'Diani': (-4.3167, 39.5667),
+    'Mtwapa': (-3.9490, 39.7440),
+    'Kilifi': (-3.6305, 39.8499),
+    'Watamu': (-3.3540, 40.0240),
+    'Malindi': (-3.2175, 40.1191),
+    'Lamu': (-2.2717, 40.9020),
+}
+
+# Other spellings, abbreviations and neighbourhoods
+ALIASES = {
+    'nbi': 'Nairobi', 'nrb': 'Nairobi', 'nairobi cbd': 'Nairobi', 'cbd': 'Nairobi',
+    'westlands': 'Nairobi', 'kilimani': 'Nairobi', 'karen': 'Nairobi', 'lavington': 'Nairobi',
+    'parklands': 'Nairobi', 'eastleigh': 'Nairobi', 'kasarani': 'Nairobi', 'embakasi': 'Nairobi',
+    'langata': 'Nairobi', 'upper hill': 'Nairobi', 'south b': 'Nairobi', 'south c': 'Nairobi',
+    'rongai': 'Nairobi', 'ongata rongai': 'Nairobi', 'roysambu': 'Nairobi', 'kileleshwa': 'Nairobi',
+    'msa': 'Mombasa', 'nyali': 'Mombasa', 'bamburi': 'Mombasa', 'likoni': 'Mombasa',
+    'ksm': 'Kisumu', 'mavoko': 'Athi River', 'muranga': "Murang'a", 'makueni': 'Wote',
+}
+
+_LOOKUP = {**{' '.join(tokenize(town)): town for town in TOWNS}, **ALIASES}
+_LONGEST_NAME = max(len(name.split()) for name in _LOOKUP)
+_COORDINATES_RE = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+
+
+def normalize_location(text):
+    """
+    Gazetteer town mentioned in a free-text location
+
+    The longest matching name wins, so "South B, Nairobi" and "Nairobi CBD"
+    both give Nairobi.
+
+    Returns:
+        str: Town name, or None if no known town is mentioned
+    """
+    words = tokenize(text)
+    for size in range(min(_LONGEST_NAME, len(words)), 0, -1):
+        for start in range(len(words) - size + 1):
+            town = _LOOKUP.get(' '.join(words[start:start + size]))
+            if town:
+                return town
+    return None
+
+
+def grid_cell(latitude, longitude):
+    return f"{math.floor(latitude / GRID_SIZE)}:{math.floor(longitude / GRID_SIZE)}"
+
+
+def geocode(text):
+    """
+    Town and coordinates for a location
+
+    Returns:
+        tuple: (town, latitude, longitude, cell); ('', None, None, '') for unknown places
+    """
+    town = normalize_location(text)
+    if town is None:
+        return '', None, None, ''
+    latitude, longitude = TOWNS[town]
+    return town, latitude, longitude, grid_cell(latitude, longitude)
+
+
+def parse_origin(value):
+    """(latitude, longitude) from "lat,lng" or a town name, None if neither"""
+    if not value:
+        return None
+    match = _COORDINATES_RE.match(value)
+    if match:
+        latitude, longitude = float(match.group(1)), float(match.group(2))
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            return latitude, longitude
+        return None
+    town = normalize_location(value)
+    return TOWNS[town] if town else None
+
+
+def cells_within(origin, radius_km):
+    """Grid cells covering the circle, or None when there are too many to list"""
+    latitude, longitude = origin
+    lat_span = radius_km / KM_PER_DEGREE
+    lng_span = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    rows = range(math.floor((latitude - lat_span) / GRID_SIZE), math.floor((latitude + lat_span) / GRID_SIZE) + 1)
+    columns = range(math.floor((longitude - lng_span) / GRID_SIZE), math.floor((longitude + lng_span) / GRID_SIZE) + 1)
+    if len(rows) * len(columns) > MAX_CELLS:
+        return None
+    return [f"{row}:{column}" for row in rows for column in columns]
+
+
+def distance_expression(origin, prefix=''):
+    """Database expression for the distance in km from ``origin`` to a located row"""
+    latitude, longitude = origin
+    lng_scale = math.cos(math.radians(latitude))
+    dy = F(f'{prefix}latitude') - Value(latitude)
+    dx = (F(f'{prefix}longitude') - Value(longitude)) * Value(lng_scale)
+    return Sqrt(dx * dx + dy * dy, output_field=FloatField()) * Value(KM_PER_DEGREE)
+
+
+def within_radius(queryset, origin, radius_km, prefix=''):
+    """
+    Rows located within ``radius_km`` of ``origin``, annotated with ``distance_km``
+
+    Args:
+        queryset: Queryset of a located model
+        origin (tuple): (latitude, longitude)
+        radius_km (float): Search radius
+        prefix (str): Lookup path to the located model, e.g. 'user__'
+    """
+    cells = cells_within(origin, radius_km)
+    if cells is not None:
+        queryset = queryset.filter(**{f'{prefix}geo_cell__in': cells})
+    else:
+        queryset = queryset.filter(**{f'{prefix}latitude__isnull': False})
+    return queryset.annotate(distance_km=distance_expression(origin, prefix)).filter(distance_km__lte=radius_km)
+
+
+def nearest(queryset, origin, k, prefix=''):
+    """
+    Ids of the ``k`` rows closest to ``origin``, nearest first
+
+    Widens the radius step by step, so dense areas are answered from a
+    handful of grid cells.
+    """
+    ids = []
+    for radius in NEAREST_RADII:
+        ids = list(
+            within_radius(queryset, origin, radius, prefix).order_by('distance_km', 'pk').values_list('pk', flat=True)[:k]
+        )
+        if len(ids) >= k:
+            break
+    return ids
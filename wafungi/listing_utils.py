@@ -0,0 +1,292 @@
+"""
+Filtered querysets behind the listing pages, shared with the JSON APIs
+
+Each builder reads the page's query parameters and returns a Listing: the
+queryset, the keyset ordering to paginate it by, the filters as the
+templates expect them, the ranked search matches (None without a query),
+the objects within reach of a ``near``/``radius`` search (None without one)
+and the objects booked on the ``free_on`` date (None without one).
+A proximity search replaces the location filter and sorts by distance.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .availability_utils import busy_ids_on, free_on
+from .geo_utils import distance_expression, nearest, normalize_location, parse_origin, within_radius
+from .models import Booking, Event, EventApplication, InstrumentListing, MusicianProfile
+from .pagination_utils import (
+    APPLICATION_ORDERING, EVENT_ORDERING, MUSICIAN_ORDERING, RECENT_ORDERING, SEARCH_ORDERING,
+)
+from .search_utils import filter_ranked, matching_ids
+
+DISTANCE_ORDERING = ('distance_km', 'id')
+
+# Relations booking lists and pages display, joined up front
+BOOKING_RELATED = (
+    'client', 'musician', 'event', 'instrument_listing__owner', 'instrument_listing__instrument',
+)
+
+
+class Listing(namedtuple(
+    'Listing', ['queryset', 'ordering', 'filters', 'search_ids', 'geo_ids', 'busy_ids'], defaults=[None, None]
+)):
+    __slots__ = ()
+
+    @property
+    def candidate_ids(self):
+        """Ids the results are limited to by search and proximity, None if unrestricted"""
+        if self.geo_ids is None:
+            return self.search_ids
+        if self.search_ids is None:
+            return self.geo_ids
+        search_ids = set(self.search_ids)
+        return [object_id for object_id in self.geo_ids if object_id in search_ids]
+
+    @property
+    def location(self):
+        """Location text filter, unless a proximity search superseded it"""
+        return self.filters.get('location') if self.geo_ids is None else None
+
+
+def _ranked(queryset, kind, query, ordering):
+    search_ids = matching_ids(kind, query) if query else None
+    if search_ids is None:
+        return queryset, ordering, None
+    return filter_ranked(queryset, search_ids), SEARCH_ORDERING, search_ids
+
+
+def parse_radius(value):
+    """Positive radius in km from a query parameter, None when missing or invalid"""
+    try:
+        radius = float(value)
+    except (TypeError, ValueError):
+        return None
+    return min(radius, 2000.0) if radius > 0 else None
+
+
+def _location(queryset, text, prefix=''):
+    """Locations in the text's gazetteer town, or containing the text when it names none"""
+    town = normalize_location(text)
+    if town:
+        return queryset.filter(**{f'{prefix}town': town})
+    return queryset.filter(**{f'{prefix}location__icontains': text})
+
+
+def _origin(params):
+    """Origin of a proximity search: ``near``, or the location text when only a radius is given"""
+    if params.get('near'):
+        return parse_origin(params.get('near'))
+    if parse_radius(params.get('radius')):
+        return parse_origin(params.get('location'))
+    return None
+
+
+def _nearby(queryset, base, origin, params, prefix=''):
+    """
+    Objects within ``radius`` km of ``origin``, or the GEO_NEAREST_K nearest without a radius
+
+    Args:
+        queryset: Filtered queryset
+        base: The same before the facet filters, for the ids in reach
+        origin (tuple): (latitude, longitude)
+        params: Query parameters
+        prefix (str): Lookup path to the located model
+
+    Returns:
+        tuple: (queryset annotated with distance_km, ids in reach)
+
+    Like a text search, a radius search keeps only the SEARCH_MAX_RESULTS
+    nearest; the radius shrinks to the farthest of them when it holds more.
+    """
+    radius = parse_radius(params.get('radius'))
+    if radius:
+        limit = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+        in_reach = list(
+            within_radius(base, origin, radius, prefix).order_by('distance_km', 'pk')
+            .values_list('pk', 'distance_km')[:limit]
+        )
+        if len(in_reach) == limit:
+            radius = in_reach[-1][1]
+        geo_ids = [object_id for object_id, _ in in_reach]
+        return within_radius(queryset, origin, radius, prefix), geo_ids
+    geo_ids = nearest(queryset, origin, getattr(settings, 'GEO_NEAREST_K', 50), prefix)
+    queryset = queryset.filter(pk__in=geo_ids).annotate(distance_km=distance_expression(origin, prefix))
+    return queryset, geo_ids
+
+
+def parse_day(value):
+    """Date from a YYYY-MM-DD query parameter, None when missing or invalid"""
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        return None
+
+
+def _free_on(queryset, kind, day):
+    """Drop what is booked on ``day``; returns (queryset, busy ids for the facet counts)"""
+    if day is None:
+        return queryset, None
+    return free_on(queryset, kind, day), busy_ids_on(kind, day)
+
+
+def parse_price(value):
+    """Decimal from a price query parameter, None when missing or invalid"""
+    if not value:
+        return None
+    try:
+        return Decimal(value)
+    except (ValueError, TypeError, ArithmeticError):
+        return None
+
+
+def musician_listing(params):
+    """Active, available musicians filtered by genre, instrument, location and search query"""
+    musicians = MusicianProfile.objects.filter(
+        user__is_active=True,
+        availability_status=True
+    ).select_related('user').prefetch_related('genres', 'instruments')
+    base = musicians
+    origin = _origin(params)
+
+    genre_filter = params.get('genre')
+    if genre_filter:
+        musicians = musicians.filter(genres__id=genre_filter)
+
+    instrument_filter = params.get('instrument')
+    if instrument_filter:
+        musicians = musicians.filter(instruments__id=instrument_filter)
+
+    location_filter = params.get('location')
+    if location_filter and origin is None:
+        musicians = _location(musicians, location_filter, 'user__')
+
+    free_on_filter = params.get('free_on')
+    musicians, busy_ids = _free_on(musicians, 'musician', parse_day(free_on_filter))
+
+    search_query = params.get('q')
+    musicians, ordering, search_ids = _ranked(musicians, 'musician', search_query, MUSICIAN_ORDERING)
+
+    geo_ids = None
+    if origin is not None:
+        musicians, geo_ids = _nearby(musicians, base, origin, params, 'user__')
+        ordering = DISTANCE_ORDERING
+
+    filters = {
+        'genre': genre_filter,
+        'instrument': instrument_filter,
+        'location': location_filter,
+        'near': params.get('near'),
+        'radius': params.get('radius'),
+        'free_on': free_on_filter,
+        'q': search_query,
+    }
+    return Listing(musicians, ordering, filters, search_ids, geo_ids, busy_ids)
+
+
+def instrument_listing(params):
+    """Available instruments filtered by type, condition, location, price and search query"""
+    instruments = InstrumentListing.objects.filter(
+        is_available=True
+    ).select_related('owner', 'instrument')
+    base = instruments
+    origin = _origin(params)
+
+    instrument_filter = params.get('instrument')
+    if instrument_filter:
+        instruments = instruments.filter(instrument__id=instrument_filter)
+
+    condition_filter = params.get('condition')
+    if condition_filter:
+        instruments = instruments.filter(condition=condition_filter)
+
+    location_filter = params.get('location')
+    if location_filter and origin is None:
+        instruments = _location(instruments, location_filter)
+
+    max_price = params.get('max_price')
+    price_limit = parse_price(max_price)
+    if price_limit is not None:
+        instruments = instruments.filter(daily_rate__lte=price_limit)
+
+    free_on_filter = params.get('free_on')
+    instruments, busy_ids = _free_on(instruments, 'instrument', parse_day(free_on_filter))
+
+    search_query = params.get('q')
+    instruments, ordering, search_ids = _ranked(instruments, 'instrument', search_query, RECENT_ORDERING)
+
+    geo_ids = None
+    if origin is not None:
+        instruments, geo_ids = _nearby(instruments, base, origin, params)
+        ordering = DISTANCE_ORDERING
+
+    filters = {
+        'instrument': instrument_filter,
+        'condition': condition_filter,
+        'location': location_filter,
+        'near': params.get('near'),
+        'radius': params.get('radius'),
+        'max_price': max_price,
+        'free_on': free_on_filter,
+        'q': search_query,
+    }
+    return Listing(instruments, ordering, filters, search_ids, geo_ids, busy_ids)
+
+
+def event_listing(params):
+    """Upcoming active events filtered by type, location and search query"""
+    events = Event.objects.filter(
+        is_active=True,
+        date__gte=timezone.now()
+    )
+    base = events
+    origin = _origin(params)
+
+    event_type_filter = params.get('event_type')
+    if event_type_filter:
+        events = events.filter(event_type=event_type_filter)
+
+    location_filter = params.get('location')
+    if location_filter and origin is None:
+        events = _location(events, location_filter)
+
+    search_query = params.get('q')
+    events, ordering, search_ids = _ranked(events, 'event', search_query, EVENT_ORDERING)
+
+    geo_ids = None
+    if origin is not None:
+        events, geo_ids = _nearby(events, base, origin, params)
+        ordering = DISTANCE_ORDERING
+
+    filters = {
+        'event_type': event_type_filter,
+        'location': location_filter,
+        'near': params.get('near'),
+        'radius': params.get('radius'),
+        'q': search_query,
+    }
+    return Listing(events, ordering, filters, search_ids, geo_ids)
+
+
+def booking_listing(user):
+    """Bookings the user made, plays at, or rents an instrument out for"""
+    if user.user_type == 'client':
+        bookings = Booking.objects.filter(client=user)
+    elif user.user_type == 'musician':
+        bookings = Booking.objects.filter(musician=user)
+    elif user.user_type == 'instrument_owner':
+        bookings = Booking.objects.filter(instrument_listing__owner=user)
+    else:
+        bookings = Booking.objects.none()
+    return Listing(bookings.select_related(*BOOKING_RELATED), RECENT_ORDERING, {}, None)
+
+
+def application_listing(user):
+    """A musician's event applications"""
+    applications = EventApplication.objects.filter(
+        musician=user
+    ).select_related('event', 'event__organizer')
+    return Listing(applications, APPLICATION_ORDERING, {}, None)
@@ -0,0 +1,97 @@
+import random
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand
+
+from wafungi.fuzzy_utils import TrigramIndex
+from wafungi.management.commands.load_test_payments import percentile
+from wafungi.search_utils import tokenize
+
+SYLLABLES = ['ka', 'ma', 'ni', 'wa', 'ji', 'ru', 'o', 'ti', 'e', 'no', 'mu', 'tu', 'a', 'ki', 'be', 'la', 'shi', 'sa']
+BRANDS = ['Yamaha', 'Fender', 'Gibson', 'Roland', 'Casio', 'Korg', 'Ibanez', 'Pearl', 'Selmer', 'Martin']
+INSTRUMENTS = ['Guitar', 'Saxophone', 'Keyboard', 'Drums', 'Violin', 'Trumpet', 'Bass', 'Flute', 'Piano']
+
+
+def misspell(word, rng):
+    """One random substitution, deletion or transposition"""
+    if len(word) < 4:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    edit = rng.choice(('substitute', 'delete', 'transpose'))
+    if edit == 'substitute':
+        return word[:i] + rng.choice('aeiou') + word[i + 1:]
+    if edit == 'delete':
+        return word[:i] + word[i + 1:]
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the in-process trigram index with the old icontains (LIKE) filters on a '
+        'synthetic dataset: latency percentiles and how often a misspelled query finds its target'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='Synthetic rows (default: 100000)')
+        parser.add_argument('--queries', type=int, default=200, help='Queries per path (default: 200)')
+        parser.add_argument('--threshold', type=float, default=0.3, help='Trigram similarity threshold (default: 0.3)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        def name():
+            return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+        rows = []
+        for row_id in range(1, options['rows'] + 1):
+            if row_id % 2:
+                rows.append((row_id, f"{name()} {rng.choice(INSTRUMENTS)}", name(), name()))
+            else:
+                rows.append((row_id, rng.choice(BRANDS), f"{rng.choice('ABCDEFXYZ')}{rng.randint(10, 999)}",
+                             rng.choice(INSTRUMENTS)))
+
+        self.stdout.write(self.style.SUCCESS(f"🧪 {len(rows)} synthetic rows, {options['queries']} misspelled queries"))
+
+        # Old path: OR of icontains filters, i.e. LIKE '%query%' on every column
+        db = sqlite3.connect(':memory:')
+        db.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, a TEXT, b TEXT, c TEXT)')
+        db.executemany('INSERT INTO item VALUES (?, ?, ?, ?)', rows)
+
+        started = time.perf_counter()
+        index = TrigramIndex()
+        for row_id, *fields in rows:
+            index.add(row_id, ' '.join(fields))
+        self.stdout.write(f"  Trigram index built in {time.perf_counter() - started:.1f}s "
+                          f"({len(index.word_trigrams)} distinct words)")
+
+        queries = []
+        for _ in range(options['queries']):
+            row_id, *fields = rng.choice(rows)
+            words = tokenize(' '.join(fields))
+            query = ' '.join(misspell(word, rng) for word in rng.sample(words, min(2, len(words))))
+            queries.append((row_id, query))
+
+        def like(query):
+            pattern = f'%{query}%'
+            return [row[0] for row in db.execute(
+                'SELECT id FROM item WHERE a LIKE ? OR b LIKE ? OR c LIKE ? LIMIT 1000', [pattern] * 3
+            )]
+
+        def fuzzy(query):
+            return index.search(tokenize(query), 1000, options['threshold'], time.perf_counter() + 60)
+
+        for label, run in (('LIKE', like), ('trigram', fuzzy)):
+            latencies, found, empty = [], 0, 0
+            for row_id, query in queries:
+                started = time.perf_counter()
+                ids = run(query)
+                latencies.append(time.perf_counter() - started)
+                found += row_id in ids
+                empty += not ids
+            self.stdout.write(
+                f"  {label:<8} p50 {percentile(latencies, 50) * 1000:7.2f}ms  "
+                f"p95 {percentile(latencies, 95) * 1000:7.2f}ms  p99 {percentile(latencies, 99) * 1000:7.2f}ms  "
+                f"target found: {found / len(queries):.0%}  no results: {empty / len(queries):.0%}"
+            )
@@ -0,0 +1,397 @@
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from wafungi.availability_utils import BLOCKING_STATUSES, booking_days, invalidate_availability
+from wafungi.facet_utils import invalidate_facets
+from wafungi.geo_utils import TOWNS, geocode
+from wafungi.models import (
+    Booking, BusyDay, Event, EventApplication, Genre, Instrument, InstrumentListing, MusicianProfile,
+    Notification, PaymentTransaction, Review, User,
+)
+from wafungi.search_utils import rebuild_index
+from wafungi.typeahead_utils import typeahead
+
+GENRES = [
+    'Afro-pop', 'Benga', 'Bongo Flava', 'Gengetone', 'Gospel', 'Hip Hop', 'Jazz', 'Ohangla', 'Reggae',
+    'Rhumba', 'Taarab', 'Classical', 'Rock', 'Soul', 'Zilizopendwa',
+]
+INSTRUMENTS = [
+    ('Acoustic Guitar', 'Strings'), ('Electric Guitar', 'Strings'), ('Bass Guitar', 'Strings'),
+    ('Nyatiti', 'Strings'), ('Violin', 'Strings'), ('Keyboard', 'Keys'), ('Piano', 'Keys'),
+    ('Drum Kit', 'Percussion'), ('Djembe', 'Percussion'), ('Saxophone', 'Wind'), ('Trumpet', 'Wind'),
+    ('Flute', 'Wind'), ('Orutu', 'Strings'), ('Microphone', 'Audio'), ('PA System', 'Audio'),
+]
+FIRST_NAMES = [
+    'Achieng', 'Akinyi', 'Amani', 'Amina', 'Baraka', 'Chebet', 'Faith', 'Halima', 'Jabari', 'Kamau',
+    'Kiprono', 'Makena', 'Mwangi', 'Njeri', 'Nyokabi', 'Odhiambo', 'Otieno', 'Wairimu', 'Wanjiru', 'Zawadi',
+]
+LAST_NAMES = [
+    'Kariuki', 'Kipchoge', 'Mutua', 'Njoroge', 'Ochieng', 'Omondi', 'Owino', 'Wafula', 'Wambua', 'Wekesa',
+    'Cheruiyot', 'Kimani', 'Maina', 'Mwende', 'Nyambura', 'Onyango', 'Rotich', 'Said', 'Too', 'Waweru',
+]
+BRANDS = ['Yamaha', 'Fender', 'Gibson', 'Roland', 'Casio', 'Korg', 'Ibanez', 'Pearl', 'Selmer', 'Shure']
+EVENT_WORDS = ['Gala', 'Wedding', 'Launch', 'Festival', 'Night', 'Concert', 'Party', 'Retreat', 'Dinner']
+
+# Days covered by generated bookings, around today
+HISTORY_DAYS = 365
+FUTURE_DAYS = 180
+
+# Fraction of bookings that hire a musician rather than rent an instrument
+MUSICIAN_SHARE = 0.65
+
+# Users of each kind and other rows at --scale 1
+DEFAULT_COUNTS = {
+    'musicians': 1000,
+    'clients': 1000,
+    'organizers': 200,
+    'owners': 200,
+    'listings': 1500,
+    'events': 1000,
+    'applications': 4000,
+    'bookings': 10000,
+}
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Load a deterministic synthetic dataset (users, musician profiles, listings, events, '
+        'applications, bookings, payments, reviews, notifications) with bulk inserts, for load and '
+        'performance testing. --scale 100 gives 100k musicians and 1M bookings.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1,
+                            help='Multiplier applied to every count below (default: 1)')
+        for name, default in DEFAULT_COUNTS.items():
+            parser.add_argument(f'--{name}', type=int, default=default, help=f'{name.capitalize()} (default: {default})')
+        parser.add_argument('--review-rate', type=float, default=0.3,
+                            help='Fraction of completed musician bookings reviewed (default: 0.3)')
+        parser.add_argument('--notifications', type=float, default=3,
+                            help='Average notifications per user (default: 3)')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per INSERT (default: 5000)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+        parser.add_argument('--prefix', default='fake',
+                            help='Username and payment id prefix, so several datasets can coexist (default: fake)')
+        parser.add_argument('--skip-index', action='store_true',
+                            help='Do not rebuild the search index afterwards')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = options['prefix']
+        self.now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        counts = {name: max(1, round(options[name] * options['scale'])) for name in DEFAULT_COUNTS}
+
+        if User.objects.filter(username__startswith=f'{self.prefix}_').exists():
+            raise CommandError(f"Users prefixed '{self.prefix}_' already exist; use another --prefix or a fresh database")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"🧪 Generating fake data (seed {options['seed']}): "
+            + ', '.join(f'{count} {name}' for name, count in counts.items())
+        ))
+        started = time.monotonic()
+        self.places = {town: geocode(town) for town in TOWNS}
+        self.password = make_password('password')  # hashed once, shared by every fake user
+
+        with transaction.atomic():
+            genre_ids, instrument_ids = self.vocabulary()
+            users = {
+                kind: self.step(f'{kind} users', lambda kind=kind: self.users(kind, counts[f'{kind}s']))
+                for kind in ('musician', 'client', 'organizer', 'owner')
+            }
+            rates = self.step('musician profiles', lambda: self.profiles(users['musician'], genre_ids, instrument_ids))
+            listings = self.step('instrument listings', lambda: self.listings(
+                counts['listings'], users['owner'], instrument_ids
+            ))
+            events = self.step('events', lambda: self.events(counts['events'], users['organizer'], genre_ids, instrument_ids))
+            self.step('event applications', lambda: self.applications(counts['applications'], events, users['musician']))
+            clients = users['client'] + users['organizer']
+            _, paid, reviewable, busy = self.step('bookings', lambda: self.bookings(
+                counts['bookings'], clients, users['musician'], rates, listings
+            ))
+            self.step('payment transactions', lambda: self.payments(paid))
+            self.step('reviews', lambda: self.reviews(reviewable, options['review_rate']))
+            self.step('busy days', lambda: self.busy_days(busy))
+            all_users = [user_id for ids in users.values() for user_id in ids]
+            self.step('notifications', lambda: self.notifications(all_users, options['notifications']))
+
+            invalidate_facets()
+            invalidate_availability()
+        typeahead.reset()
+
+        if not options['skip_index']:
+            self.step('search documents', lambda: sum(rebuild_index(batch_size=self.batch_size).values()))
+        self.stdout.write(f"  ⏱️ {time.monotonic() - started:.1f}s. Every fake user's password is 'password'.")
+
+    def step(self, label, build):
+        started = time.monotonic()
+        result = build()
+        rows = result[0] if isinstance(result, tuple) else result
+        count = rows if isinstance(rows, int) else len(rows)
+        self.stdout.write(f'  ✅ {count} {label} in {time.monotonic() - started:.1f}s')
+        return result
+
+    def insert(self, model, rows):
+        """bulk_create ``rows`` (any iterable) in batches; the created objects, with their pks"""
+        created = []
+        for batch in batched(rows, self.batch_size):
+            created.extend(model.objects.bulk_create(batch))
+        return created
+
+    def insert_count(self, model, rows, **kwargs):
+        """bulk_create ``rows`` in batches without keeping them; the number inserted"""
+        count = 0
+        for batch in batched(rows, self.batch_size):
+            model.objects.bulk_create(batch, **kwargs)
+            count += len(batch)
+        return count
+
+    def vocabulary(self):
+        for name in GENRES:
+            Genre.objects.get_or_create(name=name)
+        for name, category in INSTRUMENTS:
+            Instrument.objects.get_or_create(name=name, defaults={'category': category})
+        return list(Genre.objects.values_list('pk', flat=True)), list(Instrument.objects.values_list('pk', flat=True))
+
+    def located(self, town):
+        name, latitude, longitude, geo_cell = self.places[town]
+        return {'location': town, 'town': name, 'latitude': latitude, 'longitude': longitude, 'geo_cell': geo_cell}
+
+    def users(self, kind, count):
+        rng = self.rng
+        user_type = 'instrument_owner' if kind == 'owner' else kind
+        towns = list(TOWNS)
+
+        def rows():
+            for n in range(count):
+                first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                username = f'{self.prefix}_{kind}_{n}'
+                yield User(
+                    username=username, first_name=first, last_name=last, email=f'{username}@example.com',
+                    password=self.password, user_type=user_type, phone=f'2547{rng.randrange(10 ** 8):08d}',
+                    bio=f'{first} from {rng.choice(towns)}' if kind == 'musician' else '',
+                    is_verified=rng.random() < 0.6, **self.located(rng.choice(towns)),
+                )
+
+        return [user.pk for user in self.insert(User, rows())]
+
+    def profiles(self, musician_ids, genre_ids, instrument_ids):
+        """Musician profiles with their genres and instruments; hourly rate per musician user id"""
+        rng = self.rng
+        rates = {}
+        profiles = []
+        for user_id in musician_ids:
+            rates[user_id] = Decimal(rng.randrange(500, 10000, 250))
+            profiles.append(MusicianProfile(
+                user_id=user_id, stage_name=f'{rng.choice(FIRST_NAMES)} {rng.choice(GENRES)}' if rng.random() < 0.7 else '',
+                experience_years=rng.randint(0, 30), hourly_rate=rates[user_id],
+                availability_status=rng.random() < 0.85, rating=Decimal(rng.randint(25, 50)) / 10,
+                total_gigs=rng.randint(0, 300),
+            ))
+        profile_ids = [profile.pk for profile in self.insert(MusicianProfile, profiles)]
+
+        genres = MusicianProfile.genres.through
+        instruments = MusicianProfile.instruments.through
+        self.insert_count(genres, (
+            genres(musicianprofile_id=profile_id, genre_id=genre_id)
+            for profile_id in profile_ids for genre_id in rng.sample(genre_ids, rng.randint(1, 3))
+        ))
+        self.insert_count(instruments, (
+            instruments(musicianprofile_id=profile_id, instrument_id=instrument_id)
+            for profile_id in profile_ids for instrument_id in rng.sample(instrument_ids, rng.randint(1, 2))
+        ))
+        return rates
+
+    def listings(self, count, owner_ids, instrument_ids):
+        rng = self.rng
+        towns = list(TOWNS)
+        conditions = [choice for choice, _ in InstrumentListing.CONDITION_CHOICES]
+        rows = (
+            InstrumentListing(
+                owner_id=rng.choice(owner_ids), instrument_id=rng.choice(instrument_ids), brand=rng.choice(BRANDS),
+                model=f'{rng.choice("ABCDEFXYZ")}{rng.randint(10, 999)}', condition=rng.choice(conditions),
+                daily_rate=Decimal(rng.randrange(300, 8000, 100)), description='Well kept, available for hire',
+                is_available=rng.random() < 0.9, **self.located(rng.choice(towns)),
+            )
+            for _ in range(count)
+        )
+        return [(listing.pk, listing.daily_rate) for listing in self.insert(InstrumentListing, rows)]
+
+    def events(self, count, organizer_ids, genre_ids, instrument_ids):
+        rng = self.rng
+        towns = list(TOWNS)
+        event_types = [choice for choice, _ in Event.EVENT_TYPES]
+
+        def rows():
+            for _ in range(count):
+                town = rng.choice(towns)
+                budget_min = Decimal(rng.randrange(2000, 50000, 500))
+                yield Event(
+                    organizer_id=rng.choice(organizer_ids), title=f'{town} {rng.choice(EVENT_WORDS)}',
+                    description='Live music wanted', event_type=rng.choice(event_types),
+                    date=self.now + timedelta(days=rng.randint(-60, FUTURE_DAYS), hours=rng.randint(10, 20)),
+                    duration_hours=rng.randint(2, 8), budget_min=budget_min,
+                    budget_max=budget_min + rng.randrange(1000, 50000, 500), musicians_needed=rng.randint(1, 5),
+                    is_active=rng.random() < 0.9, **self.located(town),
+                )
+
+        event_ids = [event.pk for event in self.insert(Event, rows())]
+        genres = Event.required_genres.through
+        instruments = Event.required_instruments.through
+        self.insert_count(genres, (
+            genres(event_id=event_id, genre_id=genre_id)
+            for event_id in event_ids for genre_id in rng.sample(genre_ids, rng.randint(0, 2))
+        ))
+        self.insert_count(instruments, (
+            instruments(event_id=event_id, instrument_id=instrument_id)
+            for event_id in event_ids for instrument_id in rng.sample(instrument_ids, rng.randint(0, 2))
+        ))
+        return event_ids
+
+    def applications(self, count, event_ids, musician_ids):
+        """About count applications, spread over events, each musician at most once per event"""
+        rng = self.rng
+        per_event = max(1, round(count / len(event_ids)))
+        statuses = ['pending'] * 5 + ['accepted'] * 2 + ['declined'] * 2 + ['withdrawn']
+        rows = (
+            EventApplication(
+                event_id=event_id, musician_id=musician_id, cover_letter='I would love to play at your event',
+                proposed_rate=Decimal(rng.randrange(1000, 30000, 500)), status=rng.choice(statuses),
+            )
+            for event_id in event_ids
+            for musician_id in rng.sample(musician_ids, min(len(musician_ids), rng.randint(0, 2 * per_event)))
+        )
+        return self.insert_count(EventApplication, rows)
+
+    def bookings(self, count, client_ids, musician_ids, rates, listings):
+        """
+        Musician and instrument bookings from HISTORY_DAYS ago to FUTURE_DAYS ahead
+
+        Resources are picked first, then each musician's or listing's
+        bookings are spaced evenly over the window so they never overlap.
+        Past bookings are completed or cancelled; upcoming ones pending,
+        confirmed or cancelled.
+
+        Returns:
+            tuple: (count, paid (booking id, amount, client id) list,
+                    reviewable (booking id, client id, musician id) list,
+                    busy (kind, resource id, start, end) list)
+        """
+        rng = self.rng
+        first_day = timezone.localtime(self.now).replace(hour=0) - timedelta(days=HISTORY_DAYS)
+        window = HISTORY_DAYS + FUTURE_DAYS
+        picks = [
+            ('musician', rng.choice(musician_ids)) if rng.random() < MUSICIAN_SHARE else ('instrument', rng.choice(listings))
+            for _ in range(count)
+        ]
+        # Days between a resource's bookings: gigs end the day they start, rentals last up to 3 days
+        gaps = {pick: max(1.0 if pick[0] == 'musician' else 4.0, window / total) for pick, total in Counter(picks).items()}
+        slots = Counter()
+        paid, reviewable, busy = [], [], []
+
+        def rows():
+            for pick in picks:
+                kind, resource = pick
+                gap = gaps[pick]
+                slot = slots[pick]
+                slots[pick] += 1
+                if kind == 'musician':
+                    musician_id, listing_id = resource, None
+                    day = int(slot * gap + rng.uniform(0, gap - 1))
+                    start = first_day + timedelta(days=day, hours=rng.randint(9, 14))
+                    hours = rng.randint(2, 6)
+                    end = start + timedelta(hours=hours)
+                    amount = rates[musician_id] * hours
+                else:
+                    (listing_id, daily_rate), musician_id = resource, None
+                    day = int(slot * gap + rng.uniform(0, gap - 4))
+                    start = first_day + timedelta(days=day, hours=9)
+                    days = rng.randint(1, 3)
+                    end = start + timedelta(days=days)
+                    amount = daily_rate * days
+
+                if end < self.now:
+                    status = 'completed' if rng.random() < 0.8 else 'cancelled'
+                else:
+                    status = rng.choice(('pending', 'pending', 'confirmed', 'confirmed', 'confirmed', 'cancelled'))
+                payment_status = status == 'completed' or (status == 'confirmed' and rng.random() < 0.5)
+                yield Booking(
+                    client_id=rng.choice(client_ids), musician_id=musician_id, instrument_listing_id=listing_id,
+                    start_date=start, end_date=end, total_amount=amount, status=status,
+                    payment_status=payment_status, notes='',
+                )
+
+        for batch in batched(rows(), self.batch_size):
+            for booking in Booking.objects.bulk_create(batch):
+                if booking.payment_status:
+                    paid.append((booking.pk, booking.total_amount, booking.client_id))
+                if booking.status == 'completed' and booking.musician_id:
+                    reviewable.append((booking.pk, booking.client_id, booking.musician_id))
+                if booking.status in BLOCKING_STATUSES:
+                    kind, resource_id = (('musician', booking.musician_id) if booking.musician_id
+                                         else ('instrument', booking.instrument_listing_id))
+                    busy.append((kind, resource_id, booking.start_date, booking.end_date))
+        return count, paid, reviewable, busy
+
+    def payments(self, paid):
+        """A completed M-Pesa transaction per paid booking"""
+        rng = self.rng
+        rows = (
+            PaymentTransaction(
+                booking_id=booking_id, checkout_request_id=f'ws_CO_{self.prefix}_{n}',
+                merchant_request_id=f'{self.prefix}-{n}', transaction_id=f'{self.prefix.upper()}{n:09d}',
+                phone_number=f'2547{rng.randrange(10 ** 8):08d}', amount=amount, status='completed',
+            )
+            for n, (booking_id, amount, _) in enumerate(paid)
+        )
+        return self.insert_count(PaymentTransaction, rows)
+
+    def reviews(self, reviewable, rate):
+        rng = self.rng
+        comments = ['Amazing performance!', 'Great energy, guests loved it', 'Professional and on time', 'Good set']
+        rows = (
+            Review(booking_id=booking_id, reviewer_id=client_id, reviewee_id=musician_id,
+                   rating=rng.choice((3, 4, 4, 5, 5, 5)), comment=rng.choice(comments))
+            for booking_id, client_id, musician_id in reviewable
+            if rng.random() < rate
+        )
+        return self.insert_count(Review, rows)
+
+    def busy_days(self, busy):
+        """BusyDay rows of pending and confirmed bookings, as signals would have written them"""
+        days = set()
+        for kind, resource_id, start, end in busy:
+            days.update((kind, resource_id, day) for day in booking_days(start, end))
+        rows = (
+            BusyDay(musician_id=resource_id, day=day) if kind == 'musician'
+            else BusyDay(instrument_listing_id=resource_id, day=day)
+            for kind, resource_id, day in sorted(days)
+        )
+        return self.insert_count(BusyDay, rows, ignore_conflicts=True)
+
+    def notifications(self, user_ids, average):
+        rng = self.rng
+        titles = ['New booking request', 'Booking confirmed', 'Payment received', 'New event near you']
+        rows = (
+            Notification(user_id=user_id, title=title, message=f'{title}. Open your dashboard for details.',
+                         is_read=rng.random() < 0.7)
+            for user_id in user_ids
+            for title in (rng.choice(titles) for _ in range(rng.randint(0, round(2 * average))))
+        )
+        return self.insert_count(Notification, rows)
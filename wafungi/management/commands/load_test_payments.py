@@ -0,0 +1,213 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+
+import requests
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from django.utils import timezone
+
+from wafungi.fake_daraja import FakeDarajaServer
+from wafungi.models import Booking, Notification, PaymentTransaction, User
+
+LOAD_TEST_PREFIX = 'loadtest_'
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        'Push concurrent bookings through payment_process and mpesa_callback on a running '
+        'server backed by the fake Daraja, and report latency percentiles and error rates. '
+        'Start the server with MPESA_BASE_URL pointing at --daraja-port, e.g. '
+        'MPESA_BASE_URL=http://127.0.0.1:8900 python manage.py runserver'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000',
+                            help='URL of the running app (default: http://127.0.0.1:8000)')
+        parser.add_argument('--bookings', type=int, default=1000,
+                            help='Bookings to pay for (default: 1000)')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Concurrent simulated customers (default: 50)')
+        parser.add_argument('--users', type=int, default=20,
+                            help='Client accounts to spread bookings over (default: 20)')
+        parser.add_argument('--daraja-port', type=int, default=8900,
+                            help='Port for the in-process fake Daraja (default: 8900)')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Fake Daraja response latency in seconds (default: 0.05)')
+        parser.add_argument('--failure-rate', type=float, default=0,
+                            help='Fraction of Daraja requests answered with 503 (default: 0)')
+        parser.add_argument('--cancel-rate', type=float, default=0,
+                            help='Fraction of STK pushes the customer cancels (default: 0)')
+        parser.add_argument('--callback-delay', type=float, default=1.0,
+                            help='Seconds before Daraja sends each callback (default: 1.0)')
+        parser.add_argument('--duplicate-rate', type=float, default=0.1,
+                            help='Fraction of callbacks delivered twice (default: 0.1)')
+        parser.add_argument('--settle-timeout', type=float, default=60,
+                            help='Seconds to wait for each payment to settle (default: 60)')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the load test users and bookings afterwards')
+
+    def handle(self, *args, **options):
+        base_url = options['base_url'].rstrip('/')
+        try:
+            requests.get(base_url, timeout=5)
+        except requests.RequestException as e:
+            raise CommandError(f'App not reachable at {base_url}: {e}')
+
+        daraja = FakeDarajaServer(
+            port=options['daraja_port'],
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+            cancel_rate=options['cancel_rate'],
+            send_callbacks=True,
+            callback_url=f"{base_url}{reverse('mpesa_callback')}",
+            callback_delay=options['callback_delay'],
+            duplicate_rate=options['duplicate_rate'],
+            callback_workers=max(8, options['concurrency'] // 2),
+        ).start()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"🚦 Load testing {base_url} with {options['bookings']} bookings, "
+            f"{options['concurrency']} concurrent customers (fake Daraja on {daraja.base_url})"
+        ))
+
+        try:
+            sessions, booking_ids = self.create_fixtures(options['users'], options['bookings'])
+            results = self.run(base_url, sessions, booking_ids, options)
+            self.report(results, daraja, booking_ids)
+        finally:
+            daraja.stop()
+            if not options['keep']:
+                User.objects.filter(username__startswith=LOAD_TEST_PREFIX).delete()
+
+    def create_fixtures(self, user_count, booking_count):
+        """Client accounts with logged-in sessions and confirmed, unpaid bookings"""
+        User.objects.filter(username__startswith=LOAD_TEST_PREFIX).delete()
+        musician = User.objects.create_user(f'{LOAD_TEST_PREFIX}musician', password=None, user_type='musician')
+        clients = [
+            User.objects.create_user(f'{LOAD_TEST_PREFIX}client_{i}', password=None, user_type='client')
+            for i in range(max(user_count, 1))
+        ]
+
+        start = timezone.now() + timedelta(days=30)
+        bookings = Booking.objects.bulk_create([
+            Booking(
+                client=clients[i % len(clients)], musician=musician,
+                start_date=start + timedelta(hours=i), end_date=start + timedelta(hours=i + 1),
+                total_amount=Decimal('1000.00'), status='confirmed',
+            )
+            for i in range(booking_count)
+        ], batch_size=500)
+
+        engine = import_module(settings.SESSION_ENGINE)
+        sessions = {}
+        for client in clients:
+            session = engine.SessionStore()
+            session[SESSION_KEY] = str(client.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = client.get_session_auth_hash()
+            session.create()
+            sessions[client.pk] = session.session_key
+
+        return sessions, [(booking.pk, sessions[booking.client_id]) for booking in bookings]
+
+    def run(self, base_url, sessions, booking_ids, options):
+        def pay(item):
+            booking_id, session_key = item
+            http = requests.Session()
+            http.cookies.set(settings.SESSION_COOKIE_NAME, session_key)
+            result = {'booking_id': booking_id, 'outcome': 'error'}
+            payment_url = f"{base_url}{reverse('payment_process', args=[booking_id])}"
+
+            try:
+                http.get(payment_url, timeout=30)
+                csrf_token = http.cookies.get(settings.CSRF_COOKIE_NAME, '')
+
+                started = time.monotonic()
+                response = http.post(
+                    payment_url, data={'mpesa_number': '712345678', 'csrfmiddlewaretoken': csrf_token},
+                    headers={'Referer': payment_url}, allow_redirects=False, timeout=60,
+                )
+                result['submit'] = time.monotonic() - started
+
+                match = re.search(r'/payment/status/([^/]+)/$', response.headers.get('Location', ''))
+                if response.status_code != 302 or not match:
+                    result['outcome'] = 'rejected'
+                    return result
+
+                events_url = f"{base_url}{reverse('payment_status_events', args=[booking_id, match.group(1)])}"
+                deadline = started + options['settle_timeout']
+                status = 'pending'
+                while status == 'pending' and time.monotonic() < deadline:
+                    status = http.get(events_url, params={'status': 'pending'}, timeout=60).json()['status']
+
+                result['settle'] = time.monotonic() - started
+                result['outcome'] = status if status != 'pending' else 'timeout'
+            except (requests.RequestException, ValueError, KeyError) as e:
+                result['error'] = str(e)
+            return result
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(options['concurrency'], 1)) as executor:
+            results = list(executor.map(pay, booking_ids))
+        self.elapsed = time.monotonic() - started
+        return results
+
+    def report(self, results, daraja, booking_ids):
+        total = len(results)
+        outcomes = {}
+        for result in results:
+            outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"\n📊 {total} payments in {self.elapsed:.1f}s ({total / self.elapsed if self.elapsed else 0:.1f}/s)"
+        ))
+        self.stdout.write('  Outcomes: ' + ', '.join(f'{name} {count} ({count / total:.1%})'
+                                                     for name, count in sorted(outcomes.items())))
+
+        series = {
+            'payment_process': [r['submit'] for r in results if 'submit' in r],
+            'submit → settled': [r['settle'] for r in results if r['outcome'] in ('completed', 'failed', 'cancelled')],
+            'mpesa_callback ack': list(daraja.state.callback_latencies),
+        }
+        for name, values in series.items():
+            self.stdout.write(
+                f"  {name:<20} p50 {percentile(values, 50) * 1000:7.1f}ms  "
+                f"p95 {percentile(values, 95) * 1000:7.1f}ms  p99 {percentile(values, 99) * 1000:7.1f}ms  "
+                f"(n={len(values)})"
+            )
+
+        counts = daraja.state.counts
+        callback_error_rate = counts['callback_errors'] / counts['callbacks'] if counts['callbacks'] else 0
+        self.stdout.write(
+            f"  Daraja: {counts['stk_push']} STK pushes, {counts['query']} queries, "
+            f"{counts['injected_failures']} injected failures, {counts['callbacks']} callbacks "
+            f"({counts['duplicate_callbacks']} duplicates, {callback_error_rate:.1%} errors)"
+        )
+
+        # Duplicate callbacks must not settle a payment twice
+        booking_pks = [booking_id for booking_id, _ in booking_ids]
+        completed = PaymentTransaction.objects.filter(booking_id__in=booking_pks, status='completed').count()
+        receipts = Notification.objects.filter(
+            user__username__startswith=LOAD_TEST_PREFIX, title='Payment Successful'
+        ).count()
+        if receipts == completed:
+            self.stdout.write(f'  ✅ {completed} completed payments, each settled exactly once')
+        else:
+            self.stdout.write(self.style.ERROR(
+                f'  ❌ {completed} completed payments but {receipts} payment notifications'
+            ))
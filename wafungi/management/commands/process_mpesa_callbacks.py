@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from wafungi.payment_utils import process_callback_inbox
+
+
+class Command(BaseCommand):
+    help = 'Process stored M-Pesa callbacks: update payments, notify users and send receipts'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Callbacks to claim per batch (default: 50)',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the inbox is empty (default: 1.0)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the inbox once and exit (for cron)',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        self.stdout.write(self.style.SUCCESS('📥 Processing M-Pesa callback inbox'))
+
+        try:
+            while True:
+                counts = process_callback_inbox(batch_size=batch_size)
+
+                if counts['claimed']:
+                    self.stdout.write(
+                        f"  ✅ {counts['processed']} processed, "
+                        f"🔁 {counts['retried']} retrying, ❌ {counts['failed']} failed"
+                    )
+
+                if counts['claimed'] < batch_size:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            self.stdout.write('\n👋 Stopping callback worker')
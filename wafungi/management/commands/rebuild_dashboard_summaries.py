@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from wafungi.models import User
+from wafungi.summary_utils import refresh_users
+
+
+class Command(BaseCommand):
+    help = 'Recompute the dashboard summary of every user, e.g. after bulk imports that bypass signals'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='usernames',
+            help='Only rebuild this user (repeatable; default: all)',
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        user_ids = list(users.values_list('pk', flat=True))
+
+        self.stdout.write(self.style.SUCCESS(f'📊 Rebuilding {len(user_ids)} dashboard summaries'))
+        started = time.monotonic()
+        refresh_users(user_ids)
+        self.stdout.write(f'  ⏱️ {time.monotonic() - started:.1f}s')
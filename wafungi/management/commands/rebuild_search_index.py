@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from wafungi.search_utils import SEARCH_KINDS, get_backend, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the full-text search documents for musicians, instruments and events'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kind',
+            action='append',
+            choices=list(SEARCH_KINDS),
+            help='Only rebuild this kind (repeatable; default: all)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Documents written per INSERT (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(f'🔎 Rebuilding search index ({get_backend().name} backend)'))
+        started = time.monotonic()
+
+        counts = rebuild_index(options['kind'], batch_size=options['batch_size'])
+
+        for kind, count in counts.items():
+            self.stdout.write(f'  ✅ {count} {kind} documents')
+        self.stdout.write(f'  ⏱️ {time.monotonic() - started:.1f}s')
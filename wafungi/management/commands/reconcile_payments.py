@@ -0,0 +1,167 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from wafungi.models import PaymentTransaction
+from wafungi.mpesa_utils import QUERY_PROCESSING_ERROR_CODE, MPesaAPI
+from wafungi.payment_utils import CANCELLED_RESULT_CODES, settle_payments_in_bulk
+
+
+class RateLimiter:
+    """Token bucket shared by worker threads; ``rate`` calls per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+                self.last = now
+                if self.allowance >= 1:
+                    self.allowance -= 1
+                    return
+                delay = (1 - self.allowance) / self.rate
+            time.sleep(delay)
+
+
+class Command(BaseCommand):
+    help = (
+        'Reconcile stale pending M-Pesa payments against the STK Push query API. '
+        'Safe to run from cron: updates only apply to rows that are still pending.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=5,
+            help='Only reconcile payments pending for at least this many minutes (default: 5)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Concurrent Daraja queries (default: 8)',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=5.0,
+            help='Maximum Daraja queries per second, 0 for unlimited (default: 5)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Payments queried before each bulk update (default: 200)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Reconcile at most this many payments',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Query Daraja and report outcomes without updating payments',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(minutes=options['min_age'])
+        pending = (
+            PaymentTransaction.objects
+            .filter(status='pending', created_at__lte=cutoff)
+            .exclude(checkout_request_id='')
+            .order_by('created_at')
+            .values_list('checkout_request_id', flat=True)
+        )
+        if options['limit']:
+            pending = pending[:options['limit']]
+        checkout_request_ids = list(pending)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"🔎 Reconciling {len(checkout_request_ids)} pending M-Pesa payments "
+            f"({options['workers']} workers, {options['rate'] or 'unlimited'} req/s)"
+        ))
+        if not checkout_request_ids:
+            return
+
+        mpesa = MPesaAPI()
+        limiter = RateLimiter(options['rate'])
+        outcomes = {'completed': 0, 'failed': 0, 'cancelled': 0, 'pending': 0, 'errors': 0}
+        applied = {'completed': 0, 'failed': 0, 'cancelled': 0}
+        batch_size = max(options['batch_size'], 1)
+        started = time.monotonic()
+
+        def query(checkout_request_id):
+            limiter.wait()
+            return checkout_request_id, mpesa.query_stk_status(checkout_request_id)
+
+        with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as executor:
+            for start in range(0, len(checkout_request_ids), batch_size):
+                batch = {'completed': {}, 'failed': [], 'cancelled': []}
+
+                for checkout_request_id, result in executor.map(query, checkout_request_ids[start:start + batch_size]):
+                    outcome = self.classify(result)
+                    outcomes[outcome] += 1
+                    if outcome == 'completed':
+                        batch['completed'][checkout_request_id] = result.get('transaction_id')
+                    elif outcome in batch:
+                        batch[outcome].append(checkout_request_id)
+
+                if not options['dry_run']:
+                    counts = settle_payments_in_bulk(
+                        completed=batch['completed'],
+                        failed_ids=batch['failed'],
+                        cancelled_ids=batch['cancelled'],
+                    )
+                    for status, count in counts.items():
+                        applied[status] += count
+
+                done = min(start + batch_size, len(checkout_request_ids))
+                self.stdout.write(f"  … {done}/{len(checkout_request_ids)} queried")
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"\n📊 {len(checkout_request_ids)} payments in {elapsed:.1f}s "
+            f"({len(checkout_request_ids) / elapsed if elapsed else 0:.1f}/s)"
+        ))
+        self.stdout.write(
+            f"  ✅ {outcomes['completed']} paid, ❌ {outcomes['failed']} failed, "
+            f"🚫 {outcomes['cancelled']} cancelled, ⏳ {outcomes['pending']} still pending, "
+            f"⚠️ {outcomes['errors']} query errors"
+        )
+        if options['dry_run']:
+            self.stdout.write('  (dry run, no payments updated)')
+        else:
+            self.stdout.write(
+                f"  💾 Updated {applied['completed']} completed, {applied['failed']} failed, "
+                f"{applied['cancelled']} cancelled"
+            )
+
+    def classify(self, result):
+        """Map an STK query result to a reconciliation outcome"""
+        if not result.get('success'):
+            # Daraja answers errorCode 500.001.1001 while the customer has not responded yet
+            return 'pending' if result.get('error_code') == QUERY_PROCESSING_ERROR_CODE else 'errors'
+
+        if result.get('result_code') is None:
+            return 'pending'
+        result_code = str(result.get('result_code'))
+        if result_code == '0':
+            return 'completed'
+        if result_code in CANCELLED_RESULT_CODES:
+            return 'cancelled'
+        return 'failed'
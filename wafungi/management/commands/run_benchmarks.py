@@ -0,0 +1,105 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from wafungi.benchmark_utils import baseline, build_benchmarks, compare, measure
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the hot views and utilities against the current data (see generate_fake_data), '
+        'reporting latency percentiles and query counts. Everything runs in a transaction that is '
+        'rolled back, and mail goes to the in-memory backend. Save a baseline with --save and '
+        'check a later run against it with --compare'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Measured runs per benchmark (default: 20)')
+        parser.add_argument('--warmup', type=int, default=3,
+                            help='Unmeasured runs before each benchmark (default: 3)')
+        parser.add_argument('--only', action='append', default=[],
+                            help='Run only this benchmark (repeatable)')
+        parser.add_argument('--save', metavar='PATH',
+                            help='Write the results to PATH as a JSON baseline')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='Compare against the JSON baseline at PATH and fail on regressions')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative p50 slowdown counted as a regression (default: 0.2)')
+        parser.add_argument('--min-delta', type=float, default=2.0,
+                            help='Smallest p50 slowdown in ms counted as a regression (default: 2.0)')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+        if options['threshold'] < 0 or options['min_delta'] < 0:
+            raise CommandError('--threshold and --min-delta cannot be negative')
+        base = None
+        if options['compare']:
+            try:
+                base = json.loads(Path(options['compare']).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read baseline {options['compare']}: {e}")
+
+        with override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            REQUEST_BUDGET_STRICT=False,
+        ), transaction.atomic():
+            results = self.run(options)
+            transaction.set_rollback(True)
+
+        if options['save']:
+            Path(options['save']).write_text(json.dumps(baseline(results), indent=2))
+            self.stdout.write(self.style.SUCCESS(f"✅ Baseline saved to {options['save']}"))
+
+        if base is not None:
+            self.report_comparison(results, base, options)
+
+    def run(self, options):
+        benchmarks = build_benchmarks()
+        unknown = set(options['only']) - set(benchmarks)
+        if unknown:
+            raise CommandError(f"Unknown or unavailable benchmarks: {', '.join(sorted(unknown))} "
+                               f"(available: {', '.join(benchmarks)})")
+        if options['only']:
+            benchmarks = {name: run for name, run in benchmarks.items() if name in options['only']}
+
+        self.stdout.write(self.style.SUCCESS(
+            f"⏱️ Running {len(benchmarks)} benchmarks, {options['iterations']} iterations each "
+            f"after {options['warmup']} warmup runs"
+        ))
+        results = {}
+        for name, run in benchmarks.items():
+            try:
+                result = measure(run, options['iterations'], options['warmup'])
+            except AssertionError as e:
+                raise CommandError(f'Benchmark {name} failed: {e}')
+            results[name] = result
+            self.stdout.write(
+                f"  {name:<30} p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  "
+                f"p99 {result['p99_ms']:8.2f}ms  max {result['max_ms']:8.2f}ms  "
+                f"queries {result['queries']} (max {result['queries_max']})"
+            )
+        return results
+
+    def report_comparison(self, results, base, options):
+        self.stdout.write(f"\n🔎 Compared with baseline from {base.get('created_at', 'unknown')} "
+                          f"(dataset {base.get('dataset', {})})")
+        missing = sorted(set(base.get('results', {})) - set(results))
+        if missing and not options['only']:
+            self.stdout.write(f"  Not run this time: {', '.join(missing)}")
+
+        regressions = compare(results, base, options['threshold'], options['min_delta'])
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS(
+                f"✅ No regressions beyond {options['threshold']:.0%} (and {options['min_delta']}ms)"
+            ))
+            return
+        for name, description in regressions:
+            self.stdout.write(self.style.ERROR(f'  {name}: {description}'))
+        raise CommandError(f'{len(regressions)} regressions against the baseline')
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand
+from wafungi.fake_daraja import FakeDarajaServer
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake Daraja API server for offline M-Pesa testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            type=str,
+            default='127.0.0.1',
+            help='Interface to bind (default: 127.0.0.1)',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8900,
+            help='Port to listen on (default: 8900)',
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0,
+            help='Seconds added to every response (default: 0)',
+        )
+        parser.add_argument(
+            '--jitter',
+            type=float,
+            default=0,
+            help='Extra random latency of up to this many seconds (default: 0)',
+        )
+        parser.add_argument(
+            '--failure-rate',
+            type=float,
+            default=0,
+            help='Fraction of requests answered with 503 (default: 0)',
+        )
+        parser.add_argument(
+            '--cancel-rate',
+            type=float,
+            default=0,
+            help='Fraction of STK pushes the customer cancels (default: 0)',
+        )
+        parser.add_argument(
+            '--callbacks',
+            action='store_true',
+            help='POST payment results to the CallBackURL of each STK push',
+        )
+        parser.add_argument(
+            '--callback-url',
+            type=str,
+            default=None,
+            help='Send callbacks here instead of the CallBackURL in the request',
+        )
+        parser.add_argument(
+            '--callback-delay',
+            type=float,
+            default=2.0,
+            help='Seconds between an STK push and its result (default: 2.0)',
+        )
+        parser.add_argument(
+            '--duplicate-rate',
+            type=float,
+            default=0,
+            help='Fraction of callbacks delivered twice (default: 0)',
+        )
+
+    def handle(self, *args, **options):
+        server = FakeDarajaServer(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            latency_jitter=options['jitter'],
+            failure_rate=options['failure_rate'],
+            cancel_rate=options['cancel_rate'],
+            send_callbacks=options['callbacks'],
+            callback_url=options['callback_url'],
+            callback_delay=options['callback_delay'],
+            duplicate_rate=options['duplicate_rate'],
+        )
+
+        self.stdout.write(self.style.SUCCESS(f'🧪 Fake Daraja listening on {server.base_url}'))
+        self.stdout.write(f'  Point the app at it with MPESA_BASE_URL={server.base_url}')
+        if options['callbacks']:
+            self.stdout.write(f"  📨 Delivering callbacks after {options['callback_delay']}s "
+                              f"({options['duplicate_rate']:.0%} duplicated)")
+        self.stdout.write('  Press Ctrl+C to stop.')
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('\n👋 Stopping fake Daraja')
+        finally:
+            server.close()
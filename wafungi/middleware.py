@@ -0,0 +1,112 @@
+"""
+Per-request query and time reporting with per-view budgets
+"""
+import logging
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .timing_utils import collect_timings, current_timings
+
+logger = logging.getLogger(__name__)
+
+
+class RequestBudgetExceeded(Exception):
+    """Raised in strict mode when a request goes over its view's budget"""
+
+
+def budget_for(url_name):
+    """
+    Limits for a URL name: the defaults overridden by REQUEST_BUDGETS[url_name]
+
+    Returns:
+        dict: Any of 'queries', 'db_ms' and 'total_ms'
+    """
+    budget = {
+        'queries': getattr(settings, 'REQUEST_BUDGET_QUERIES', 30),
+        'db_ms': getattr(settings, 'REQUEST_BUDGET_DB_MS', 250),
+    }
+    budget.update(getattr(settings, 'REQUEST_BUDGETS', {}).get(url_name, {}))
+    return budget
+
+
+def over_budget(stats, budget):
+    """Descriptions of the limits ``stats`` (RequestTimings.as_dict()) went over, e.g. 'queries 41>30'"""
+    return [f"{name} {stats[name]}>{limit}" for name, limit in budget.items() if limit is not None and stats[name] > limit]
+
+
+class RequestBudgetMiddleware:
+    """
+    Count queries and time the DB, templates and view of every request
+
+    The numbers go out as a Server-Timing header and as fields of a log
+    record keyed by URL name. Requests over their view's budget are logged
+    as warnings, or fail with RequestBudgetExceeded when
+    REQUEST_BUDGET_STRICT is set (meant for development and tests).
+    Queries run while a streaming response is consumed are not counted.
+    Async-capable, so ASGI requests are not pushed through a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Django runs a sync process_view in a thread when the chain is async
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not getattr(settings, 'REQUEST_TIMING_ENABLED', True):
+            return self.get_response(request)
+
+        with collect_timings() as timings:
+            response = self.get_response(request)
+        return self.report(request, response, timings)
+
+    async def __acall__(self, request):
+        if not getattr(settings, 'REQUEST_TIMING_ENABLED', True):
+            return await self.get_response(request)
+
+        with collect_timings() as timings:
+            response = await self.get_response(request)
+        return self.report(request, response, timings)
+
+    def report(self, request, response, timings):
+        """Add the Server-Timing header, log the numbers and check the view's budget"""
+        match = request.resolver_match
+        url_name = match.view_name if match else None
+        stats = timings.as_dict()
+        exceeded = over_budget(stats, budget_for(url_name)) if url_name else []
+
+        if getattr(settings, 'REQUEST_TIMING_HEADER', True):
+            header = timings.server_timing()
+            if exceeded:
+                header += f', budget;desc="over: {", ".join(exceeded)}"'
+            response['Server-Timing'] = header
+
+        fields = {'url_name': url_name, 'method': request.method, 'status': response.status_code, **stats}
+        if exceeded:
+            logger.warning(f"Request budget exceeded for {url_name}: {', '.join(exceeded)}",
+                           extra={'timings': fields, 'over_budget': exceeded})
+            if getattr(settings, 'REQUEST_BUDGET_STRICT', False):
+                raise RequestBudgetExceeded(f"{request.method} {request.path} ({url_name}): {', '.join(exceeded)}")
+        else:
+            logger.info(f"{request.method} {url_name} {response.status_code}: {stats['queries']} queries, "
+                        f"{stats['db_ms']}ms db, {stats['total_ms']}ms total", extra={'timings': fields})
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        start_view()
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        start_view()
+
+
+def start_view():
+    """Mark where middleware ends and the view begins"""
+    timings = current_timings()
+    if timings is not None:
+        timings.start_view()
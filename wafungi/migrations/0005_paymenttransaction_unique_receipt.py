@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0004_paymenttransaction'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='paymenttransaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('transaction_id', ''), _negated=True), fields=('transaction_id',), name='unique_mpesa_receipt_number'),
+        ),
+    ]
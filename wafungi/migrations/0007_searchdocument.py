@@ -0,0 +1,104 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+FTS_TABLE = 'wafungi_searchdocument_fts'
+
+
+def create_fulltext_index(apps, schema_editor):
+    """FTS5 table (SQLite) or GIN-indexed tsvector column (PostgreSQL) over the documents"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                return  # Falls back to the in-process index
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "title, body, content='wafungi_searchdocument', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON wafungi_searchdocument BEGIN "
+            f"INSERT INTO {FTS_TABLE}(rowid, title, body) VALUES (new.id, new.title, new.body); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON wafungi_searchdocument BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE ON wafungi_searchdocument BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); "
+            f"INSERT INTO {FTS_TABLE}(rowid, title, body) VALUES (new.id, new.title, new.body); END"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "ALTER TABLE wafungi_searchdocument ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(body, '')), 'B')) STORED"
+        )
+        schema_editor.execute(
+            "CREATE INDEX wafungi_searchdocument_vector_idx ON wafungi_searchdocument USING GIN (search_vector)"
+        )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for suffix in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS wafungi_searchdocument_vector_idx")
+        schema_editor.execute("ALTER TABLE wafungi_searchdocument DROP COLUMN IF EXISTS search_vector")
+
+
+def index_existing_objects(apps, schema_editor):
+    """Same text as search_utils builds, from the historical models"""
+    SearchDocument = apps.get_model('wafungi', 'SearchDocument')
+    MusicianProfile = apps.get_model('wafungi', 'MusicianProfile')
+    InstrumentListing = apps.get_model('wafungi', 'InstrumentListing')
+    Event = apps.get_model('wafungi', 'Event')
+
+    documents = []
+    for profile in MusicianProfile.objects.select_related('user').prefetch_related('genres', 'instruments'):
+        user = profile.user
+        documents.append(SearchDocument(
+            kind='musician', object_id=profile.pk,
+            title=' '.join(filter(None, [profile.stage_name, user.first_name, user.last_name])),
+            body=' '.join([user.bio] + [g.name for g in profile.genres.all()] + [i.name for i in profile.instruments.all()]),
+        ))
+    for listing in InstrumentListing.objects.select_related('instrument'):
+        documents.append(SearchDocument(
+            kind='instrument', object_id=listing.pk,
+            title=f"{listing.brand} {listing.model} {listing.instrument.name}", body=listing.description,
+        ))
+    for event in Event.objects.all():
+        documents.append(SearchDocument(kind='event', object_id=event.pk, title=event.title, body=event.description))
+    SearchDocument.objects.bulk_create(documents, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0006_mpesacallback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('musician', 'Musician'), ('instrument', 'Instrument Listing'), ('event', 'Event')], max_length=20)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('title', models.TextField(blank=True)),
+                ('body', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_search_document')],
+            },
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+        migrations.RunPython(index_existing_objects, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:05
+
+from django.db import migrations
+
+
+def create_trigram_index(apps, schema_editor):
+    """pg_trgm index over document titles; other databases use the in-process trigram index"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX wafungi_searchdocument_title_trgm ON wafungi_searchdocument "
+        "USING GIN (title gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS wafungi_searchdocument_title_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0007_searchdocument'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0008_searchdocument_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['client', '-created_at', 'id'], name='booking_client_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['musician', '-created_at', 'id'], name='booking_musician_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['date', 'id'], name='event_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventapplication',
+            index=models.Index(fields=['musician', '-applied_at', 'id'], name='application_musician_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instrumentlisting',
+            index=models.Index(fields=['-created_at', 'id'], name='instrument_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='musicianprofile',
+            index=models.Index(fields=['-rating', '-total_gigs', 'id'], name='musician_rank_idx'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+def locate_existing_rows(apps, schema_editor):
+    """Geocode the locations saved before the gazetteer existed"""
+    from wafungi.geo_utils import geocode
+
+    for model_name in ('User', 'InstrumentListing', 'Event'):
+        model = apps.get_model('wafungi', model_name)
+        located = []
+        for row in model.objects.exclude(location='').only('id', 'location').iterator(chunk_size=2000):
+            town, latitude, longitude, cell = geocode(row.location)
+            if town:
+                row.town, row.latitude, row.longitude, row.geo_cell = town, latitude, longitude, cell
+                located.append(row)
+        model.objects.bulk_update(located, ['town', 'latitude', 'longitude', 'geo_cell'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0009_listing_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='town',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='instrumentlisting',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='instrumentlisting',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='instrumentlisting',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='instrumentlisting',
+            name='town',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='town',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+        migrations.RunPython(locate_existing_rows, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0010_geo_location'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['musician', 'start_date', 'end_date'], name='booking_musician_slot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['instrument_listing', 'start_date', 'end_date'], name='booking_instrument_slot_idx'),
+        ),
+    ]
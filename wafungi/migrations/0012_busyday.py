@@ -0,0 +1,54 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:42
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def materialize_busy_days(apps, schema_editor):
+    """Busy days of the pending and confirmed bookings that have not ended yet"""
+    Booking = apps.get_model('wafungi', 'Booking')
+    BusyDay = apps.get_model('wafungi', 'BusyDay')
+
+    rows = set()
+    bookings = Booking.objects.filter(status__in=['pending', 'confirmed'], end_date__gt=timezone.now())
+    for musician_id, listing_id, start, end in bookings.values_list(
+        'musician_id', 'instrument_listing_id', 'start_date', 'end_date'
+    ).iterator(chunk_size=2000):
+        first = timezone.localtime(start).date()
+        last = timezone.localtime(end - timedelta(microseconds=1)).date()
+        for offset in range((last - first).days + 1):
+            day = first + timedelta(days=offset)
+            rows.add((None, listing_id, day) if listing_id else (musician_id, None, day))
+    BusyDay.objects.bulk_create(
+        [BusyDay(musician_id=musician_id, instrument_listing_id=listing_id, day=day)
+         for musician_id, listing_id, day in rows if musician_id or listing_id],
+        batch_size=1000, ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0011_booking_slot_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BusyDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('instrument_listing', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='busy_days', to='wafungi.instrumentlisting')),
+                ('musician', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='busy_days', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day', 'musician'], name='busy_day_musician_idx'), models.Index(fields=['day', 'instrument_listing'], name='busy_day_instrument_idx')],
+                'constraints': [models.UniqueConstraint(fields=('musician', 'day'), name='unique_musician_busy_day'), models.UniqueConstraint(fields=('instrument_listing', 'day'), name='unique_instrument_busy_day')],
+            },
+        ),
+        migrations.RunPython(materialize_busy_days, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:50
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def start_from_created_at(apps, schema_editor):
+    apps.get_model('wafungi', 'Booking').objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0012_busyday'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(start_from_created_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0013_booking_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dashboard_summary', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total_earnings', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('bookings_made', models.PositiveIntegerField(default=0)),
+                ('bookings_received', models.PositiveIntegerField(default=0)),
+                ('pending_requests', models.PositiveIntegerField(default=0)),
+                ('events_created', models.PositiveIntegerField(default=0)),
+                ('instruments_listed', models.PositiveIntegerField(default=0)),
+                ('applications_sent', models.PositiveIntegerField(default=0)),
+                ('pending_applications', models.PositiveIntegerField(default=0)),
+                ('unread_notifications', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'is_read', '-created_at'], name='notification_unread_idx'),
+        ),
+    ]
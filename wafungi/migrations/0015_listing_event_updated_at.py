@@ -0,0 +1,33 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:20
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def start_from_created_at(apps, schema_editor):
+    for name in ('Event', 'InstrumentListing'):
+        apps.get_model('wafungi', name).objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wafungi', '0014_dashboard_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='instrumentlisting',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(start_from_created_at, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,20 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 from decimal import Decimal
 
-class User(AbstractUser):
+class Located(models.Model):
+    """Gazetteer town and grid cell of a free-text location, filled in on save"""
+    town = models.CharField(max_length=50, blank=True, db_index=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    geo_cell = models.CharField(max_length=20, blank=True, db_index=True)
+    
+    class Meta:
+        abstract = True
+
+class User(AbstractUser, Located):
     USER_TYPES = (
         ('musician', 'Musician'),
         ('organizer', 'Event Organizer'),
@@ -47,10 +58,16 @@ class MusicianProfile(models.Model):
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
     total_gigs = models.PositiveIntegerField(default=0)
     
+    class Meta:
+        indexes = [
+            # Keyset pagination of search_musicians
+            models.Index(fields=['-rating', '-total_gigs', 'id'], name='musician_rank_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.stage_name or self.user.username} - Musician"
 
-class InstrumentListing(models.Model):
+class InstrumentListing(Located):
     CONDITION_CHOICES = (
         ('excellent', 'Excellent'),
         ('good', 'Good'),
@@ -69,11 +86,17 @@ class InstrumentListing(models.Model):
     is_available = models.BooleanField(default=True)
     location = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', 'id'], name='instrument_recent_idx'),
+        ]
     
     def __str__(self):
         return f"{self.brand} {self.model} - {self.instrument.name}"
 
-class Event(models.Model):
+class Event(Located):
     EVENT_TYPES = (
         ('wedding', 'Wedding'),
         ('corporate', 'Corporate Event'),
@@ -97,6 +120,12 @@ class Event(models.Model):
     musicians_needed = models.PositiveIntegerField(default=1)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'id'], name='event_date_idx'),
+        ]
     
     def __str__(self):
         return self.title
@@ -122,6 +151,9 @@ class EventApplication(models.Model):
     class Meta:
         unique_together = ('event', 'musician')  # Prevent duplicate applications
         ordering = ['-applied_at']
+        indexes = [
+            models.Index(fields=['musician', '-applied_at', 'id'], name='application_musician_idx'),
+        ]
     
     def __str__(self):
         return f"{self.musician.get_full_name() or self.musician.username} - {self.event.title}"
@@ -146,9 +178,46 @@ class PaymentTransaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        constraints = [
+            # A receipt number can only ever settle one transaction
+            models.UniqueConstraint(
+                fields=['transaction_id'],
+                condition=~models.Q(transaction_id=''),
+                name='unique_mpesa_receipt_number',
+            ),
+        ]
+    
     def __str__(self):
         return f"Transaction {self.transaction_id or self.checkout_request_id} - {self.status}"
 
+class MpesaCallback(models.Model):
+    """Raw M-Pesa callback, stored on receipt and processed by a background worker"""
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    )
+    
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['received_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='mpesa_callback_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Callback {self.checkout_request_id or self.id} - {self.status}"
+
 class Booking(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -169,6 +238,17 @@ class Booking(models.Model):
     payment_status = models.BooleanField(default=False)
     notes = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            # Keyset pagination of my_bookings
+            models.Index(fields=['client', '-created_at', 'id'], name='booking_client_recent_idx'),
+            models.Index(fields=['musician', '-created_at', 'id'], name='booking_musician_recent_idx'),
+            # Overlap checks: bookings of a musician or listing around a time slot
+            models.Index(fields=['musician', 'start_date', 'end_date'], name='booking_musician_slot_idx'),
+            models.Index(fields=['instrument_listing', 'start_date', 'end_date'], name='booking_instrument_slot_idx'),
+        ]
     
     def get_recipient_phone(self):
         """Get the phone number of the service provider (musician or instrument owner)"""
@@ -207,5 +287,86 @@ class Notification(models.Model):
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        indexes = [
+            # Unread notifications on the dashboard
+            models.Index(fields=['user', 'is_read', '-created_at'], name='notification_unread_idx'),
+        ]
+    
     def __str__(self):
         return f"Notification for {self.user.username}"
+
+class SearchDocument(models.Model):
+    """
+    Searchable text of a musician, instrument listing or event
+    
+    Kept in sync by signals (see signals.py) and indexed by the database's
+    full-text engine: an FTS5 table on SQLite, a GIN-indexed tsvector column
+    on PostgreSQL (both created in migration 0007).
+    """
+    KIND_CHOICES = (
+        ('musician', 'Musician'),
+        ('instrument', 'Instrument Listing'),
+        ('event', 'Event'),
+    )
+    
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    title = models.TextField(blank=True)
+    body = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_search_document'),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} #{self.object_id}"
+
+class BusyDay(models.Model):
+    """
+    A day on which a musician or instrument listing has a pending or confirmed booking
+    
+    Materialized from Booking by availability_utils.refresh_busy_days so the
+    search pages can filter "free on" a date with one indexed lookup.
+    """
+    musician = models.ForeignKey(User, on_delete=models.CASCADE, related_name='busy_days', null=True, blank=True)
+    instrument_listing = models.ForeignKey(InstrumentListing, on_delete=models.CASCADE, related_name='busy_days', null=True, blank=True)
+    day = models.DateField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['musician', 'day'], name='unique_musician_busy_day'),
+            models.UniqueConstraint(fields=['instrument_listing', 'day'], name='unique_instrument_busy_day'),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'musician'], name='busy_day_musician_idx'),
+            models.Index(fields=['day', 'instrument_listing'], name='busy_day_instrument_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.musician or self.instrument_listing} busy on {self.day}"
+
+class DashboardSummary(models.Model):
+    """
+    Running totals behind a user's dashboard
+    
+    Adjusted in place by summary_utils whenever bookings, payments,
+    applications, events, listings or notifications change, and rebuilt
+    from scratch when missing.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='dashboard_summary')
+    total_earnings = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    bookings_made = models.PositiveIntegerField(default=0)
+    bookings_received = models.PositiveIntegerField(default=0)
+    pending_requests = models.PositiveIntegerField(default=0)
+    events_created = models.PositiveIntegerField(default=0)
+    instruments_listed = models.PositiveIntegerField(default=0)
+    applications_sent = models.PositiveIntegerField(default=0)
+    pending_applications = models.PositiveIntegerField(default=0)
+    unread_notifications = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Dashboard summary for {self.user.username}"
@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+
+from .mpesa_utils import (
+    DarajaUnavailable, MPesaAPI, access_token_cache, apayments_available, build_payment_reference,
+    circuit_breakers, is_daraja_failure, retry_delay,
+)
+
+logger = logging.getLogger(__name__)
+
+# One client per event loop; an httpx.AsyncClient must not cross loops
+_async_clients = weakref.WeakKeyDictionary()
+_refresh_locks = weakref.WeakKeyDictionary()
+_background_refreshes = set()
+
+
+def get_async_http_client():
+    """
+    Shared keep-alive httpx client for Daraja calls on the running event loop
+
+    Pool limits and timeouts follow the same settings as the sync session.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None or client.is_closed:
+        max_connections = getattr(settings, 'MPESA_HTTP_POOL_MAXSIZE', 20)
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=getattr(settings, 'MPESA_ASYNC_MAX_CONNECTIONS', max_connections * 5),
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(
+                getattr(settings, 'MPESA_READ_TIMEOUT', 30),
+                connect=getattr(settings, 'MPESA_CONNECT_TIMEOUT', 5),
+            ),
+        )
+        _async_clients[loop] = client
+
+    return client
+
+
+async def close_async_http_clients():
+    """Close the client bound to the running loop, e.g. on ASGI shutdown"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _refresh_lock_for(key):
+    locks = _refresh_locks.setdefault(asyncio.get_running_loop(), {})
+    return locks.setdefault(key, asyncio.Lock())
+
+
+class AsyncMPesaAPI(MPesaAPI):
+    """
+    Non-blocking M-Pesa API client for ASGI views
+
+    Shares configuration, payload building, the process-wide token cache and
+    the circuit breakers with MPesaAPI, but performs all network I/O, cache
+    reads and writes included, as coroutines.
+    """
+
+    @property
+    def client(self):
+        return get_async_http_client()
+
+    async def get_access_token(self, force_refresh=False):
+        """Get OAuth access token, served from the shared token cache when possible"""
+        key = access_token_cache.cache_key(self)
+
+        if not force_refresh:
+            entry = await access_token_cache.alookup(key)
+            if entry:
+                if entry['expires_at'] - time.time() <= access_token_cache.refresh_margin:
+                    self._refresh_in_background(key)
+                return entry['token']
+
+        # Only one coroutine per loop refreshes; the rest wait and reuse its token
+        async with _refresh_lock_for(key):
+            if not force_refresh:
+                entry = await access_token_cache.alookup(key)
+                if entry:
+                    return entry['token']
+
+            token, expires_in = await self.request_access_token()
+            if not token:
+                return None
+            return await access_token_cache.astore(key, token, expires_in)
+
+    def _refresh_in_background(self, key):
+        lock = _refresh_lock_for(key)
+        if lock.locked():
+            return  # A refresh is already running
+
+        task = asyncio.create_task(self.get_access_token(force_refresh=True))
+        _background_refreshes.add(task)
+        task.add_done_callback(_background_refreshes.discard)
+
+    async def send(self, endpoint, method, url, idempotent=False, **kwargs):
+        """Async counterpart of MPesaAPI.send, sharing its circuit breakers"""
+        breaker = circuit_breakers[endpoint]
+        attempts = 1 + (getattr(settings, 'MPESA_RETRY_ATTEMPTS', 2) if idempotent else 0)
+
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(retry_delay(attempt - 1))
+            if not await breaker.aallow():
+                raise DarajaUnavailable(f"Daraja {endpoint} circuit is open")
+
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                await breaker.arecord_failure()
+                error, response = e, None
+                logger.warning(f"Daraja {endpoint} attempt {attempt + 1}/{attempts} failed: {e}")
+                continue
+
+            if not is_daraja_failure(response.status_code, response.text):
+                await breaker.arecord_success()
+                return response
+
+            await breaker.arecord_failure()
+            logger.warning(f"Daraja {endpoint} attempt {attempt + 1}/{attempts} returned {response.status_code}")
+
+        if response is not None:
+            return response
+        raise error
+
+    async def send_authorized(self, endpoint, url, payload, access_token, idempotent=False):
+        """Async counterpart of MPesaAPI.send_authorized"""
+        response = await self.send(endpoint, 'POST', url, idempotent=idempotent,
+                                   json=payload, headers=self.bearer_headers(access_token))
+        if response.status_code == 401:
+            logger.info("M-Pesa access token rejected, requesting a new one")
+            await access_token_cache.ainvalidate(self)
+            access_token = await self.get_access_token(force_refresh=True)
+            if access_token:
+                response = await self.send(endpoint, 'POST', url, idempotent=idempotent,
+                                           json=payload, headers=self.bearer_headers(access_token))
+        return response
+
+    async def request_access_token(self):
+        """
+        Request a fresh OAuth access token from M-Pesa API
+
+        Returns:
+            tuple: (access_token, expires_in seconds), or (None, None) on failure
+        """
+        if not self.consumer_key or not self.consumer_secret:
+            logger.error("M-Pesa credentials not set. Please check MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET in settings.")
+            return None, None
+
+        try:
+            logger.info(f"Requesting access token from: {self.auth_url}")
+
+            response = await self.send('oauth', 'GET', self.auth_url, idempotent=True, headers=self.basic_auth_headers())
+            response.raise_for_status()
+
+            result = response.json()
+            access_token = result.get('access_token')
+
+            if access_token:
+                logger.info("Successfully obtained M-Pesa access token")
+                return access_token, result.get('expires_in')
+            else:
+                logger.error(f"No access token in response: {result}")
+                return None, None
+
+        except DarajaUnavailable as e:
+            logger.warning(f"Skipping M-Pesa access token request: {e}")
+            return None, None
+        except httpx.HTTPError as e:
+            logger.error(f"Network error getting M-Pesa access token: {e}")
+            return None, None
+        except Exception as e:
+            logger.error(f"Unexpected error getting M-Pesa access token: {e}")
+            return None, None
+
+    async def stk_push(self, phone_number, amount, account_reference, transaction_desc):
+        """
+        Initiate STK Push payment
+
+        Args:
+            phone_number (str): Customer phone number
+            amount (float): Amount to be paid
+            account_reference (str): Reference for the transaction
+            transaction_desc (str): Description of the transaction
+
+        Returns:
+            dict: Response with success status and transaction details
+        """
+        if not await apayments_available():
+            return self.unavailable_response()
+
+        access_token = await self.get_access_token()
+        if not access_token:
+            if await circuit_breakers['oauth'].astate() != 'closed':
+                return self.unavailable_response()
+            return {
+                'success': False,
+                'error': 'Failed to get access token. Please check M-Pesa credentials.',
+                'error_code': 'AUTH_ERROR'
+            }
+
+        payload = self.build_stk_push_payload(phone_number, amount, account_reference, transaction_desc)
+
+        try:
+            logger.info(f"Initiating STK Push for {payload['PhoneNumber']}, Amount: {amount}")
+
+            response = await self.send_authorized('stk_push', self.stk_push_url, payload, access_token)
+            response.raise_for_status()
+
+            result = response.json()
+            logger.info(f"STK Push response: {result}")
+
+            return self.parse_stk_push_response(result)
+
+        except DarajaUnavailable:
+            return self.unavailable_response()
+        except httpx.HTTPError as e:
+            logger.error(f"Network error during STK Push: {e}")
+            return {
+                'success': False,
+                'error': f'Network error: {str(e)}',
+                'error_code': 'NETWORK_ERROR'
+            }
+        except Exception as e:
+            logger.error(f"Unexpected error during STK Push: {e}")
+            return {
+                'success': False,
+                'error': f'Unexpected error: {str(e)}',
+                'error_code': 'SYSTEM_ERROR'
+            }
+
+    async def query_stk_status(self, checkout_request_id):
+        """
+        Query the status of an STK Push transaction
+
+        Args:
+            checkout_request_id (str): CheckoutRequestID from STK Push response
+
+        Returns:
+            dict: Transaction status information
+        """
+        access_token = await self.get_access_token()
+        if not access_token:
+            if await circuit_breakers['oauth'].astate() != 'closed':
+                return self.unavailable_response()
+            return {'success': False, 'error': 'Failed to get access token'}
+
+        payload = self.build_query_payload(checkout_request_id)
+
+        try:
+            response = await self.send_authorized('query', self.query_url, payload, access_token, idempotent=True)
+            if response.status_code >= 400:
+                return self.query_error_response(response.status_code, response.text)
+
+            return self.parse_query_response(response.json())
+
+        except DarajaUnavailable:
+            return self.unavailable_response()
+        except Exception as e:
+            logger.error(f"Error querying STK status: {e}")
+            return {'success': False, 'error': str(e)}
+
+
+async def aprocess_mpesa_payment(phone_number, amount, booking_id=None, recipient_phone=None):
+    """Async counterpart of process_mpesa_payment"""
+    mpesa = AsyncMPesaAPI()
+    account_reference, transaction_desc = build_payment_reference(booking_id)
+
+    result = await mpesa.stk_push(
+        phone_number=phone_number,
+        amount=amount,
+        account_reference=account_reference,
+        transaction_desc=transaction_desc
+    )
+
+    logger.info(f"Payment attempt for booking {booking_id}: {result}")
+
+    return result
+
+
+async def averify_payment_status(checkout_request_id):
+    """Async counterpart of verify_payment_status"""
+    mpesa = AsyncMPesaAPI()
+    return await mpesa.query_stk_status(checkout_request_id)
@@ -1,16 +1,497 @@
 import logging
 import requests
 import base64
+import hashlib
 import json
+import random
+import threading
+import time
 from datetime import datetime
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
-import urllib3
-from requests.exceptions import RequestException
-from pyngrok import ngrok # type: ignore
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, RequestException, Timeout
 
 logger = logging.getLogger(__name__)
 
+# Daraja tokens are valid for an hour; used when the response omits expires_in
+DEFAULT_TOKEN_LIFETIME = 3599
+
+
+class AccessTokenCache:
+    """
+    Process-wide cache of M-Pesa OAuth access tokens
+    
+    Tokens are shared by every MPesaAPI instance and thread in the process and
+    kept until the ``expires_in`` returned by Daraja runs out. Once a token is
+    within MPESA_TOKEN_REFRESH_MARGIN seconds of expiry it is still served while
+    a single background thread fetches its replacement. Setting
+    MPESA_TOKEN_CACHE_ALIAS to a Django cache alias also shares tokens between
+    worker processes through that cache backend.
+    """
+    
+    def __init__(self):
+        self._tokens = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+    
+    @property
+    def refresh_margin(self):
+        return getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300)
+    
+    @property
+    def shared_cache(self):
+        alias = getattr(settings, 'MPESA_TOKEN_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+    
+    def cache_key(self, api):
+        """Key tokens by endpoint and consumer key so sandbox and production never mix"""
+        digest = hashlib.sha256(f"{api.auth_url}|{api.consumer_key}".encode()).hexdigest()[:32]
+        return f"mpesa:access-token:{digest}"
+    
+    def get(self, api, force_refresh=False):
+        """
+        Return a valid access token for the API credentials
+        
+        Args:
+            api (MPesaAPI): Client whose credentials and auth URL are used
+            force_refresh (bool): Skip cached tokens and fetch a new one
+        
+        Returns:
+            str: Access token, or None if Daraja could not issue one
+        """
+        key = self.cache_key(api)
+        
+        if not force_refresh:
+            entry = self.lookup(key)
+            if entry:
+                if entry['expires_at'] - time.time() <= self.refresh_margin:
+                    self._refresh_in_background(api, key)
+                return entry['token']
+        
+        # Only one thread per process refreshes; the rest wait and reuse its token
+        with self._lock_for(key):
+            if not force_refresh:
+                entry = self.lookup(key)
+                if entry:
+                    return entry['token']
+            return self._refresh(api, key)
+    
+    def invalidate(self, api):
+        """Drop the cached token for the API credentials, e.g. after a 401"""
+        key = self.cache_key(api)
+        self._tokens.pop(key, None)
+        if self.shared_cache is not None:
+            self.shared_cache.delete(key)
+    
+    async def ainvalidate(self, api):
+        """Async counterpart of invalidate"""
+        key = self.cache_key(api)
+        self._tokens.pop(key, None)
+        if self.shared_cache is not None:
+            await self.shared_cache.adelete(key)
+    
+    def clear(self):
+        """Forget every token held by this process"""
+        self._tokens.clear()
+    
+    def _lock_for(self, key):
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+    
+    def lookup(self, key):
+        """
+        Return the cached token entry for a key if it has not expired
+        
+        A missing or expiring local entry is replaced by a fresher one from the
+        shared cache, so workers pick up tokens another worker already fetched.
+        """
+        entry = self._tokens.get(key)
+        if self._wants_shared(entry):
+            entry = self._merge_shared(key, entry, self.shared_cache.get(key))
+        return entry if entry and entry['expires_at'] > time.time() else None
+    
+    async def alookup(self, key):
+        """Async counterpart of lookup, reading the shared cache without blocking the event loop"""
+        entry = self._tokens.get(key)
+        if self._wants_shared(entry):
+            entry = self._merge_shared(key, entry, await self.shared_cache.aget(key))
+        return entry if entry and entry['expires_at'] > time.time() else None
+    
+    def _wants_shared(self, entry):
+        return self.shared_cache is not None and (entry is None or entry['expires_at'] - time.time() <= self.refresh_margin)
+    
+    def _merge_shared(self, key, entry, shared):
+        """Keep whichever of the local and shared entries expires later"""
+        if shared and (entry is None or shared['expires_at'] > entry['expires_at']):
+            entry = self._tokens[key] = shared
+        return entry
+    
+    def _refresh(self, api, key):
+        """Fetch a new token and publish it locally and to the shared cache"""
+        shared_cache = self.shared_cache
+        lock_key = f"{key}:refresh-lock"
+        
+        # Across workers, let the process that wins the lock do the fetching
+        locked = shared_cache is not None and shared_cache.add(lock_key, 1, timeout=30)
+        if shared_cache is not None and not locked:
+            entry = self._wait_for_shared_token(key)
+            if entry:
+                return entry['token']
+            # The lock holder is slow or gone; fetch anyway but leave its lock alone
+        
+        try:
+            token, expires_in = api.request_access_token()
+            if not token:
+                return None
+            return self.store(key, token, expires_in)
+        finally:
+            if locked:
+                shared_cache.delete(lock_key)
+    
+    def store(self, key, token, expires_in):
+        """Publish a freshly issued token locally and to the shared cache"""
+        entry, expires_in = self._store_locally(key, token, expires_in)
+        if self.shared_cache is not None:
+            self.shared_cache.set(key, entry, timeout=expires_in)
+        return token
+    
+    async def astore(self, key, token, expires_in):
+        """Async counterpart of store"""
+        entry, expires_in = self._store_locally(key, token, expires_in)
+        if self.shared_cache is not None:
+            await self.shared_cache.aset(key, entry, timeout=expires_in)
+        return token
+    
+    def _store_locally(self, key, token, expires_in):
+        try:
+            expires_in = int(expires_in)
+        except (TypeError, ValueError):
+            expires_in = DEFAULT_TOKEN_LIFETIME
+        
+        entry = self._tokens[key] = {'token': token, 'expires_at': time.time() + expires_in}
+        logger.info(f"Cached M-Pesa access token for {expires_in} seconds")
+        return entry, expires_in
+    
+    def _wait_for_shared_token(self, key, timeout=5.0, interval=0.1):
+        """Poll the shared cache while another worker refreshes the token"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            entry = self.shared_cache.get(key)
+            if entry and entry['expires_at'] - time.time() > self.refresh_margin:
+                self._tokens[key] = entry
+                return entry
+            time.sleep(interval)
+        return None
+    
+    def _refresh_in_background(self, api, key):
+        lock = self._lock_for(key)
+        if not lock.acquire(blocking=False):
+            return  # A refresh is already running
+        
+        def refresh():
+            try:
+                self._refresh(api, key)
+            except Exception as e:
+                logger.error(f"Background M-Pesa token refresh failed: {e}")
+            finally:
+                lock.release()
+        
+        threading.Thread(target=refresh, name='mpesa-token-refresh', daemon=True).start()
+
+
+access_token_cache = AccessTokenCache()
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """
+    Shared keep-alive session used for all Daraja calls in this process
+    
+    Connections to each Daraja host are pooled (MPESA_HTTP_POOL_MAXSIZE per host)
+    and reused across threads, so only the first request pays for TCP and TLS
+    setup. Cookies are never stored, which keeps the session safe to share.
+    """
+    global _http_session
+    
+    if _http_session is not None:
+        return _http_session
+    
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(
+                pool_connections=getattr(settings, 'MPESA_HTTP_POOL_CONNECTIONS', 4),
+                pool_maxsize=getattr(settings, 'MPESA_HTTP_POOL_MAXSIZE', 20),
+                pool_block=getattr(settings, 'MPESA_HTTP_POOL_BLOCK', False),
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Connection': 'keep-alive'})
+            _http_session = session
+    
+    return _http_session
+
+def get_http_timeout():
+    """(connect, read) timeout tuple for Daraja calls"""
+    return (
+        getattr(settings, 'MPESA_CONNECT_TIMEOUT', 5),
+        getattr(settings, 'MPESA_READ_TIMEOUT', 30),
+    )
+
+def get_http_pool_stats():
+    """
+    Connection reuse statistics for the shared Daraja session
+    
+    Returns:
+        list: One dict per host pool with connection and request counts
+    """
+    if _http_session is None:
+        return []
+    
+    stats = []
+    seen = set()
+    for adapter in _http_session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made = pool.num_requests
+            connections_opened = pool.num_connections
+            # Empty slots in the pool queue are None placeholders
+            idle = [conn for conn in list(pool.pool.queue) if conn is not None] if pool.pool is not None else []
+            stats.append({
+                'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+                'requests': requests_made,
+                'connections_opened': connections_opened,
+                'idle_connections': len(idle),
+                'max_connections': pool.pool.maxsize if pool.pool is not None else 0,
+                'reuse_rate': round(1 - connections_opened / requests_made, 4) if requests_made else 0.0,
+            })
+    return stats
+
+_callback_url = None
+_callback_url_lock = threading.Lock()
+
+def get_callback_url():
+    """
+    Resolve the M-Pesa callback URL once per process
+    
+    Production deployments use MPESA_CALLBACK_URL as-is. When MPESA_NGROK_ENABLED
+    is set (local development only), a single ngrok tunnel to MPESA_NGROK_PORT is
+    opened on first use and reused for the lifetime of the process.
+    
+    Returns:
+        str: Absolute URL of the /mpesa/callback/ endpoint
+    """
+    global _callback_url
+    
+    if _callback_url is not None:
+        return _callback_url
+    
+    with _callback_url_lock:
+        if _callback_url is None:
+            if getattr(settings, 'MPESA_NGROK_ENABLED', False):
+                _callback_url = _open_ngrok_callback_url()
+            else:
+                _callback_url = settings.MPESA_CALLBACK_URL
+            logger.info(f"M-Pesa callback URL: {_callback_url}")
+    
+    return _callback_url
+
+def _open_ngrok_callback_url():
+    """Open the development ngrok tunnel; pyngrok is only imported here"""
+    from pyngrok import conf, ngrok # type: ignore
+    
+    auth_token = getattr(settings, 'NGROK_AUTH_TOKEN', '')
+    if auth_token:
+        conf.get_default().auth_token = auth_token
+    
+    port = getattr(settings, 'MPESA_NGROK_PORT', 8000)
+    public_url = ngrok.connect(port).public_url
+    return f"{public_url}/mpesa/callback/"
+
+# STK query errorCode while the customer has not answered the prompt yet
+QUERY_PROCESSING_ERROR_CODE = '500.001.1001'
+
+# Daraja errorCodes that are business answers from a healthy API, not outages
+NON_FAILURE_ERROR_CODES = {QUERY_PROCESSING_ERROR_CODE}
+
+UNAVAILABLE_MESSAGE = 'M-Pesa payments are temporarily unavailable. Please try again in a few minutes.'
+
+
+class DarajaUnavailable(RequestException):
+    """Raised instead of calling Daraja while its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one Daraja endpoint, shared by all workers via the cache
+    
+    After MPESA_BREAKER_FAILURE_THRESHOLD failures within MPESA_BREAKER_WINDOW
+    seconds the circuit opens and calls fail fast for MPESA_BREAKER_COOLDOWN
+    seconds. It then turns half-open: one worker at a time is allowed a probe
+    call, whose success closes the circuit and whose failure reopens it.
+    State lives in the MPESA_BREAKER_CACHE_ALIAS cache, so it is only shared
+    between processes when that cache backend is (Redis, Memcached, database).
+    The ``a``-prefixed methods are for coroutines: they reach the cache
+    through its async API, so a network backend never blocks the event loop.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.failures_key = f"mpesa:breaker:{name}:failures"
+        self.open_until_key = f"mpesa:breaker:{name}:open-until"
+        self.probe_key = f"mpesa:breaker:{name}:probe"
+    
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'MPESA_BREAKER_CACHE_ALIAS', 'default')]
+    
+    @property
+    def threshold(self):
+        return getattr(settings, 'MPESA_BREAKER_FAILURE_THRESHOLD', 5)
+    
+    @property
+    def window(self):
+        return getattr(settings, 'MPESA_BREAKER_WINDOW', 60)
+    
+    @property
+    def cooldown(self):
+        return getattr(settings, 'MPESA_BREAKER_COOLDOWN', 30)
+    
+    @property
+    def probe_timeout(self):
+        connect_timeout, read_timeout = get_http_timeout()
+        return int(connect_timeout + read_timeout) + 1
+    
+    @staticmethod
+    def _state(open_until):
+        if open_until is None:
+            return 'closed'
+        return 'open' if time.time() < open_until else 'half_open'
+    
+    @property
+    def state(self):
+        """'closed', 'open' or 'half_open'"""
+        return self._state(self.cache.get(self.open_until_key))
+    
+    async def astate(self):
+        return self._state(await self.cache.aget(self.open_until_key))
+    
+    def is_open(self):
+        """True while calls are being rejected outright (cooldown not over)"""
+        return self.state == 'open'
+    
+    async def ais_open(self):
+        return await self.astate() == 'open'
+    
+    def allow(self):
+        """Whether a call may go out now; in half-open state only one probe may"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        return self.cache.add(self.probe_key, 1, timeout=self.probe_timeout)
+    
+    async def aallow(self):
+        state = await self.astate()
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        return await self.cache.aadd(self.probe_key, 1, timeout=self.probe_timeout)
+    
+    def record_success(self):
+        if self.cache.get(self.open_until_key) is not None:
+            logger.info(f"Daraja {self.name} circuit closed")
+            self.cache.delete_many([self.open_until_key, self.probe_key])
+        self.cache.delete(self.failures_key)
+    
+    async def arecord_success(self):
+        if await self.cache.aget(self.open_until_key) is not None:
+            logger.info(f"Daraja {self.name} circuit closed")
+            await self.cache.adelete_many([self.open_until_key, self.probe_key])
+        await self.cache.adelete(self.failures_key)
+    
+    def record_failure(self):
+        if self.state == 'half_open':
+            self.trip()
+            return
+        
+        self.cache.add(self.failures_key, 0, timeout=self.window)
+        try:
+            failures = self.cache.incr(self.failures_key)
+        except ValueError:  # expired between add and incr
+            self.cache.set(self.failures_key, 1, timeout=self.window)
+            failures = 1
+        
+        if failures >= self.threshold:
+            self.trip()
+    
+    async def arecord_failure(self):
+        # Backends only guarantee an atomic incr in the sync API, so run it in a thread
+        await sync_to_async(self.record_failure)()
+    
+    def trip(self):
+        logger.warning(f"Daraja {self.name} circuit opened for {self.cooldown}s")
+        # Keep the marker well past the cooldown so the circuit stays half-open until a probe succeeds
+        self.cache.set(self.open_until_key, time.time() + self.cooldown, timeout=self.cooldown + 3600)
+        self.cache.delete_many([self.failures_key, self.probe_key])
+    
+    def reset(self):
+        self.cache.delete_many([self.failures_key, self.open_until_key, self.probe_key])
+
+circuit_breakers = {name: CircuitBreaker(name) for name in ('oauth', 'stk_push', 'query')}
+
+def payments_available():
+    """False while Daraja is known to be down, so payment views can fail fast"""
+    return not (circuit_breakers['oauth'].is_open() or circuit_breakers['stk_push'].is_open())
+
+async def apayments_available():
+    """Async counterpart of payments_available"""
+    return not (await circuit_breakers['oauth'].ais_open() or await circuit_breakers['stk_push'].ais_open())
+
+def daraja_error(body):
+    """
+    errorCode and errorMessage from a Daraja error response body
+    
+    Returns:
+        tuple: (errorCode, errorMessage), None for whichever is missing
+    """
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return data.get('errorCode'), data.get('errorMessage')
+
+def is_daraja_failure(status_code, body=None):
+    """Whether a Daraja HTTP response counts against the circuit breaker"""
+    if status_code == 429:
+        return True
+    if status_code < 500:
+        return False
+    return daraja_error(body)[0] not in NON_FAILURE_ERROR_CODES
+
+def retry_delay(attempt):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    base = getattr(settings, 'MPESA_RETRY_BASE_DELAY', 0.5)
+    cap = getattr(settings, 'MPESA_RETRY_MAX_DELAY', 4)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
 class MPesaAPI:
     """
     M-Pesa API integration utility for STK Push payments
@@ -22,47 +503,138 @@ class MPesaAPI:
         self.consumer_secret = getattr(settings, 'MPESA_CONSUMER_SECRET', '')
         self.business_short_code = getattr(settings, 'MPESA_BUSINESS_SHORT_CODE', '174379')
         self.passkey = getattr(settings, 'MPESA_PASSKEY', '')
-        public_url = ngrok.connect(8000).public_url
-        self.callback_url = f"{public_url}/mpesa/callback/"
-        print(f"\n * Ngrok callback URL: {self.callback_url}\n")
-       
         
         # M-Pesa API URLs
         self.auth_url = getattr(settings, 'MPESA_AUTH_URL', 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials')
         self.stk_push_url = getattr(settings, 'MPESA_STK_PUSH_URL', 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest')
         self.query_url = getattr(settings, 'MPESA_QUERY_URL', 'https://sandbox.safaricom.co.ke/mpesa/stkpushquery/v1/query')
         
+        # Pooled keep-alive transport shared by every instance
+        self.session = get_http_session()
+        self.timeout = get_http_timeout()
+        
         # Log configuration for debugging
         logger.info(f"M-Pesa API initialized with:")
         logger.info(f"Consumer Key: {self.consumer_key[:10]}..." if self.consumer_key else "Consumer Key: NOT SET")
         logger.info(f"Business Short Code: {self.business_short_code}")
         logger.info(f"Auth URL: {self.auth_url}")
     
-    def get_access_token(self):
-        """Get OAuth access token from M-Pesa API"""
+    @property
+    def callback_url(self):
+        """URL Daraja posts STK Push results to, resolved once per process"""
+        return get_callback_url()
+    
+    def get_access_token(self, force_refresh=False):
+        """Get OAuth access token, served from the shared token cache when possible"""
+        return access_token_cache.get(self, force_refresh=force_refresh)
+    
+    def send(self, endpoint, method, url, idempotent=False, **kwargs):
+        """
+        Make a Daraja HTTP call guarded by the endpoint's circuit breaker
+        
+        Idempotent calls (OAuth, status queries) are retried up to
+        MPESA_RETRY_ATTEMPTS times with jittered exponential backoff on
+        connection errors, timeouts, 429s and 5xx responses. STK Push is never
+        retried, as a repeat would prompt the customer twice.
+        
+        Args:
+            endpoint (str): Breaker name: 'oauth', 'stk_push' or 'query'
+            method (str): HTTP method
+            url (str): Request URL
+            idempotent (bool): Whether the call is safe to retry
+        
+        Returns:
+            requests.Response: The last response received
+        
+        Raises:
+            DarajaUnavailable: The circuit is open
+            RequestException: The call failed on every attempt without a response
+        """
+        breaker = circuit_breakers[endpoint]
+        attempts = 1 + (getattr(settings, 'MPESA_RETRY_ATTEMPTS', 2) if idempotent else 0)
+        
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(retry_delay(attempt - 1))
+            if not breaker.allow():
+                raise DarajaUnavailable(f"Daraja {endpoint} circuit is open")
+            
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (RequestsConnectionError, Timeout) as e:
+                breaker.record_failure()
+                error, response = e, None
+                logger.warning(f"Daraja {endpoint} attempt {attempt + 1}/{attempts} failed: {e}")
+                continue
+            
+            if not is_daraja_failure(response.status_code, response.text):
+                breaker.record_success()
+                return response
+            
+            breaker.record_failure()
+            logger.warning(f"Daraja {endpoint} attempt {attempt + 1}/{attempts} returned {response.status_code}")
+        
+        if response is not None:
+            return response
+        raise error
+    
+    def send_authorized(self, endpoint, url, payload, access_token, idempotent=False):
+        """
+        POST to a Daraja API with a bearer token
+        
+        A 401 means Daraja rejected the token without acting on the request,
+        so the cached token is dropped and the call repeated once with a new one.
+        """
+        response = self.send(endpoint, 'POST', url, idempotent=idempotent,
+                             json=payload, headers=self.bearer_headers(access_token))
+        if response.status_code == 401:
+            logger.info("M-Pesa access token rejected, requesting a new one")
+            access_token_cache.invalidate(self)
+            access_token = self.get_access_token(force_refresh=True)
+            if access_token:
+                response = self.send(endpoint, 'POST', url, idempotent=idempotent,
+                                     json=payload, headers=self.bearer_headers(access_token))
+        return response
+    
+    def unavailable_response(self):
+        """Result returned instead of calling Daraja while its circuit is open"""
+        return {
+            'success': False,
+            'error': UNAVAILABLE_MESSAGE,
+            'error_code': 'SERVICE_UNAVAILABLE'
+        }
+    
+    def query_error_response(self, status_code, body):
+        """Result for an STK query answered with an HTTP error, keeping Daraja's errorCode"""
+        error_code, error_message = daraja_error(body)
+        if error_code == QUERY_PROCESSING_ERROR_CODE:
+            logger.info(f"STK query: {error_message or 'transaction still being processed'}")
+        else:
+            logger.error(f"Error querying STK status: HTTP {status_code} {error_code or ''} {error_message or body[:200]}")
+        return {
+            'success': False,
+            'error': error_message or f"HTTP {status_code}",
+            'error_code': error_code or f"HTTP_{status_code}",
+        }
+    
+    def request_access_token(self):
+        """
+        Request a fresh OAuth access token from M-Pesa API
+        
+        Returns:
+            tuple: (access_token, expires_in seconds), or (None, None) on failure
+        """
         try:
             # Check if credentials are set
             if not self.consumer_key or not self.consumer_secret:
                 logger.error("M-Pesa credentials not set. Please check MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET in settings.")
-                return None
-            
-            # Encode credentials
-            credentials = base64.b64encode(
-                f"{self.consumer_key}:{self.consumer_secret}".encode()
-            ).decode()
-            
-            headers = {
-                'Authorization': f'Basic {credentials}',
-                'Content-Type': 'application/json'
-            }
+                return None, None
             
             logger.info(f"Requesting access token from: {self.auth_url}")
-            logger.debug(f"Request headers: {headers}")
             
-            response = requests.get(self.auth_url, headers=headers, timeout=30)
+            response = self.send('oauth', 'GET', self.auth_url, idempotent=True, headers=self.basic_auth_headers())
             
             logger.info(f"Access token response status: {response.status_code}")
-            logger.debug(f"Access token response: {response.text}")
             
             response.raise_for_status()
             
@@ -71,20 +643,23 @@ class MPesaAPI:
             
             if access_token:
                 logger.info("Successfully obtained M-Pesa access token")
-                return access_token
+                return access_token, result.get('expires_in')
             else:
                 logger.error(f"No access token in response: {result}")
-                return None
+                return None, None
                 
+        except DarajaUnavailable as e:
+            logger.warning(f"Skipping M-Pesa access token request: {e}")
+            return None, None
         except requests.exceptions.RequestException as e:
             logger.error(f"Network error getting M-Pesa access token: {e}")
             if hasattr(e, 'response') and e.response is not None:
                 logger.error(f"Response status: {e.response.status_code}")
                 logger.error(f"Response text: {e.response.text}")
-            return None
+            return None, None
         except Exception as e:
             logger.error(f"Unexpected error getting M-Pesa access token: {e}")
-            return None
+            return None, None
     
     def generate_password(self):
         """Generate M-Pesa API password"""
@@ -109,6 +684,87 @@ class MPesaAPI:
             # Assume it's a 9-digit number starting with 7 or 1
             return '254' + phone_number
     
+    def basic_auth_headers(self):
+        """Headers for the OAuth token request"""
+        credentials = base64.b64encode(
+            f"{self.consumer_key}:{self.consumer_secret}".encode()
+        ).decode()
+        
+        return {
+            'Authorization': f'Basic {credentials}',
+            'Content-Type': 'application/json'
+        }
+    
+    def bearer_headers(self, access_token):
+        """Headers for authenticated Daraja API calls"""
+        return {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+    
+    def build_stk_push_payload(self, phone_number, amount, account_reference, transaction_desc):
+        """Build the STK Push request body"""
+        password, timestamp = self.generate_password()
+        formatted_phone = self.format_phone_number(phone_number)
+        
+        return {
+            'BusinessShortCode': self.business_short_code,
+            'Password': password,
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': int(float(amount)),  # M-Pesa expects integer
+            'PartyA': formatted_phone,
+            'PartyB': self.business_short_code,
+            'PhoneNumber': formatted_phone,
+            'CallBackURL': self.callback_url,
+            'AccountReference': account_reference,
+            'TransactionDesc': transaction_desc
+        }
+    
+    def parse_stk_push_response(self, result):
+        """Convert a Daraja STK Push response into our result dict"""
+        if result.get('ResponseCode') == '0':
+            return {
+                'success': True,
+                'checkout_request_id': result.get('CheckoutRequestID'),
+                'merchant_request_id': result.get('MerchantRequestID'),
+                'response_description': result.get('ResponseDescription'),
+                'customer_message': result.get('CustomerMessage')
+            }
+        else:
+            return {
+                'success': False,
+                'error': result.get('ResponseDescription', 'Unknown error'),
+                'error_code': result.get('ResponseCode', 'UNKNOWN')
+            }
+    
+    def build_query_payload(self, checkout_request_id):
+        """Build the STK Push status query request body"""
+        password, timestamp = self.generate_password()
+        
+        return {
+            'BusinessShortCode': self.business_short_code,
+            'Password': password,
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id
+        }
+    
+    def parse_query_response(self, result):
+        """
+        Convert a Daraja STK status query response into our result dict
+        
+        Query responses usually carry no receipt number (only the callback
+        does), so ``transaction_id`` is None unless Daraja included one.
+        """
+        metadata = {item.get('Name'): item.get('Value') for item in result.get('CallbackMetadata', {}).get('Item', [])}
+        return {
+            'success': True,
+            'result_code': result.get('ResultCode'),
+            'result_desc': result.get('ResultDesc'),
+            'transaction_id': result.get('MpesaReceiptNumber') or metadata.get('MpesaReceiptNumber'),
+            'data': result
+        }
+    
     def stk_push(self, phone_number, amount, account_reference, transaction_desc):
         """
         Initiate STK Push payment
@@ -122,41 +778,26 @@ class MPesaAPI:
         Returns:
             dict: Response with success status and transaction details
         """
+        if not payments_available():
+            return self.unavailable_response()
+        
         access_token = self.get_access_token()
         if not access_token:
+            if circuit_breakers['oauth'].state != 'closed':
+                return self.unavailable_response()
             return {
                 'success': False, 
                 'error': 'Failed to get access token. Please check M-Pesa credentials.',
                 'error_code': 'AUTH_ERROR'
             }
         
-        password, timestamp = self.generate_password()
-        formatted_phone = self.format_phone_number(phone_number)
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            'BusinessShortCode': self.business_short_code,
-            'Password': password,
-            'Timestamp': timestamp,
-            'TransactionType': 'CustomerPayBillOnline',
-            'Amount': int(float(amount)),  # M-Pesa expects integer
-            'PartyA': formatted_phone,
-            'PartyB': self.business_short_code,
-            'PhoneNumber': formatted_phone,
-            'CallBackURL': self.callback_url,
-            'AccountReference': account_reference,
-            'TransactionDesc': transaction_desc
-        }
+        payload = self.build_stk_push_payload(phone_number, amount, account_reference, transaction_desc)
         
         try:
-            logger.info(f"Initiating STK Push for {formatted_phone}, Amount: {amount}")
+            logger.info(f"Initiating STK Push for {payload['PhoneNumber']}, Amount: {amount}")
             logger.debug(f"STK Push payload: {payload}")
             
-            response = requests.post(self.stk_push_url, json=payload, headers=headers, timeout=30)
+            response = self.send_authorized('stk_push', self.stk_push_url, payload, access_token)
             
             logger.info(f"STK Push response status: {response.status_code}")
             logger.debug(f"STK Push response: {response.text}")
@@ -166,21 +807,10 @@ class MPesaAPI:
             result = response.json()
             logger.info(f"STK Push response: {result}")
             
-            if result.get('ResponseCode') == '0':
-                return {
-                    'success': True,
-                    'checkout_request_id': result.get('CheckoutRequestID'),
-                    'merchant_request_id': result.get('MerchantRequestID'),
-                    'response_description': result.get('ResponseDescription'),
-                    'customer_message': result.get('CustomerMessage')
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': result.get('ResponseDescription', 'Unknown error'),
-                    'error_code': result.get('ResponseCode', 'UNKNOWN')
-                }
-                
+            return self.parse_stk_push_response(result)
+        
+        except DarajaUnavailable:
+            return self.unavailable_response()
         except requests.exceptions.RequestException as e:
             logger.error(f"Network error during STK Push: {e}")
             if hasattr(e, 'response') and e.response is not None:
@@ -210,39 +840,41 @@ class MPesaAPI:
         """
         access_token = self.get_access_token()
         if not access_token:
+            if circuit_breakers['oauth'].state != 'closed':
+                return self.unavailable_response()
             return {'success': False, 'error': 'Failed to get access token'}
         
-        password, timestamp = self.generate_password()
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            'BusinessShortCode': self.business_short_code,
-            'Password': password,
-            'Timestamp': timestamp,
-            'CheckoutRequestID': checkout_request_id
-        }
+        payload = self.build_query_payload(checkout_request_id)
         
         try:
-            response = requests.post(self.query_url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            return {
-                'success': True,
-                'result_code': result.get('ResultCode'),
-                'result_desc': result.get('ResultDesc'),
-                'data': result
-            }
+            response = self.send_authorized('query', self.query_url, payload, access_token, idempotent=True)
+            if response.status_code >= 400:
+                return self.query_error_response(response.status_code, response.text)
             
+            return self.parse_query_response(response.json())
+        
+        except DarajaUnavailable:
+            return self.unavailable_response()
         except Exception as e:
             logger.error(f"Error querying STK status: {e}")
             return {'success': False, 'error': str(e)}
 
 # Payment processing functions
+def build_payment_reference(booking_id=None):
+    """
+    Account reference and description shown to the customer on the STK prompt
+    
+    Returns:
+        tuple: (account_reference, transaction_desc)
+    """
+    if booking_id:
+        account_reference = f'BOOKING-{booking_id}'
+        transaction_desc = f'Payment for booking #{booking_id} - WAFUNGI-NATION'
+    else:
+        account_reference = f'PAYMENT-{timezone.now().strftime("%Y%m%d%H%M%S")}'
+        transaction_desc = 'Payment - WAFUNGI-NATION'
+    return account_reference, transaction_desc
+
 def process_mpesa_payment(phone_number, amount, booking_id=None, recipient_phone=None):
     """
     Process M-Pesa payment for a booking
@@ -257,14 +889,7 @@ def process_mpesa_payment(phone_number, amount, booking_id=None, recipient_phone
         dict: Payment processing result
     """
     mpesa = MPesaAPI()
-    
-    # Format the account reference and description
-    if booking_id:
-        account_reference = f'BOOKING-{booking_id}'
-        transaction_desc = f'Payment for booking #{booking_id} - WAFUNGI-NATION'
-    else:
-        account_reference = f'PAYMENT-{timezone.now().strftime("%Y%m%d%H%M%S")}'
-        transaction_desc = 'Payment - WAFUNGI-NATION'
+    account_reference, transaction_desc = build_payment_reference(booking_id)
     
     result = mpesa.stk_push(
         phone_number=phone_number,
@@ -331,6 +956,7 @@ def handle_mpesa_callback(callback_data):
             return {
                 'success': False,
                 'error': result_desc,
+                'result_code': result_code,
                 'checkout_request_id': checkout_request_id
             }
             
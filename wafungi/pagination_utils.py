@@ -0,0 +1,164 @@
+"""
+Keyset (cursor) pagination for listing pages and their JSON APIs
+
+Instead of COUNT(*) plus OFFSET, each page asks for the rows after (or
+before) the sort key of the last row shown, which an index on the ordering
+columns answers in constant time however deep the page. Cursors are signed,
+opaque strings; a tampered or stale cursor just starts from the first page.
+Total counts are only computed when asked for.
+"""
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+CURSOR_SALT = 'wafungi.pagination.cursor'
+
+# Orderings of the listing pages; the trailing id makes every key unique
+MUSICIAN_ORDERING = ('-rating', '-total_gigs', 'id')
+EVENT_ORDERING = ('date', 'id')
+RECENT_ORDERING = ('-created_at', 'id')
+APPLICATION_ORDERING = ('-applied_at', 'id')
+SEARCH_ORDERING = ('search_rank', 'id')
+
+
+class CursorPage:
+    """One page of results plus the cursors of its neighbours"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+
+def _keys(ordering):
+    return [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+
+def _to_json(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(obj, ordering, backwards=False):
+    """Opaque cursor pointing just past (or before) ``obj`` in ``ordering``"""
+    values = [_to_json(getattr(obj, name)) for name, _ in _keys(ordering)]
+    return signing.dumps({'v': values, 'b': backwards}, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor, model, ordering):
+    """
+    Sort key and direction stored in a cursor
+
+    Returns:
+        tuple: (values, backwards), or (None, False) for a missing or invalid cursor
+    """
+    if not cursor:
+        return None, False
+    try:
+        payload = signing.loads(cursor, salt=CURSOR_SALT)
+        keys = _keys(ordering)
+        if len(payload['v']) != len(keys):
+            return None, False
+        values = []
+        for (name, _), value in zip(keys, payload['v']):
+            try:
+                value = model._meta.get_field(name).to_python(value)
+            except FieldDoesNotExist:
+                pass  # annotations such as search_rank are stored as plain JSON
+            values.append(value)
+        return values, bool(payload['b'])
+    except (signing.BadSignature, KeyError, TypeError, ValidationError):
+        return None, False
+
+
+def _after(keys, values, backwards):
+    """Q matching rows that sort after ``values`` (before, when ``backwards``)"""
+    condition = Q(pk__in=[])
+    equal = Q()
+    for (name, descending), value in zip(keys, values):
+        lookup = 'lt' if descending != backwards else 'gt'
+        condition |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+def paginate_by_cursor(queryset, ordering, cursor=None, per_page=12, count=None):
+    """
+    Fetch the page of ``queryset`` that ``cursor`` points at
+
+    Args:
+        queryset: Filtered queryset; its own ordering is replaced by ``ordering``
+        ordering (tuple): Field names, '-' for descending, ending in a unique field
+        cursor (str, optional): next_cursor/previous_cursor of another page
+        per_page (int): Page size
+        count: True to COUNT the matching rows, or an already known total
+
+    Returns:
+        CursorPage
+    """
+    keys = _keys(ordering)
+    values, backwards = decode_cursor(cursor, queryset.model, ordering)
+
+    if count is True:
+        count = queryset.count()
+
+    page_ordering = ordering
+    if backwards:
+        page_ordering = [name[1:] if name.startswith('-') else f'-{name}' for name in ordering]
+    page = queryset.order_by(*page_ordering)
+    if values is not None:
+        page = page.filter(_after(keys, values, backwards))
+
+    rows = list(page[:per_page + 1])
+    if backwards and not rows:
+        # Everything before the cursor is gone: start over
+        return paginate_by_cursor(queryset, ordering, None, per_page, count)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, values is not None
+
+    return CursorPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1], ordering) if rows and has_next else None,
+        previous_cursor=encode_cursor(rows[0], ordering, backwards=True) if rows and has_previous else None,
+        count=count,
+    )
+
+
+def cursor_page(request, queryset, ordering, per_page, count=None):
+    """
+    paginate_by_cursor driven by the ``cursor`` and ``count`` query parameters
+
+    ``?count=1`` asks for an exact total when none is known already.
+    """
+    if count is None and request.GET.get('count') in ('1', 'true'):
+        count = True
+    return paginate_by_cursor(queryset, ordering, request.GET.get('cursor'), per_page, count)
@@ -0,0 +1,94 @@
+"""
+Wake-ups for clients waiting on an M-Pesa payment's status
+
+Every change to a payment (callback stored, transaction completed or failed)
+bumps a per-CheckoutRequestID version counter in the cache and sets the
+asyncio events of waiters in this process. Waiters in the same process are
+woken immediately; waiters in other processes notice the new version on
+their next cache check (every MPESA_STATUS_POLL_INTERVAL seconds, through
+the cache's async API so the event loop is never blocked), which requires
+MPESA_EVENTS_CACHE_ALIAS to be a shared cache backend.
+"""
+import asyncio
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+# Versions only need to outlive the payment prompt and a slow callback
+VERSION_TIMEOUT = 3600
+
+
+def _cache():
+    return caches[getattr(settings, 'MPESA_EVENTS_CACHE_ALIAS', 'default')]
+
+
+def _version_key(checkout_request_id):
+    return f"mpesa:payment-events:{checkout_request_id}"
+
+
+async def aget_payment_version(checkout_request_id):
+    """Current event version for a payment, 0 if nothing has happened yet"""
+    return await _cache().aget(_version_key(checkout_request_id), 0)
+
+
+def notify_payment_update(checkout_request_id):
+    """Record that a payment changed and wake everyone waiting on it"""
+    cache = _cache()
+    key = _version_key(checkout_request_id)
+    if not cache.add(key, 1, timeout=VERSION_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:  # expired between add and incr
+            cache.set(key, 1, timeout=VERSION_TIMEOUT)
+
+    with _waiters_lock:
+        waiters = list(_waiters.get(checkout_request_id, ()))
+    for loop, event in waiters:
+        loop.call_soon_threadsafe(event.set)
+
+
+async def wait_for_payment_update(checkout_request_id, version, timeout):
+    """
+    Wait until a payment's event version moves past ``version``
+
+    Args:
+        checkout_request_id (str): CheckoutRequestID of the payment
+        version (int): Version the caller has already seen
+        timeout (float): Maximum seconds to wait
+
+    Returns:
+        int: The new version, or None if nothing changed before the timeout
+    """
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    waiter = (loop, event)
+    interval = getattr(settings, 'MPESA_STATUS_POLL_INTERVAL', 0.25)
+    deadline = loop.time() + timeout
+
+    with _waiters_lock:
+        _waiters.setdefault(checkout_request_id, set()).add(waiter)
+    try:
+        while True:
+            current = await aget_payment_version(checkout_request_id)
+            if current != version:
+                return current
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(event.wait(), min(interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        with _waiters_lock:
+            waiters = _waiters.get(checkout_request_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del _waiters[checkout_request_id]
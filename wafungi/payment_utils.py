@@ -0,0 +1,349 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from django.utils import timezone
+from datetime import timedelta
+from functools import partial
+import logging
+
+from .models import Booking, MpesaCallback, Notification, PaymentTransaction
+from .email_utils import send_payment_receipt_email
+from .mpesa_utils import handle_mpesa_callback
+from .payment_events import notify_payment_update
+from .summary_utils import contributions, rows_changed, rows_created
+
+logger = logging.getLogger(__name__)
+
+# M-Pesa result codes that mean the customer dismissed the STK prompt
+CANCELLED_RESULT_CODES = {'1032'}
+
+def complete_payment(checkout_request_id, receipt_number, payment_details=None):
+    """
+    Mark an M-Pesa transaction and its booking as paid, exactly once
+    
+    The transaction row is locked for the duration of the update, and the
+    status change only applies while the transaction is not yet completed, so
+    duplicate callbacks, retries and the demo simulation path can race safely.
+    The receipt email is sent only after the winning update commits.
+    
+    Args:
+        checkout_request_id (str): CheckoutRequestID from the STK Push
+        receipt_number (str): MpesaReceiptNumber, blank if not known
+        payment_details (dict, optional): Extra details for the receipt email
+    
+    Returns:
+        tuple: (PaymentTransaction or None, bool whether this call applied it)
+    """
+    with db_transaction.atomic():
+        transaction = (
+            PaymentTransaction.objects.select_for_update()
+            .select_related('booking', 'booking__client', 'booking__musician',
+                            'booking__instrument_listing__owner')
+            .filter(checkout_request_id=checkout_request_id)
+            .first()
+        )
+        if transaction is None:
+            logger.error(f"Transaction not found for checkout_request_id: {checkout_request_id}")
+            return None, False
+        
+        if transaction.status == 'completed':
+            if receipt_number and not transaction.transaction_id:
+                _record_receipt(transaction, receipt_number)
+            logger.info(f"Duplicate completion ignored for {checkout_request_id}")
+            return transaction, False
+        
+        receipt_number = receipt_number or ''
+        try:
+            with db_transaction.atomic():
+                updated = PaymentTransaction.objects.filter(
+                    pk=transaction.pk
+                ).exclude(status='completed').update(
+                    status='completed',
+                    transaction_id=receipt_number,
+                    updated_at=timezone.now(),
+                )
+        except IntegrityError:
+            # Receipt number already recorded against another transaction
+            logger.warning(f"Duplicate M-Pesa receipt {receipt_number} ignored for {checkout_request_id}")
+            return transaction, False
+        
+        if not updated:
+            return transaction, False
+        
+        transaction.status = 'completed'
+        transaction.transaction_id = receipt_number
+        
+        booking = transaction.booking
+        before = contributions(Booking, [booking.pk])
+        Booking.objects.filter(pk=booking.pk).update(payment_status=True, updated_at=timezone.now())
+        booking.payment_status = True
+        rows_changed(Booking, [booking.pk], before)
+        
+        notifications = Notification.objects.bulk_create(_payment_notifications(booking))
+        rows_created(Notification, [notification.pk for notification in notifications])
+        
+        details = {
+            'transaction_id': receipt_number,
+            'payment_date': timezone.now(),
+            'amount': booking.total_amount,
+            'phone_number': transaction.phone_number,
+        }
+        details.update(payment_details or {})
+        db_transaction.on_commit(lambda: notify_payment_update(checkout_request_id))
+        db_transaction.on_commit(lambda: send_payment_receipt_email(booking, details))
+    
+    logger.info(f"Payment completed for booking {booking.id}")
+    return transaction, True
+
+def _record_receipt(transaction, receipt_number):
+    """Fill in the receipt of a payment that was completed before its callback arrived"""
+    try:
+        with db_transaction.atomic():
+            updated = PaymentTransaction.objects.filter(pk=transaction.pk, transaction_id='').update(
+                transaction_id=receipt_number, updated_at=timezone.now()
+            )
+    except IntegrityError:
+        logger.warning(f"Duplicate M-Pesa receipt {receipt_number} ignored for {transaction.checkout_request_id}")
+        return
+    if updated:
+        transaction.transaction_id = receipt_number
+        logger.info(f"Recorded M-Pesa receipt {receipt_number} for {transaction.checkout_request_id}")
+
+def fail_payment(checkout_request_id, result_code=None, mpesa_response=None):
+    """
+    Mark a pending M-Pesa transaction as failed or cancelled
+    
+    Completed transactions are never downgraded, so a late failure callback
+    cannot undo a payment that already went through.
+    
+    Returns:
+        bool: Whether the transaction was updated
+    """
+    status = 'cancelled' if str(result_code) in CANCELLED_RESULT_CODES else 'failed'
+    fields = {'status': status, 'updated_at': timezone.now()}
+    if mpesa_response is not None:
+        fields['mpesa_response'] = mpesa_response
+    
+    updated = PaymentTransaction.objects.filter(
+        checkout_request_id=checkout_request_id,
+        status='pending',
+    ).update(**fields)
+    
+    if updated:
+        logger.info(f"Payment {status} for transaction {checkout_request_id}")
+        db_transaction.on_commit(lambda: notify_payment_update(checkout_request_id))
+    return bool(updated)
+
+def settle_payments_in_bulk(completed=None, failed_ids=(), cancelled_ids=()):
+    """
+    Apply reconciled STK query outcomes to many transactions at once
+    
+    Completions lock the affected rows, flip transactions and bookings with
+    one UPDATE each and bulk-insert notifications; receipt numbers Daraja
+    reported are recorded like a late callback's, and receipts go out after
+    commit. Failures only touch transactions that are still pending, so
+    rows settled meanwhile by a callback are left alone and not notified.
+    
+    Args:
+        completed (dict): CheckoutRequestIDs Daraja reports as paid, mapped
+            to their MpesaReceiptNumber (None if the query carried none)
+        failed_ids (iterable): CheckoutRequestIDs that failed
+        cancelled_ids (iterable): CheckoutRequestIDs the customer cancelled
+    
+    Returns:
+        dict: Number of transactions moved to each status
+    """
+    counts = {'completed': 0, 'failed': 0, 'cancelled': 0}
+    completed = completed or {}
+    now = timezone.now()
+    
+    if completed:
+        with db_transaction.atomic():
+            transactions = list(
+                PaymentTransaction.objects.select_for_update()
+                .select_related('booking', 'booking__client', 'booking__musician',
+                                'booking__instrument_listing__owner')
+                .filter(checkout_request_id__in=list(completed))
+                .exclude(status='completed')
+            )
+            if transactions:
+                PaymentTransaction.objects.filter(
+                    pk__in=[t.pk for t in transactions]
+                ).update(status='completed', updated_at=now)
+                booking_ids = {t.booking_id for t in transactions}
+                before = contributions(Booking, booking_ids)
+                Booking.objects.filter(pk__in=booking_ids).update(payment_status=True, updated_at=now)
+                rows_changed(Booking, booking_ids, before)
+                
+                notifications = []
+                for transaction in transactions:
+                    transaction.status = 'completed'
+                    transaction.booking.payment_status = True
+                    receipt_number = completed[transaction.checkout_request_id]
+                    if receipt_number and not transaction.transaction_id:
+                        _record_receipt(transaction, receipt_number)
+                    notifications.extend(_payment_notifications(transaction.booking))
+                notifications = Notification.objects.bulk_create(notifications)
+                rows_created(Notification, [notification.pk for notification in notifications])
+                
+                def notify_and_send_receipts():
+                    for transaction in transactions:
+                        notify_payment_update(transaction.checkout_request_id)
+                        send_payment_receipt_email(transaction.booking, {
+                            'transaction_id': transaction.transaction_id,
+                            'payment_date': now,
+                            'amount': transaction.booking.total_amount,
+                            'phone_number': transaction.phone_number,
+                        })
+                db_transaction.on_commit(notify_and_send_receipts)
+            counts['completed'] = len(transactions)
+    
+    for status, ids in (('failed', failed_ids), ('cancelled', cancelled_ids)):
+        if ids:
+            with db_transaction.atomic():
+                changed = list(
+                    PaymentTransaction.objects.select_for_update()
+                    .filter(checkout_request_id__in=list(ids), status='pending')
+                    .values_list('checkout_request_id', flat=True)
+                )
+                if changed:
+                    PaymentTransaction.objects.filter(
+                        checkout_request_id__in=changed
+                    ).update(status=status, updated_at=now)
+                    for checkout_request_id in changed:
+                        db_transaction.on_commit(partial(notify_payment_update, checkout_request_id))
+            counts[status] = len(changed)
+    
+    return counts
+
+def _payment_notifications(booking):
+    """Unsaved notifications for the service provider and client about a payment"""
+    notifications = []
+    
+    service_provider = booking.get_service_provider()
+    if service_provider:
+        if booking.instrument_listing:
+            item_name = f"{booking.instrument_listing.brand} {booking.instrument_listing.model}"
+        else:
+            item_name = "musician booking"
+        
+        notifications.append(Notification(
+            user=service_provider,
+            title='Payment Received',
+            message=f'Payment of KSH {booking.total_amount:,.0f} has been received for the {item_name} booking.'
+        ))
+    
+    notifications.append(Notification(
+        user=booking.client,
+        title='Payment Successful',
+        message=f'Your payment of KSH {booking.total_amount:,.0f} was successful. Receipt sent to your email.'
+    ))
+    
+    return notifications
+
+# Callback inbox
+def store_mpesa_callback(callback_data):
+    """
+    Persist a raw M-Pesa callback for the worker to process
+    
+    This is the only work done before acknowledging Safaricom, so the ack
+    does not wait on row locks, templates or SMTP.
+    """
+    stk_callback = callback_data.get('Body', {}).get('stkCallback', {}) if isinstance(callback_data, dict) else {}
+    callback = MpesaCallback.objects.create(
+        checkout_request_id=str(stk_callback.get('CheckoutRequestID') or '')[:100],
+        payload=callback_data,
+    )
+    # Let a waiting status page apply it straight away instead of waiting for the worker
+    if callback.checkout_request_id:
+        db_transaction.on_commit(lambda: notify_payment_update(callback.checkout_request_id))
+    return callback
+
+def process_callback_inbox(batch_size=50, checkout_request_id=None):
+    """
+    Claim and process a batch of due callbacks from the inbox
+    
+    Rows are leased by moving them to ``processing`` with a future
+    ``next_attempt_at``, so a crashed worker's batch becomes due again once
+    the lease expires. Failures are retried with exponential backoff until
+    MPESA_CALLBACK_MAX_ATTEMPTS is reached.
+    
+    Args:
+        batch_size (int): Maximum callbacks to claim
+        checkout_request_id (str, optional): Only process callbacks for this transaction
+    
+    Returns:
+        dict: Counts of processed, retried and failed callbacks
+    """
+    callbacks = _claim_callbacks(batch_size, checkout_request_id)
+    counts = {'claimed': len(callbacks), 'processed': 0, 'retried': 0, 'failed': 0}
+    
+    for callback in callbacks:
+        try:
+            _apply_callback(callback.payload)
+        except Exception as e:
+            logger.error(f"Error processing M-Pesa callback {callback.id}: {e}")
+            counts[_schedule_retry(callback, e)] += 1
+        else:
+            MpesaCallback.objects.filter(pk=callback.pk).update(
+                status='processed', processed_at=timezone.now(), last_error=''
+            )
+            counts['processed'] += 1
+    
+    return counts
+
+def _claim_callbacks(batch_size, checkout_request_id=None):
+    now = timezone.now()
+    lease = timedelta(seconds=getattr(settings, 'MPESA_CALLBACK_LEASE_SECONDS', 300))
+    
+    due = MpesaCallback.objects.filter(
+        status__in=['pending', 'processing'],
+        next_attempt_at__lte=now,
+    )
+    if checkout_request_id:
+        due = due.filter(checkout_request_id=checkout_request_id)
+    
+    # Cheap read first so idle polls never take a write lock
+    if not due.exists():
+        return []
+    
+    with db_transaction.atomic():
+        due = due.select_for_update(skip_locked=True)
+        callbacks = list(due.order_by('next_attempt_at', 'id')[:batch_size])
+        if callbacks:
+            MpesaCallback.objects.filter(pk__in=[c.pk for c in callbacks]).update(
+                status='processing', next_attempt_at=now + lease
+            )
+    
+    return callbacks
+
+def _apply_callback(callback_data):
+    """Apply a stored callback to its transaction; safe to repeat"""
+    result = handle_mpesa_callback(callback_data)
+    
+    if result['success']:
+        complete_payment(result['checkout_request_id'], result['transaction_id'], result)
+    elif result.get('checkout_request_id'):
+        fail_payment(result['checkout_request_id'], result.get('result_code'), callback_data)
+    else:
+        raise ValueError(f"Malformed M-Pesa callback: {result.get('error')}")
+
+def _schedule_retry(callback, error):
+    """Back off exponentially, giving up after MPESA_CALLBACK_MAX_ATTEMPTS"""
+    attempts = callback.attempts + 1
+    max_attempts = getattr(settings, 'MPESA_CALLBACK_MAX_ATTEMPTS', 8)
+    
+    if attempts >= max_attempts:
+        MpesaCallback.objects.filter(pk=callback.pk).update(
+            status='failed', attempts=attempts, last_error=str(error)
+        )
+        return 'failed'
+    
+    base_delay = getattr(settings, 'MPESA_CALLBACK_RETRY_DELAY', 5)
+    delay = min(base_delay * (2 ** (attempts - 1)), 3600)
+    MpesaCallback.objects.filter(pk=callback.pk).update(
+        status='pending',
+        attempts=attempts,
+        last_error=str(error),
+        next_attempt_at=timezone.now() + timedelta(seconds=delay),
+    )
+    return 'retried'
@@ -0,0 +1,400 @@
+"""
+Full-text search over musicians, instrument listings and events
+
+Every searchable object has a SearchDocument row (title + body text) that
+signals keep up to date. Queries go to the best engine available:
+
+* SQLite: the FTS5 table created in migration 0007, ranked with bm25
+* PostgreSQL: the GIN-indexed ``search_vector`` column, ranked with ts_rank
+* anything else: an in-process inverted index built from SearchDocument rows
+
+Every query term is matched as a prefix and all terms must match, so "gui"
+finds guitarists just like the old ``icontains`` filters did. Musician and
+instrument searches that match nothing fall back to fuzzy_utils.
+"""
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from . import fuzzy_utils
+from .models import Event, InstrumentListing, MusicianProfile, SearchDocument
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'wafungi_searchdocument_fts'
+
+# Title matches count this many times more than body matches
+TITLE_WEIGHT = 10.0
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Lowercase, accent-free word tokens of a piece of text"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _TOKEN_RE.findall(text.lower())
+
+
+# Documents
+
+def musician_document(profile):
+    user = profile.user
+    title = ' '.join(filter(None, [profile.stage_name, user.first_name, user.last_name]))
+    body = ' '.join(
+        [user.bio]
+        + [genre.name for genre in profile.genres.all()]
+        + [instrument.name for instrument in profile.instruments.all()]
+    )
+    return title, body
+
+
+def instrument_document(listing):
+    return f"{listing.brand} {listing.model} {listing.instrument.name}", listing.description
+
+
+def event_document(event):
+    return event.title, event.description
+
+
+SEARCH_KINDS = {
+    'musician': (MusicianProfile, musician_document, ('user',), ('genres', 'instruments')),
+    'instrument': (InstrumentListing, instrument_document, ('instrument',), ()),
+    'event': (Event, event_document, (), ()),
+}
+
+
+def index_object(kind, obj):
+    """Create or refresh the search document for a model instance"""
+    title, body = SEARCH_KINDS[kind][1](obj)
+    SearchDocument.objects.update_or_create(
+        kind=kind, object_id=obj.pk, defaults={'title': title, 'body': body}
+    )
+    backend = get_backend()
+    transaction.on_commit(lambda: backend.document_changed(kind, obj.pk, title, body))
+    transaction.on_commit(lambda: fuzzy_utils.document_changed(kind, obj.pk, title))
+
+
+def remove_object(kind, object_id):
+    """Drop the search document of a deleted instance"""
+    SearchDocument.objects.filter(kind=kind, object_id=object_id).delete()
+    backend = get_backend()
+    transaction.on_commit(lambda: backend.document_removed(kind, object_id))
+    transaction.on_commit(lambda: fuzzy_utils.document_removed(kind, object_id))
+
+
+def rebuild_index(kinds=None, batch_size=1000):
+    """
+    Regenerate the search documents of every object of the given kinds
+
+    Returns:
+        dict: Number of documents written per kind
+    """
+    counts = {}
+    for kind in kinds or SEARCH_KINDS:
+        model, build, related, prefetch = SEARCH_KINDS[kind]
+        queryset = model.objects.select_related(*related).prefetch_related(*prefetch).order_by('pk')
+
+        with transaction.atomic():
+            SearchDocument.objects.filter(kind=kind).delete()
+            batch = []
+            counts[kind] = 0
+            for obj in queryset.iterator(chunk_size=batch_size):
+                title, body = build(obj)
+                batch.append(SearchDocument(kind=kind, object_id=obj.pk, title=title, body=body))
+                if len(batch) >= batch_size:
+                    SearchDocument.objects.bulk_create(batch)
+                    counts[kind] += len(batch)
+                    batch = []
+            SearchDocument.objects.bulk_create(batch)
+            counts[kind] += len(batch)
+
+    get_backend().reset()
+    fuzzy_utils.reset()
+    return counts
+
+
+# Query engines
+
+class SearchBackend:
+    """Runs ranked queries against the search documents"""
+
+    name = None
+
+    def search(self, kind, terms, limit):
+        """Object ids of ``kind`` matching every term as a prefix, best first"""
+        raise NotImplementedError
+
+    def document_changed(self, kind, object_id, title, body):
+        pass
+
+    def document_removed(self, kind, object_id):
+        pass
+
+    def reset(self):
+        pass
+
+
+class SQLiteFTSBackend(SearchBackend):
+    name = 'sqlite_fts'
+
+    def search(self, kind, terms, limit):
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT d.object_id FROM {FTS_TABLE} "
+                f"JOIN wafungi_searchdocument d ON d.id = {FTS_TABLE}.rowid "
+                f"WHERE {FTS_TABLE} MATCH %s AND d.kind = %s "
+                f"ORDER BY bm25({FTS_TABLE}, {TITLE_WEIGHT}, 1.0) LIMIT %s",
+                [match, kind, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresBackend(SearchBackend):
+    name = 'postgres'
+
+    def search(self, kind, terms, limit):
+        query = ' & '.join(f"{term}:*" for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT object_id FROM wafungi_searchdocument "
+                "WHERE kind = %s AND search_vector @@ to_tsquery('simple', %s) "
+                "ORDER BY ts_rank(search_vector, to_tsquery('simple', %s)) DESC LIMIT %s",
+                [kind, query, query, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndex:
+    """Term -> {object_id: weight} postings with a sorted vocabulary for prefix lookups"""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self._vocabulary = None
+
+    def add(self, object_id, title, body):
+        self.remove(object_id)
+        weights = defaultdict(float)
+        for term in tokenize(title):
+            weights[term] += TITLE_WEIGHT
+        for term in tokenize(body):
+            weights[term] += 1.0
+        for term, weight in weights.items():
+            if term not in self.postings:
+                self._vocabulary = None
+            self.postings[term][object_id] = weight
+        self.documents[object_id] = tuple(weights)
+
+    def remove(self, object_id):
+        for term in self.documents.pop(object_id, ()):
+            posting = self.postings[term]
+            posting.pop(object_id, None)
+            if not posting:
+                del self.postings[term]
+                self._vocabulary = None
+
+    def expand(self, prefix):
+        """Indexed terms starting with ``prefix``"""
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        start = bisect_left(self._vocabulary, prefix)
+        terms = []
+        for term in self._vocabulary[start:]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, terms, limit):
+        total = len(self.documents)
+        scores = None
+        for term in terms:
+            term_scores = defaultdict(float)
+            for word in self.expand(term):
+                posting = self.postings[word]
+                idf = math.log(1 + total / len(posting))
+                for object_id, weight in posting.items():
+                    term_scores[object_id] += weight * idf
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {object_id: score + term_scores[object_id]
+                          for object_id, score in scores.items() if object_id in term_scores}
+            if not scores:
+                return []
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+
+class PythonBackend(SearchBackend):
+    """
+    In-process inverted index for databases without a full-text engine
+
+    Loaded lazily from SearchDocument rows and updated in place on changes
+    made by this process; changes from other processes bump a version in
+    the cache, which makes every other process reload on its next query.
+    That only reaches other processes through a shared cache, so indexes
+    are also reloaded after SEARCH_INDEX_MAX_AGE seconds.
+    """
+
+    name = 'python'
+    VERSION_KEY = 'search:index-version'
+
+    def __init__(self):
+        self.indexes = {}
+        self.version = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def index(self, kind):
+        with self.lock:
+            version = cache.get(self.VERSION_KEY, 0)
+            now = time.monotonic()
+            if version != self.version or now >= self.expires_at:
+                self.indexes = {}
+                self.version = version
+                self.expires_at = now + getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+            index = self.indexes.get(kind)
+            if index is None:
+                index = InvertedIndex()
+                for object_id, title, body in SearchDocument.objects.filter(kind=kind).values_list(
+                    'object_id', 'title', 'body'
+                ).iterator(chunk_size=2000):
+                    index.add(object_id, title, body)
+                self.indexes[kind] = index
+            return index
+
+    def search(self, kind, terms, limit):
+        index = self.index(kind)
+        with self.lock:
+            return index.search(terms, limit)
+
+    def bump_version(self):
+        if not cache.add(self.VERSION_KEY, 1, timeout=None):
+            try:
+                cache.incr(self.VERSION_KEY)
+            except ValueError:
+                cache.set(self.VERSION_KEY, 1, timeout=None)
+        # Our own indexes are already current
+        self.version = cache.get(self.VERSION_KEY, 0)
+
+    def document_changed(self, kind, object_id, title, body):
+        with self.lock:
+            if kind in self.indexes:
+                self.indexes[kind].add(object_id, title, body)
+            self.bump_version()
+
+    def document_removed(self, kind, object_id):
+        with self.lock:
+            if kind in self.indexes:
+                self.indexes[kind].remove(object_id)
+            self.bump_version()
+
+    def reset(self):
+        with self.lock:
+            self.indexes = {}
+            self.bump_version()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Search engine for the default database
+
+    SEARCH_BACKEND may force 'sqlite_fts', 'postgres' or 'python'; the
+    default 'auto' uses the database's own engine when it is available.
+    """
+    name = getattr(settings, 'SEARCH_BACKEND', 'auto')
+    if name == 'auto':
+        if connection.vendor == 'postgresql':
+            name = 'postgres'
+        elif connection.vendor == 'sqlite' and _has_fts_table():
+            name = 'sqlite_fts'
+        else:
+            name = 'python'
+
+    with _backends_lock:
+        if name not in _backends:
+            backend_class = {cls.name: cls for cls in (SQLiteFTSBackend, PostgresBackend, PythonBackend)}[name]
+            _backends[name] = backend_class()
+        return _backends[name]
+
+
+_fts_table_present = None
+
+
+def _has_fts_table():
+    global _fts_table_present
+    if _fts_table_present is None:
+        with connection.cursor() as cursor:
+            _fts_table_present = FTS_TABLE in connection.introspection.table_names(cursor)
+    return _fts_table_present
+
+
+def search_ids(kind, query, limit=None):
+    """
+    Ranked ids of the objects of ``kind`` matching a free-text query
+
+    Args:
+        kind (str): 'musician', 'instrument' or 'event'
+        query (str): User input
+        limit (int, optional): Maximum ids, SEARCH_MAX_RESULTS by default
+
+    Returns:
+        list: Object ids, best match first; None if the query has no words
+    """
+    terms = tokenize(query)
+    if not terms:
+        return None
+    return get_backend().search(kind, terms, limit or getattr(settings, 'SEARCH_MAX_RESULTS', 1000))
+
+
+def matching_ids(kind, query):
+    """
+    Ranked ids for a search box query, falling back to fuzzy matches
+
+    Returns:
+        list: Object ids, best match first; None if the query has no words
+    """
+    ids = search_ids(kind, query)
+    if ids == []:
+        ids = fuzzy_utils.fuzzy_search_ids(kind, tokenize(query))
+    return ids
+
+
+def filter_ranked(queryset, ids):
+    """
+    Narrow a queryset to ``ids`` in the given order; None leaves it untouched
+
+    The position is annotated as ``search_rank`` so pages can be keyed on it.
+    """
+    if ids is None:
+        return queryset
+    if not ids:
+        return queryset.annotate(search_rank=Value(0, output_field=IntegerField())).none()
+    ranking = Case(*[When(pk=pk, then=position) for position, pk in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(pk__in=ids).annotate(search_rank=ranking).order_by('search_rank')
+
+
+def apply_search(queryset, kind, query):
+    """
+    Narrow a queryset to full-text matches for ``query``, best matches first
+
+    Musicians and instruments fall back to fuzzy matches when nothing matches exactly.
+    """
+    return filter_ranked(queryset, matching_ids(kind, query))
@@ -0,0 +1,249 @@
+"""
+Model signal handlers that keep derived data in sync
+"""
+from collections import Counter
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .availability_utils import booking_changed, booking_footprint, invalidate_availability
+from .facet_utils import facet_object_changed, facet_value_changed, facet_value_removed, invalidate_facets
+from .geo_utils import geocode
+from .models import Booking, Event, EventApplication, Genre, Instrument, InstrumentListing, MusicianProfile, Notification, User
+from .search_utils import index_object, remove_object
+from .summary_utils import apply, contributions, counted_fields, rows_changed
+from .typeahead_utils import suggestion_changed, suggestion_removed
+
+# Locations
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=InstrumentListing)
+@receiver(pre_save, sender=Event)
+def locate(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Gazetteer town, coordinates and grid cell of the location text"""
+    if raw or (update_fields is not None and 'location' not in update_fields):
+        return
+    instance.town, instance.latitude, instance.longitude, instance.geo_cell = geocode(instance.location)
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=InstrumentListing)
+@receiver(post_save, sender=Event)
+def save_location_fields(sender, instance, raw=False, update_fields=None, **kwargs):
+    """save(update_fields=['location']) leaves out what locate() filled in"""
+    if raw or update_fields is None or 'location' not in update_fields or 'geo_cell' in update_fields:
+        return
+    sender.objects.filter(pk=instance.pk).update(
+        town=instance.town, latitude=instance.latitude, longitude=instance.longitude, geo_cell=instance.geo_cell
+    )
+
+# Search index and typeahead suggestions
+
+@receiver(post_save, sender=MusicianProfile)
+def index_musician(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_object('musician', instance)
+        suggestion_changed('musician', instance)
+
+@receiver(post_save, sender=InstrumentListing)
+def index_instrument_listing(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_object('instrument', instance)
+        suggestion_changed('instrument', instance)
+
+@receiver(post_save, sender=Event)
+def index_event(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_object('event', instance)
+        suggestion_changed('event', instance)
+
+@receiver(post_delete, sender=MusicianProfile)
+def unindex_musician(sender, instance, **kwargs):
+    remove_object('musician', instance.pk)
+    suggestion_removed('musician', instance.pk)
+
+@receiver(post_delete, sender=InstrumentListing)
+def unindex_instrument_listing(sender, instance, **kwargs):
+    remove_object('instrument', instance.pk)
+    suggestion_removed('instrument', instance.pk)
+
+@receiver(post_delete, sender=Event)
+def unindex_event(sender, instance, **kwargs):
+    remove_object('event', instance.pk)
+    suggestion_removed('event', instance.pk)
+
+@receiver(m2m_changed, sender=MusicianProfile.genres.through)
+@receiver(m2m_changed, sender=MusicianProfile.instruments.through)
+def reindex_musician_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_object('musician', instance)
+    elif pk_set:
+        # Changed from the genre/instrument side
+        for profile in MusicianProfile.objects.filter(pk__in=pk_set).select_related('user'):
+            index_object('musician', profile)
+
+@receiver(post_save, sender=User)
+def reindex_user_musician(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """Names and bio are part of the musician's search document, names and picture of the suggestion"""
+    if raw or created:
+        return
+    if update_fields is not None and not {'first_name', 'last_name', 'bio', 'profile_picture'} & set(update_fields):
+        return  # e.g. last_login on every sign-in
+    profile = MusicianProfile.objects.filter(user=instance).first()
+    if profile is not None:
+        profile.user = instance
+        index_object('musician', profile)
+        suggestion_changed('musician', profile)
+
+@receiver(post_save, sender=Instrument)
+def reindex_instrument_type(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    suggestion_changed('instrument_type', instance)
+    if created:
+        return
+    for listing in InstrumentListing.objects.filter(instrument=instance).select_related('instrument'):
+        index_object('instrument', listing)
+    for profile in MusicianProfile.objects.filter(instruments=instance).select_related('user'):
+        index_object('musician', profile)
+
+@receiver(post_save, sender=Genre)
+def reindex_genre(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    suggestion_changed('genre', instance)
+    if created:
+        return
+    for profile in MusicianProfile.objects.filter(genres=instance).select_related('user'):
+        index_object('musician', profile)
+
+@receiver(post_delete, sender=Instrument)
+def remove_instrument_type_suggestion(sender, instance, **kwargs):
+    suggestion_removed('instrument_type', instance.pk)
+
+@receiver(post_delete, sender=Genre)
+def remove_genre_suggestion(sender, instance, **kwargs):
+    suggestion_removed('genre', instance.pk)
+
+# Facet counts
+
+@receiver(post_save, sender=MusicianProfile)
+@receiver(post_delete, sender=MusicianProfile)
+def update_musician_facets(sender, instance, raw=False, **kwargs):
+    if not raw:
+        facet_object_changed('musician', instance.pk)
+
+@receiver(post_save, sender=InstrumentListing)
+@receiver(post_delete, sender=InstrumentListing)
+def update_listing_facets(sender, instance, raw=False, **kwargs):
+    if not raw:
+        facet_object_changed('instrument', instance.pk)
+
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Instrument)
+def update_facet_value(sender, instance, raw=False, **kwargs):
+    if not raw:
+        facet_value_changed('genre' if sender is Genre else 'instrument', instance.pk, instance.name)
+
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Instrument)
+def remove_facet_value(sender, instance, **kwargs):
+    facet_value_removed('genre' if sender is Genre else 'instrument', instance.pk)
+
+@receiver(m2m_changed, sender=MusicianProfile.genres.through)
+@receiver(m2m_changed, sender=MusicianProfile.instruments.through)
+def update_musician_tag_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        facet_object_changed('musician', instance.pk)
+    elif pk_set is not None:
+        for profile_id in pk_set:
+            facet_object_changed('musician', profile_id)
+    else:
+        # Cleared from the genre's side: which musicians had it is gone
+        invalidate_facets()
+
+@receiver(post_save, sender=User)
+def update_musician_location_facets(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """Musician facets count active users by location"""
+    if raw or created or instance.user_type != 'musician':
+        return
+    if update_fields is not None and not {'location', 'is_active'} & set(update_fields):
+        return
+    for profile_id in MusicianProfile.objects.filter(user=instance).values_list('pk', flat=True):
+        facet_object_changed('musician', profile_id)
+
+# Availability
+
+# Booking fields that decide which busy days it covers
+BOOKING_FOOTPRINT_FIELDS = {'start_date', 'end_date', 'musician', 'musician_id', 'instrument_listing', 'instrument_listing_id'}
+
+@receiver(pre_save, sender=Booking)
+def read_booking_footprint(sender, instance, raw=False, update_fields=None, **kwargs):
+    """The days an edited booking covered before the save, so the ones it leaves are freed"""
+    instance._footprint_before = None
+    if raw or not instance.pk:
+        return
+    if update_fields is not None and not BOOKING_FOOTPRINT_FIELDS & set(update_fields):
+        return
+    before = Booking.objects.filter(pk=instance.pk).only(
+        'start_date', 'end_date', 'musician_id', 'instrument_listing_id'
+    ).first()
+    if before is not None:
+        instance._footprint_before = booking_footprint(before)
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def update_booking_availability(sender, instance, raw=False, **kwargs):
+    """Busy days and cached bitmaps follow bookings as they are made, moved, accepted, declined or cancelled"""
+    if not raw:
+        booking_changed(instance, getattr(instance, '_footprint_before', None))
+        invalidate_availability()
+
+# Dashboard summaries
+
+@receiver(pre_save, sender=Booking)
+@receiver(pre_save, sender=EventApplication)
+@receiver(pre_save, sender=Event)
+@receiver(pre_save, sender=InstrumentListing)
+@receiver(pre_save, sender=Notification)
+def read_summary_contribution(sender, instance, raw=False, update_fields=None, **kwargs):
+    """What the row adds to dashboard totals before it is saved, None if the save cannot change it"""
+    if raw:
+        return
+    if instance.pk and update_fields is not None and not counted_fields(sender) & set(update_fields):
+        instance._summary_before = None
+    else:
+        instance._summary_before = contributions(sender, [instance.pk]) if instance.pk else Counter()
+
+@receiver(post_save, sender=Booking)
+@receiver(post_save, sender=EventApplication)
+@receiver(post_save, sender=Event)
+@receiver(post_save, sender=InstrumentListing)
+@receiver(post_save, sender=Notification)
+def update_summaries(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    before = getattr(instance, '_summary_before', Counter())
+    if before is not None:
+        rows_changed(sender, [instance.pk], before)
+
+@receiver(pre_delete, sender=Booking)
+@receiver(pre_delete, sender=EventApplication)
+@receiver(pre_delete, sender=Event)
+@receiver(pre_delete, sender=InstrumentListing)
+@receiver(pre_delete, sender=Notification)
+def read_deleted_summary_contribution(sender, instance, **kwargs):
+    instance._summary_before = contributions(sender, [instance.pk])
+
+@receiver(post_delete, sender=Booking)
+@receiver(post_delete, sender=EventApplication)
+@receiver(post_delete, sender=Event)
+@receiver(post_delete, sender=InstrumentListing)
+@receiver(post_delete, sender=Notification)
+def remove_from_summaries(sender, instance, **kwargs):
+    removed = Counter()
+    removed.subtract(getattr(instance, '_summary_before', Counter()))
+    apply(removed)
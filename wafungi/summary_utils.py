@@ -0,0 +1,192 @@
+"""
+Per-user dashboard totals, kept up to date incrementally
+
+Every tracked row (booking, event application, event, instrument listing,
+notification) contributes to a few users' totals: a booking counts for its
+client and for its musician or instrument owner, adds to their pending requests
+while pending and to their earnings once paid. When a row changes, its
+contribution before and after the change are read back by primary key and
+only the difference is applied to the DashboardSummary rows, with
+F() expressions in one transaction. The dashboard then reads one row instead
+of aggregating the user's whole history.
+
+Code paths that bypass model signals (queryset.update(), bulk_create()) call
+update_rows(), rows_changed() or refresh_users() themselves. Saves whose
+update_fields leave every counted field alone skip the read-back.
+"""
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+
+from .models import Booking, DashboardSummary, Event, EventApplication, InstrumentListing, Notification
+
+def _booking(row):
+    contributions = Counter()
+    provider = row['instrument_listing__owner_id'] or row['musician_id']
+    contributions[row['client_id'], 'bookings_made'] += 1
+    if provider:
+        contributions[provider, 'bookings_received'] += 1
+        if row['status'] == 'pending':
+            contributions[provider, 'pending_requests'] += 1
+        if row['payment_status']:
+            contributions[provider, 'total_earnings'] += row['total_amount']
+    return contributions
+
+
+def _application(row):
+    contributions = Counter({(row['musician_id'], 'applications_sent'): 1})
+    if row['status'] == 'pending':
+        contributions[row['event__organizer_id'], 'pending_applications'] += 1
+    return contributions
+
+
+def _event(row):
+    return Counter({(row['organizer_id'], 'events_created'): 1})
+
+
+def _listing(row):
+    return Counter({(row['owner_id'], 'instruments_listed'): 1})
+
+
+def _notification(row):
+    return Counter({(row['user_id'], 'unread_notifications'): 0 if row['is_read'] else 1})
+
+
+# Model -> (fields read back, contribution of one row)
+TRACKED = {
+    Booking: (
+        ('client_id', 'musician_id', 'instrument_listing__owner_id', 'status', 'payment_status', 'total_amount'),
+        _booking,
+    ),
+    EventApplication: (('musician_id', 'event__organizer_id', 'status'), _application),
+    Event: (('organizer_id',), _event),
+    InstrumentListing: (('owner_id',), _listing),
+    Notification: (('user_id', 'is_read'), _notification),
+}
+
+
+def counted_fields(model):
+    """Names and attnames of the fields a row's contribution depends on"""
+    names = set()
+    for path in TRACKED[model][0]:
+        field = model._meta.get_field(path.split('__')[0])
+        names.update((field.name, field.attname))
+    return names
+
+
+def contributions(model, pks, lock=False):
+    """
+    What the current rows ``pks`` of ``model`` add to users' totals
+
+    With ``lock``, the rows are locked (SELECT ... FOR UPDATE) until the
+    surrounding transaction ends, so nothing changes them between this read
+    and the caller's update.
+    """
+    fields, contribution = TRACKED[model]
+    rows = model.objects.filter(pk__in=list(pks))
+    if lock:
+        rows = rows.select_for_update(of=('self',))
+    total = Counter()
+    for row in rows.values(*fields):
+        total.update(contribution(row))
+    return total
+
+
+def apply(deltas):
+    """
+    Add (user id, counter) -> delta to the summaries, in one transaction
+
+    Users without a summary yet are skipped: theirs is built from scratch,
+    already including the change, when first needed.
+    """
+    by_user = defaultdict(dict)
+    for (user_id, counter), delta in deltas.items():
+        if user_id and delta:
+            by_user[user_id][counter] = delta
+    if not by_user:
+        return
+    with transaction.atomic():
+        for user_id, changes in by_user.items():
+            DashboardSummary.objects.filter(user_id=user_id).update(
+                **{counter: F(counter) + delta for counter, delta in changes.items()}
+            )
+
+
+def rows_changed(model, pks, before):
+    """
+    Apply the change in contribution of rows updated in bulk
+
+    Args:
+        model: Tracked model
+        pks: Primary keys of the rows
+        before (Counter): contributions(model, pks) read before the update
+    """
+    after = contributions(model, pks)
+    after.subtract(before)
+    apply(after)
+
+
+def rows_created(model, pks):
+    apply(contributions(model, pks))
+
+
+def update_rows(model, pks, **fields):
+    """
+    UPDATE the rows ``pks`` and apply the change in their contribution, atomically
+
+    Returns:
+        int: Number of rows updated
+    """
+    pks = list(pks)
+    with transaction.atomic():
+        before = contributions(model, pks, lock=True)
+        updated = model.objects.filter(pk__in=pks).update(**fields)
+        rows_changed(model, pks, before)
+    return updated
+
+
+def build_summary(user_id):
+    """Totals of one user computed from their whole history"""
+    provider = Q(musician_id=user_id) | Q(instrument_listing__owner_id=user_id)
+    bookings = Booking.objects.aggregate(
+        bookings_made=Count('id', filter=Q(client_id=user_id)),
+        bookings_received=Count('id', filter=provider),
+        pending_requests=Count('id', filter=provider & Q(status='pending')),
+        total_earnings=Sum('total_amount', filter=provider & Q(payment_status=True)),
+    )
+    applications = EventApplication.objects.aggregate(
+        applications_sent=Count('id', filter=Q(musician_id=user_id)),
+        pending_applications=Count('id', filter=Q(event__organizer_id=user_id, status='pending')),
+    )
+    return DashboardSummary(
+        user_id=user_id,
+        total_earnings=bookings['total_earnings'] or Decimal('0'),
+        bookings_made=bookings['bookings_made'],
+        bookings_received=bookings['bookings_received'],
+        pending_requests=bookings['pending_requests'],
+        applications_sent=applications['applications_sent'],
+        pending_applications=applications['pending_applications'],
+        events_created=Event.objects.filter(organizer_id=user_id).count(),
+        instruments_listed=InstrumentListing.objects.filter(owner_id=user_id).count(),
+        unread_notifications=Notification.objects.filter(user_id=user_id, is_read=False).count(),
+    )
+
+
+def refresh_users(user_ids):
+    """Rebuild the summaries of ``user_ids`` from scratch, e.g. after an admin bulk action"""
+    with transaction.atomic():
+        for user_id in set(user_ids):
+            summary = build_summary(user_id)
+            summary.save()
+
+
+def get_summary(user):
+    """The user's summary, built on first use"""
+    summary = DashboardSummary.objects.filter(user=user).first()
+    if summary is None:
+        with transaction.atomic():
+            summary = build_summary(user.pk)
+            summary.save()
+    return summary
@@ -0,0 +1,30 @@
+"""
+Test runner that gives SQLite tests real write locking
+
+The threaded tests (parallel M-Pesa callbacks, concurrent bookings) need
+connections that wait for each other's write lock rather than fail, which an
+in-memory SQLite database with deferred transactions does not give. This
+runner points each SQLite database at a file next to it and starts every
+transaction with BEGIN IMMEDIATE, for the test run only; the settings
+themselves are left as they are for the development server.
+"""
+from pathlib import Path
+
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+class LockingTestRunner(DiscoverRunner):
+
+    def setup_databases(self, **kwargs):
+        for connection in connections.all(initialized_only=False):
+            if connection.vendor != 'sqlite':
+                continue
+            # Shared with settings.DATABASES, so connections other threads open see it too
+            settings_dict = connection.settings_dict
+            settings_dict.setdefault('OPTIONS', {}).update({'transaction_mode': 'IMMEDIATE', 'timeout': 20})
+            if not settings_dict['TEST'].get('NAME'):
+                name = Path(settings_dict['NAME'])
+                settings_dict['TEST']['NAME'] = name.with_name(f'test_{name.name}')
+            connection.close()
+        return super().setup_databases(**kwargs)
@@ -1,3 +1,1775 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import json
+import socket
+import tempfile
+import threading
+import time
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import (
+    Client, LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.urls import reverse
+from django.utils import timezone
+
+from . import fuzzy_utils, mpesa_utils
+from .benchmark_utils import compare
+from .availability_utils import (
+    BookingConflict, IntervalIndex, book, cached_busy_bitmaps, free_among, invalidate_availability, is_free,
+)
+from .facet_utils import instrument_facets, invalidate_facets, musician_facets
+from .calendar_utils import feed_token
+from .checks import check_shared_caches
+from .fake_daraja import FakeDarajaServer
+from .geo_utils import cells_within, normalize_location
+from .models import (
+    User, Booking, Event, Genre, Instrument, InstrumentListing, MpesaCallback, MusicianProfile, Review,
+    BusyDay, DashboardSummary, EventApplication, Notification, PaymentTransaction, SearchDocument,
+)
+from .middleware import RequestBudgetExceeded, RequestBudgetMiddleware
+from .mpesa_async import AsyncMPesaAPI
+from .mpesa_utils import (
+    AccessTokenCache, MPesaAPI, access_token_cache, circuit_breakers, get_callback_url, get_http_pool_stats,
+    get_http_session,
+)
+from .payment_utils import complete_payment, process_callback_inbox, settle_payments_in_bulk
+from .search_utils import PythonBackend, get_backend, rebuild_index, search_ids
+from .summary_utils import build_summary, get_summary
+from .timing_utils import collect_timings
+from .typeahead_utils import Typeahead, get_suggestions, typeahead
+
+
+class FakeDarajaMixin:
+    """Run every test against a fresh in-process fake Daraja server"""
+
+    def setUp(self):
+        super().setUp()
+        access_token_cache.clear()
+        self.daraja = FakeDarajaServer().start()
+        self.addCleanup(self.daraja.stop)
+        for breaker in circuit_breakers.values():
+            breaker.reset()
+        overrides = override_settings(
+            MPESA_CONSUMER_KEY='test-key',
+            MPESA_CONSUMER_SECRET='test-secret',
+            MPESA_CALLBACK_URL='http://testserver/mpesa/callback/',
+            **self.daraja.settings()
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(access_token_cache.clear)
+
+
+class StubTokenAPI:
+    """Stands in for MPesaAPI, issuing numbered tokens"""
+
+    auth_url = 'https://daraja.test/oauth'
+    consumer_key = 'key'
+
+    def __init__(self, expires_in=3599, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.calls = 0
+
+    def request_access_token(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return f'token-{self.calls}', self.expires_in
+
+
+@override_settings(MPESA_TOKEN_REFRESH_MARGIN=300)
+class AccessTokenCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_concurrent_callers_share_one_fetch(self):
+        tokens, api = AccessTokenCache(), StubTokenAPI(delay=0.1)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: tokens.get(api), range(8)))
+
+        self.assertEqual(results, ['token-1'] * 8)
+        self.assertEqual(api.calls, 1)
+
+    def test_expired_token_is_fetched_again(self):
+        tokens, api = AccessTokenCache(), StubTokenAPI()
+        tokens.store(tokens.cache_key(api), 'stale', -1)
+
+        self.assertEqual(tokens.get(api), 'token-1')
+        self.assertEqual(tokens.get(api), 'token-1')
+        self.assertEqual(api.calls, 1)
+
+    def test_expiring_token_is_served_while_refreshed(self):
+        tokens, api = AccessTokenCache(), StubTokenAPI()
+        key = tokens.cache_key(api)
+        tokens.store(key, 'old', 100)
+
+        self.assertEqual(tokens.get(api), 'old')
+        deadline = time.monotonic() + 5
+        while tokens.lookup(key)['token'] == 'old' and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(tokens.get(api), 'token-1')
+        self.assertEqual(api.calls, 1)
+
+    @override_settings(MPESA_TOKEN_CACHE_ALIAS='default')
+    def test_workers_reuse_shared_token(self):
+        first, second, api = AccessTokenCache(), AccessTokenCache(), StubTokenAPI()
+        key = first.cache_key(api)
+        second.store(key, 'stale', -1)
+        cache.clear()
+
+        self.assertEqual(first.get(api), 'token-1')
+        # The second worker's own copy has expired; it takes the first worker's token
+        self.assertEqual(second.get(api), 'token-1')
+        self.assertEqual(api.calls, 1)
+
+    @override_settings(MPESA_TOKEN_CACHE_ALIAS='default')
+    def test_waiting_worker_leaves_others_lock_alone(self):
+        tokens, api = AccessTokenCache(), StubTokenAPI()
+        lock_key = f"{tokens.cache_key(api)}:refresh-lock"
+        cache.add(lock_key, 1, timeout=30)
+
+        with mock.patch.object(tokens, '_wait_for_shared_token', return_value=None):
+            self.assertEqual(tokens.get(api), 'token-1')
+
+        self.assertEqual(cache.get(lock_key), 1)
+
+
+class CallbackUrlTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(mpesa_utils, '_callback_url', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(MPESA_NGROK_ENABLED=False, MPESA_CALLBACK_URL='https://wafungi.example/mpesa/callback/')
+    def test_setting_is_used_without_ngrok(self):
+        with mock.patch.object(mpesa_utils, '_open_ngrok_callback_url') as open_tunnel:
+            self.assertEqual(get_callback_url(), 'https://wafungi.example/mpesa/callback/')
+        open_tunnel.assert_not_called()
+
+    @override_settings(MPESA_NGROK_ENABLED=True, MPESA_CALLBACK_URL='https://wafungi.example/mpesa/callback/')
+    def test_one_ngrok_tunnel_per_process(self):
+        def open_tunnel():
+            time.sleep(0.05)
+            return 'https://abc123.ngrok.io/mpesa/callback/'
+
+        with mock.patch.object(mpesa_utils, '_open_ngrok_callback_url', side_effect=open_tunnel) as opened:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                urls = set(executor.map(lambda _: get_callback_url(), range(8)))
+            urls.add(get_callback_url())
+
+        self.assertEqual(urls, {'https://abc123.ngrok.io/mpesa/callback/'})
+        self.assertEqual(opened.call_count, 1)
+
+
+@override_settings(MPESA_HTTP_POOL_CONNECTIONS=2, MPESA_HTTP_POOL_MAXSIZE=7, MPESA_HTTP_POOL_BLOCK=True)
+class HttpSessionTests(FakeDarajaMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(mpesa_utils, '_http_session', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_session_is_shared_and_configured(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sessions = set(executor.map(lambda _: id(get_http_session()), range(8)))
+        session = get_http_session()
+
+        self.assertEqual(sessions, {id(session)})
+        self.assertIs(MPesaAPI().session, session)
+        adapter = session.get_adapter('https://api.safaricom.co.ke')
+        self.assertIs(adapter, session.get_adapter('http://127.0.0.1'))
+        self.assertEqual((adapter._pool_connections, adapter._pool_maxsize, adapter._pool_block), (2, 7, True))
+
+        # No domain may set cookies on the shared session
+        self.assertEqual(list(session.cookies.get_policy().allowed_domains()), [])
+
+    def test_connections_are_reused(self):
+        self.assertEqual(get_http_pool_stats(), [])
+
+        for _ in range(3):
+            token, _ = MPesaAPI().request_access_token()
+            self.assertTrue(token)
+
+        [stats] = get_http_pool_stats()
+        self.assertEqual((stats['requests'], stats['connections_opened']), (3, 1))
+        self.assertEqual(stats['max_connections'], 7)
+        self.assertEqual(stats['idle_connections'], 1)
+
+
+class AsyncMPesaAPITests(FakeDarajaMixin, SimpleTestCase):
+
+    async def test_stk_push_and_query(self):
+        mpesa = AsyncMPesaAPI()
+
+        result = await mpesa.stk_push('0712345678', 150, 'BOOKING-1', 'Test payment')
+        self.assertTrue(result['success'])
+        self.assertEqual(self.daraja.state.stk_requests[result['checkout_request_id']]['payload']['PhoneNumber'], '254712345678')
+
+        status = await mpesa.query_stk_status(result['checkout_request_id'])
+        self.assertTrue(status['success'])
+        self.assertEqual(status['result_code'], '0')
+
+    async def test_rejected_token_is_replaced(self):
+        mpesa = AsyncMPesaAPI()
+        await mpesa.get_access_token()
+        self.daraja.state.tokens.clear()
+
+        result = await mpesa.stk_push('712345678', 10, 'BOOKING-1', 'Test payment')
+
+        self.assertTrue(result['success'], result)
+        self.assertEqual(self.daraja.state.counts['oauth'], 2)
+
+    async def test_access_token_is_reused(self):
+        mpesa = AsyncMPesaAPI()
+
+        for _ in range(3):
+            await mpesa.stk_push('712345678', 10, 'BOOKING-1', 'Test payment')
+
+        self.assertEqual(self.daraja.state.counts['oauth'], 1)
+        self.assertEqual(self.daraja.state.counts['stk_push'], 3)
+
+
+class AsyncMPesaSharedCacheTests(FakeDarajaMixin, TransactionTestCase):
+    """
+    The async client with a database cache as its shared cache
+
+    Like a Redis round-trip, a database cache read blocks; Django refuses
+    one on the event loop, so any sync cache call fails these tests.
+    """
+
+    def setUp(self):
+        overrides = override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                'LOCATION': 'test_shared_cache'}},
+            MPESA_TOKEN_CACHE_ALIAS='default',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        call_command('createcachetable', verbosity=0)
+        super().setUp()
+
+    async def test_cache_is_used_off_the_event_loop(self):
+        mpesa = AsyncMPesaAPI()
+
+        result = await mpesa.stk_push('712345678', 150, 'BOOKING-1', 'Test payment')
+        self.assertTrue(result['success'], result)
+        status = await mpesa.query_stk_status(result['checkout_request_id'])
+        self.assertTrue(status['success'], status)
+        self.assertIsNotNone(await cache.aget(access_token_cache.cache_key(mpesa)))
+
+        breaker = circuit_breakers['query']
+        await breaker.arecord_failure()
+        self.assertEqual(await cache.aget(breaker.failures_key), 1)
+        await breaker.arecord_success()
+        self.assertEqual(await breaker.astate(), 'closed')
+
+
+class AsyncPaymentViewTests(FakeDarajaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client_user = User.objects.create_user('client', password='pass', user_type='client')
+        musician = User.objects.create_user('musician', password='pass', user_type='musician')
+        start = timezone.now() + timedelta(days=7)
+        self.booking = Booking.objects.create(
+            client=self.client_user, musician=musician, start_date=start,
+            end_date=start + timedelta(hours=3), total_amount=Decimal('3150.00'), status='confirmed'
+        )
+
+    async def test_payment_process_async_creates_pending_transaction(self):
+        await self.async_client.aforce_login(self.client_user)
+
+        response = await self.async_client.post(
+            reverse('payment_process_async', args=[self.booking.id]), {'mpesa_number': '712345678'}
+        )
+
+        transaction = await PaymentTransaction.objects.aget(booking=self.booking)
+        self.assertRedirects(
+            response, reverse('payment_status_async', args=[self.booking.id, transaction.checkout_request_id]),
+            fetch_redirect_response=False
+        )
+        self.assertEqual(transaction.status, 'pending')
+        self.assertEqual(transaction.phone_number, '254712345678')
+
+    async def test_payment_status_async_completes_from_stk_query(self):
+        await self.async_client.aforce_login(self.client_user)
+        await self.async_client.post(
+            reverse('payment_process_async', args=[self.booking.id]), {'mpesa_number': '712345678'}
+        )
+        transaction = await PaymentTransaction.objects.aget(booking=self.booking)
+
+        response = await self.async_client.get(
+            reverse('payment_status_async', args=[self.booking.id, transaction.checkout_request_id])
+        )
+
+        self.assertRedirects(response, reverse('payment_success', args=[self.booking.id]), fetch_redirect_response=False)
+        await transaction.arefresh_from_db()
+        await self.booking.arefresh_from_db()
+        self.assertEqual(transaction.status, 'completed')
+        self.assertTrue(self.booking.payment_status)
+        self.assertEqual(transaction.transaction_id, '')
+
+        # The callback arriving afterwards still records the receipt, without paying twice
+        await sync_to_async(complete_payment)(transaction.checkout_request_id, 'RKT1ABC2DE')
+        await transaction.arefresh_from_db()
+        self.assertEqual(transaction.transaction_id, 'RKT1ABC2DE')
+        self.assertEqual(await Notification.objects.filter(title='Payment Received').acount(), 1)
+
+    async def test_payment_status_async_keeps_receipt_from_query(self):
+        await self.async_client.aforce_login(self.client_user)
+        await self.async_client.post(
+            reverse('payment_process_async', args=[self.booking.id]), {'mpesa_number': '712345678'}
+        )
+        transaction = await PaymentTransaction.objects.aget(booking=self.booking)
+        paid = {'success': True, 'result_code': '0', 'result_desc': 'Paid', 'transaction_id': 'RKT9XYZ8WV', 'data': {}}
+
+        with mock.patch('wafungi.async_views.averify_payment_status', return_value=paid):
+            await self.async_client.get(
+                reverse('payment_status_async', args=[self.booking.id, transaction.checkout_request_id])
+            )
+
+        await transaction.arefresh_from_db()
+        self.assertEqual((transaction.status, transaction.transaction_id), ('completed', 'RKT9XYZ8WV'))
+
+
+@override_settings(MPESA_BREAKER_FAILURE_THRESHOLD=3, MPESA_BREAKER_COOLDOWN=30, MPESA_RETRY_BASE_DELAY=0)
+class CircuitBreakerTests(FakeDarajaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(lambda: [breaker.reset() for breaker in circuit_breakers.values()])
+
+    def take_daraja_down(self):
+        """Point the STK endpoints at a closed local port so every call is refused"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            dead_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        overrides = override_settings(
+            MPESA_STK_PUSH_URL=f"{dead_url}/stkpush", MPESA_QUERY_URL=f"{dead_url}/query"
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_breaker_opens_and_fails_fast(self):
+        MPesaAPI().get_access_token()
+        self.take_daraja_down()
+        mpesa = MPesaAPI()
+
+        with mock.patch.object(get_http_session(), 'request', wraps=get_http_session().request) as request:
+            for _ in range(3):
+                self.assertEqual(mpesa.stk_push('712345678', 10, 'REF', 'Test')['error_code'], 'NETWORK_ERROR')
+            self.assertEqual(circuit_breakers['stk_push'].state, 'open')
+
+            result = mpesa.stk_push('712345678', 10, 'REF', 'Test')
+
+        # STK Push is never retried, and nothing is sent once the circuit is open
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(result['error_code'], 'SERVICE_UNAVAILABLE')
+
+    def test_idempotent_query_is_retried(self):
+        MPesaAPI().get_access_token()
+        self.take_daraja_down()
+        mpesa = MPesaAPI()
+
+        with override_settings(MPESA_RETRY_ATTEMPTS=2), \
+                mock.patch.object(get_http_session(), 'request', wraps=get_http_session().request) as request:
+            result = mpesa.query_stk_status('ws_CO_1')
+
+        self.assertFalse(result['success'])
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(circuit_breakers['query'].state, 'open')
+
+    def test_per_process_breaker_cache_is_flagged(self):
+        shared = {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'breaker_cache'}
+        local = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+
+        with override_settings(DEBUG=False, CACHES={'default': local, 'shared': shared}):
+            self.assertEqual([w.id for w in check_shared_caches(None)], ['wafungi.W001'])
+            with override_settings(MPESA_BREAKER_CACHE_ALIAS='shared'):
+                self.assertEqual(check_shared_caches(None), [])
+            with override_settings(DEBUG=True):
+                self.assertEqual(check_shared_caches(None), [])
+
+    def test_half_open_probe_closes_circuit(self):
+        breaker = circuit_breakers['stk_push']
+        breaker.trip()
+        self.assertEqual(MPesaAPI().stk_push('712345678', 10, 'REF', 'Test')['error_code'], 'SERVICE_UNAVAILABLE')
+
+        with mock.patch('wafungi.mpesa_utils.time.time', return_value=time.time() + 31):
+            self.assertEqual(breaker.state, 'half_open')
+            self.assertTrue(MPesaAPI().stk_push('712345678', 10, 'REF', 'Test')['success'])
+
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_payment_process_fast_path_while_open(self):
+        client_user = User.objects.create_user('client', password='pass', user_type='client')
+        musician = User.objects.create_user('musician', password='pass', user_type='musician')
+        start = timezone.now() + timedelta(days=7)
+        booking = Booking.objects.create(
+            client=client_user, musician=musician, start_date=start,
+            end_date=start + timedelta(hours=3), total_amount=Decimal('3150.00'), status='confirmed'
+        )
+        circuit_breakers['stk_push'].trip()
+        self.client.force_login(client_user)
+
+        response = self.client.post(reverse('payment_process', args=[booking.id]), {'mpesa_number': '712345678'})
+
+        self.assertContains(response, 'temporarily unavailable')
+        self.assertEqual(self.daraja.state.counts['stk_push'], 0)
+        self.assertFalse(PaymentTransaction.objects.exists())
+
+
+class ReconcilePaymentsCommandTests(FakeDarajaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('wafungi.payment_utils.send_payment_receipt_email')
+        self.send_receipt = patcher.start()
+        self.addCleanup(patcher.stop)
+        client_user = User.objects.create_user('client', password='pass', user_type='client')
+        musician = User.objects.create_user('musician', password='pass', user_type='musician')
+        start = timezone.now() + timedelta(days=7)
+        stale = timezone.now() - timedelta(hours=1)
+
+        # Result codes Daraja reports for each pending payment; None is still processing
+        self.outcomes = {'ws_CO_PAID': '0', 'ws_CO_CANCELLED': '1032', 'ws_CO_FAILED': '1', 'ws_CO_WAITING': None}
+        for checkout_request_id, result_code in self.outcomes.items():
+            booking = Booking.objects.create(
+                client=client_user, musician=musician, start_date=start,
+                end_date=start + timedelta(hours=3), total_amount=Decimal('1000.00'), status='confirmed'
+            )
+            PaymentTransaction.objects.create(
+                booking=booking, checkout_request_id=checkout_request_id,
+                phone_number='254712345678', amount=booking.total_amount
+            )
+            if result_code is not None:
+                self.daraja.state.stk_requests[checkout_request_id] = {
+                    'merchant_request_id': '1-1-1', 'payload': {},
+                    'result_code': result_code, 'result_desc': 'Test',
+                }
+        PaymentTransaction.objects.update(created_at=stale)
+
+    def statuses(self):
+        return dict(PaymentTransaction.objects.values_list('checkout_request_id', 'status'))
+
+    def test_reconciles_stale_pending_payments(self):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reconcile_payments', '--workers=4', '--rate=0', '--batch-size=3', stdout=out)
+
+        self.assertEqual(self.statuses(), {
+            'ws_CO_PAID': 'completed', 'ws_CO_CANCELLED': 'cancelled',
+            'ws_CO_FAILED': 'failed', 'ws_CO_WAITING': 'pending',
+        })
+        self.assertTrue(Booking.objects.get(transactions__checkout_request_id='ws_CO_PAID').payment_status)
+        self.assertEqual(self.send_receipt.call_count, 1)
+        self.assertEqual(self.daraja.state.counts['query'], 4)
+        self.assertIn('1 still pending', out.getvalue())
+
+        # A second run only queries what is still pending
+        call_command('reconcile_payments', '--rate=0', stdout=StringIO())
+        self.assertEqual(self.daraja.state.counts['query'], 5)
+
+    def test_dry_run_leaves_payments_untouched(self):
+        call_command('reconcile_payments', '--dry-run', '--rate=0', stdout=StringIO())
+
+        self.assertEqual(set(self.statuses().values()), {'pending'})
+
+    def test_bulk_settle_records_receipts_and_notifies_changes(self):
+        # Settled by its callback after the query came back
+        PaymentTransaction.objects.filter(checkout_request_id='ws_CO_FAILED').update(status='completed')
+
+        with mock.patch('wafungi.payment_utils.notify_payment_update') as notify, \
+                self.captureOnCommitCallbacks(execute=True):
+            counts = settle_payments_in_bulk(
+                completed={'ws_CO_PAID': 'SRECEIPT01', 'ws_CO_WAITING': 'SRECEIPT01'},
+                failed_ids=['ws_CO_FAILED', 'ws_CO_CANCELLED'],
+            )
+
+        self.assertEqual(counts, {'completed': 2, 'failed': 1, 'cancelled': 0})
+        receipts = dict(PaymentTransaction.objects.values_list('checkout_request_id', 'transaction_id'))
+        # A receipt number settles one transaction only
+        self.assertEqual(sorted([receipts['ws_CO_PAID'], receipts['ws_CO_WAITING']]), ['', 'SRECEIPT01'])
+        self.assertEqual(sorted(call.args[1]['transaction_id'] for call in self.send_receipt.call_args_list),
+                         ['', 'SRECEIPT01'])
+        self.assertEqual(sorted(call.args[0] for call in notify.call_args_list),
+                         ['ws_CO_CANCELLED', 'ws_CO_PAID', 'ws_CO_WAITING'])
+
+    def test_daraja_errors_are_not_mistaken_for_pending(self):
+        outage = json.dumps({'requestId': '1', 'errorCode': '500.003.1001', 'errorMessage': 'Internal Server Error'})
+        out = StringIO()
+
+        with mock.patch.object(MPesaAPI, 'send_authorized', return_value=mock.Mock(status_code=500, text=outage)):
+            call_command('reconcile_payments', '--rate=0', stdout=out)
+
+        self.assertIn('0 still pending', out.getvalue())
+        self.assertIn('4 query errors', out.getvalue())
+
+
+class PendingPaymentMixin:
+    """A confirmed booking with a pending STK Push, and helpers to post its callback"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('wafungi.payment_utils.send_payment_receipt_email')
+        self.send_receipt = patcher.start()
+        self.addCleanup(patcher.stop)
+        client_user = User.objects.create_user('client', email='client@example.com', password='pass', user_type='client')
+        musician = User.objects.create_user('musician', password='pass', user_type='musician')
+        start = timezone.now() + timedelta(days=7)
+        self.booking = Booking.objects.create(
+            client=client_user, musician=musician, start_date=start,
+            end_date=start + timedelta(hours=3), total_amount=Decimal('3150.00'), status='confirmed'
+        )
+        self.transaction = PaymentTransaction.objects.create(
+            booking=self.booking, checkout_request_id='ws_CO_TEST_1', phone_number='254712345678',
+            amount=self.booking.total_amount
+        )
+
+    def callback_body(self, receipt='RKT1ABC2DE'):
+        return json.dumps({'Body': {'stkCallback': {
+            'MerchantRequestID': '29115-34620561-1',
+            'CheckoutRequestID': self.transaction.checkout_request_id,
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 3150},
+                {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+                {'Name': 'TransactionDate', 'Value': 20250709164200},
+                {'Name': 'PhoneNumber', 'Value': 254712345678},
+            ]},
+        }}})
+
+    def post_callback(self, body):
+        try:
+            response = Client().post(reverse('mpesa_callback'), body, content_type='application/json')
+            return response.json()
+        finally:
+            connection.close()
+
+
+class MpesaCallbackIdempotencyTests(PendingPaymentMixin, TransactionTestCase):
+    """Daraja retries callbacks; only the first one may settle the payment"""
+
+    PARALLEL_CALLBACKS = 8
+
+    def drain_inbox(self, batch_size=1):
+        try:
+            return process_callback_inbox(batch_size=batch_size)
+        finally:
+            connection.close()
+
+    def test_parallel_duplicate_callbacks_settle_once(self):
+        body = self.callback_body()
+        with ThreadPoolExecutor(max_workers=self.PARALLEL_CALLBACKS) as pool:
+            acks = list(pool.map(self.post_callback, [body] * self.PARALLEL_CALLBACKS))
+            # Several workers drain the duplicates concurrently
+            list(pool.map(self.drain_inbox, [1] * self.PARALLEL_CALLBACKS))
+
+        self.assertEqual(acks, [{'ResultCode': 0, 'ResultDesc': 'Success'}] * self.PARALLEL_CALLBACKS)
+        self.assertEqual(MpesaCallback.objects.filter(status='processed').count(), self.PARALLEL_CALLBACKS)
+        self.transaction.refresh_from_db()
+        self.booking.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'completed')
+        self.assertEqual(self.transaction.transaction_id, 'RKT1ABC2DE')
+        self.assertTrue(self.booking.payment_status)
+        self.assertEqual(self.send_receipt.call_count, 1)
+        self.assertEqual(Notification.objects.filter(title='Payment Successful').count(), 1)
+
+    def test_ack_does_not_wait_for_processing(self):
+        self.assertEqual(self.post_callback(self.callback_body())['ResultCode'], 0)
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'pending')
+        self.assertEqual(MpesaCallback.objects.get().checkout_request_id, 'ws_CO_TEST_1')
+        self.send_receipt.assert_not_called()
+
+    def test_late_failure_callback_does_not_undo_payment(self):
+        self.post_callback(self.callback_body())
+        failure = json.loads(self.callback_body())
+        failure['Body']['stkCallback'].update(ResultCode=1032, ResultDesc='Request cancelled by user')
+        del failure['Body']['stkCallback']['CallbackMetadata']
+        self.post_callback(json.dumps(failure))
+
+        process_callback_inbox()
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'completed')
+
+    def test_receipt_number_settles_only_one_transaction(self):
+        self.post_callback(self.callback_body())
+        other = PaymentTransaction.objects.create(
+            booking=self.booking, checkout_request_id='ws_CO_TEST_2', phone_number='254712345678',
+            amount=self.booking.total_amount
+        )
+        self.transaction = other
+        self.post_callback(self.callback_body())
+
+        process_callback_inbox()
+        other.refresh_from_db()
+        self.assertEqual(other.status, 'pending')
+        self.assertEqual(self.send_receipt.call_count, 1)
+
+    def test_failed_processing_is_retried_with_backoff(self):
+        self.post_callback(self.callback_body())
+
+        with mock.patch('wafungi.payment_utils.complete_payment', side_effect=RuntimeError('db down')):
+            counts = process_callback_inbox()
+
+        self.assertEqual(counts['retried'], 1)
+        callback = MpesaCallback.objects.get()
+        self.assertEqual((callback.status, callback.attempts), ('pending', 1))
+        self.assertGreater(callback.next_attempt_at, timezone.now())
+        self.assertEqual(process_callback_inbox()['claimed'], 0)
+
+
+class PaymentStatusEventsTests(PendingPaymentMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('payment_status_events', args=[self.booking.id, self.transaction.checkout_request_id])
+
+    async def test_long_poll_is_woken_by_callback(self):
+        await self.async_client.aforce_login(self.booking.client)
+
+        poll = asyncio.ensure_future(self.async_client.get(self.url, {'status': 'pending', 'timeout': 10}))
+        await asyncio.sleep(0.2)
+        self.assertFalse(poll.done())
+
+        started = time.monotonic()
+        await asyncio.to_thread(self.post_callback, self.callback_body())
+        response = await poll
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(response.json()['status'], 'completed')
+        self.assertTrue(response.json()['changed'])
+        self.assertEqual(response.json()['redirect_url'], reverse('payment_success', args=[self.booking.id]))
+
+    async def test_long_poll_times_out_unchanged(self):
+        await self.async_client.aforce_login(self.booking.client)
+
+        response = await self.async_client.get(self.url, {'status': 'pending', 'timeout': 0.3})
+
+        self.assertEqual(response.json(), {
+            'checkout_request_id': 'ws_CO_TEST_1', 'status': 'pending', 'changed': False,
+        })
+
+    async def test_event_stream_sends_current_status(self):
+        await PaymentTransaction.objects.filter(pk=self.transaction.pk).aupdate(status='failed')
+        await self.async_client.aforce_login(self.booking.client)
+
+        response = await self.async_client.get(self.url, headers={'Accept': 'text/event-stream'})
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn('event: status\ndata: {"checkout_request_id": "ws_CO_TEST_1", "status": "failed"}', body)
+
+    @override_settings(MPESA_STATUS_STREAM_TIMEOUT=300, MPESA_STATUS_LONGPOLL_TIMEOUT=300)
+    def test_wsgi_requests_are_answered_at_once(self):
+        self.client.force_login(self.booking.client)
+
+        started = time.monotonic()
+        response = self.client.get(self.url, {'status': 'pending', 'timeout': 10})
+        self.assertEqual(response.json(), {
+            'checkout_request_id': 'ws_CO_TEST_1', 'status': 'pending', 'changed': False, 'retry_after': 3,
+        })
+
+        response = self.client.get(self.url, headers={'Accept': 'text/event-stream'})
+        with self.assertWarnsMessage(Warning, 'StreamingHttpResponse must consume asynchronous iterators'):
+            body = b''.join(response).decode()
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(body, 'retry: 3000\n\nevent: status\ndata: '
+                               '{"checkout_request_id": "ws_CO_TEST_1", "status": "pending"}\n\n')
+
+    async def test_other_users_cannot_watch_payment(self):
+        other = await User.objects.acreate_user('other', password='pass', user_type='client')
+        await self.async_client.aforce_login(other)
+
+        response = await self.async_client.get(self.url, {'timeout': 0})
+
+        self.assertEqual(response.status_code, 404)
+
+
+class FakeDarajaCallbackTests(LiveServerTestCase):
+    """The fake Daraja delivers (and duplicates) callbacks to our live endpoint"""
+
+    def setUp(self):
+        patcher = mock.patch('wafungi.payment_utils.send_payment_receipt_email')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        access_token_cache.clear()
+        self.addCleanup(access_token_cache.clear)
+        self.daraja = FakeDarajaServer(
+            send_callbacks=True, callback_url=f"{self.live_server_url}{reverse('mpesa_callback')}",
+            callback_delay=0.1, duplicate_rate=1,
+        ).start()
+        self.addCleanup(self.daraja.stop)
+        overrides = override_settings(MPESA_CONSUMER_KEY='test-key', MPESA_CONSUMER_SECRET='test-secret',
+                                      **self.daraja.settings())
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_duplicated_callbacks_settle_payment_once(self):
+        client_user = User.objects.create_user('client', password='pass', user_type='client')
+        musician = User.objects.create_user('musician', password='pass', user_type='musician')
+        start = timezone.now() + timedelta(days=7)
+        booking = Booking.objects.create(
+            client=client_user, musician=musician, start_date=start,
+            end_date=start + timedelta(hours=3), total_amount=Decimal('1500.00'), status='confirmed'
+        )
+        self.client.force_login(client_user)
+        self.client.post(reverse('payment_process', args=[booking.id]), {'mpesa_number': '712345678'})
+
+        deadline = time.monotonic() + 10
+        while self.daraja.state.counts['callbacks'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        process_callback_inbox()
+
+        self.assertEqual(self.daraja.state.counts['duplicate_callbacks'], 1)
+        self.assertEqual(self.daraja.state.counts['callback_errors'], 0)
+        transaction = PaymentTransaction.objects.get(booking=booking)
+        self.assertEqual(transaction.status, 'completed')
+        self.assertTrue(transaction.transaction_id.startswith('S'))
+        self.assertEqual(Notification.objects.filter(user=client_user, title='Payment Successful').count(), 1)
+
+
+class SearchIndexTests(TestCase):
+
+    def setUp(self):
+        self.jazz = Genre.objects.create(name='Jazz')
+        saxophone = Instrument.objects.create(name='Saxophone', category='Wind')
+        self.guitar = Instrument.objects.create(name='Guitar', category='Strings')
+
+        user = User.objects.create_user('amani', first_name='Amani', last_name='Otieno', user_type='musician',
+                                        bio='Session guitarist from Kisumu')
+        self.guitarist = MusicianProfile.objects.create(user=user, stage_name='Amani Strings')
+        self.guitarist.instruments.add(self.guitar)
+        other = User.objects.create_user('wanjiru', first_name='Wanjiru', user_type='musician',
+                                         bio='Plays alongside a guitarist now and then')
+        self.saxophonist = MusicianProfile.objects.create(user=other, stage_name='Sax Queen')
+        self.saxophonist.instruments.add(saxophone)
+
+        owner = User.objects.create_user('owner', user_type='instrument_owner')
+        self.listing = InstrumentListing.objects.create(
+            owner=owner, instrument=saxophone, brand='Yamaha', model='YAS-280', condition='good',
+            daily_rate=Decimal('1500.00'), description='Student alto saxophone', location='Nairobi'
+        )
+
+    def assert_backends_agree(self, kind, query, expected):
+        self.assertEqual(search_ids(kind, query), expected)
+        with override_settings(SEARCH_BACKEND='python'):
+            # Loaded from the rows this test sees rather than an earlier test's
+            get_backend().reset()
+            self.assertEqual(search_ids(kind, query), expected)
+
+    def test_prefix_terms_all_match_and_titles_rank_first(self):
+        self.assertIn(get_backend().name, ('sqlite_fts', 'postgres'))
+        self.assert_backends_agree('musician', 'guitar', [self.guitarist.pk, self.saxophonist.pk])
+        self.assert_backends_agree('musician', 'amani kisu', [self.guitarist.pk])
+        self.assert_backends_agree('instrument', 'yamaha alto', [self.listing.pk])
+        self.assert_backends_agree('instrument', 'fender', [])
+
+    def test_python_index_catches_up_after_max_age(self):
+        backend = PythonBackend()
+        self.assertEqual(backend.search('instrument', ['yamaha'], 10), [self.listing.pk])
+
+        # Another process changed the documents, but its version bump never reached this one
+        SearchDocument.objects.filter(kind='instrument').update(title='Selmer', body='')
+        self.assertEqual(backend.search('instrument', ['selmer'], 10), [])
+
+        with mock.patch('wafungi.search_utils.time.monotonic', return_value=time.monotonic() + 301):
+            self.assertEqual(backend.search('instrument', ['selmer'], 10), [self.listing.pk])
+
+    def test_signals_keep_index_current(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.saxophonist.genres.add(self.jazz)
+            self.listing.brand = 'Selmer'
+            self.listing.save()
+            self.guitarist.user.last_name = 'Kamau'
+            self.guitarist.user.save()
+
+        self.assert_backends_agree('musician', 'jazz', [self.saxophonist.pk])
+        self.assert_backends_agree('instrument', 'selmer', [self.listing.pk])
+        self.assert_backends_agree('musician', 'kamau', [self.guitarist.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.delete()
+        self.assert_backends_agree('instrument', 'selmer', [])
+
+    def test_rebuild_matches_incremental_index(self):
+        documents = set(SearchDocument.objects.values_list('kind', 'object_id', 'title', 'body'))
+
+        rebuild_index()
+
+        self.assertEqual(set(SearchDocument.objects.values_list('kind', 'object_id', 'title', 'body')), documents)
+
+    def test_search_views_use_index(self):
+        response = self.client.get(reverse('search_musicians'), {'q': 'strings guitar'})
+        self.assertEqual([m.pk for m in response.context['page_obj']], [self.guitarist.pk])
+
+        response = self.client.get(reverse('search_instruments'), {'q': 'yas'})
+        self.assertEqual([i.pk for i in response.context['page_obj']], [self.listing.pk])
+
+        response = self.client.get(reverse('search_musicians'), {'q': 'zzxqqj'})
+        self.assertEqual(list(response.context['page_obj']), [])
+
+
+class TypeaheadTests(TestCase):
+
+    def setUp(self):
+        self.guitar = Instrument.objects.create(name='Guitar', category='Strings')
+        Genre.objects.create(name='Gospel')
+        user = User.objects.create_user('amani', first_name='Amani', last_name='Otieno', user_type='musician')
+        self.guitarist = MusicianProfile.objects.create(user=user, stage_name='Guitar Amani')
+        owner = User.objects.create_user('owner', user_type='instrument_owner')
+        self.listing = InstrumentListing.objects.create(
+            owner=owner, instrument=self.guitar, brand='Gibson', model='Les Paul', condition='good',
+            daily_rate=Decimal('2500.00'), description='Electric guitar', location='Nairobi'
+        )
+        typeahead.reset()
+
+    def names(self, query):
+        return [(result['type'], result['name']) for result in get_suggestions(query)]
+
+    def test_prefix_suggestions_without_queries(self):
+        self.assertEqual(self.names('g'), [
+            ('musician', 'Guitar Amani'),
+            ('instrument', 'Gibson Les Paul'),
+            ('genre', 'Gospel'),
+            ('instrument_type', 'Guitar'),
+        ])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names('les gib'), [('instrument', 'Gibson Les Paul')])
+            self.assertEqual(self.names('  OTI '), [('musician', 'Guitar Amani')])
+            self.assertEqual(self.names('zz'), [])
+
+    def test_index_catches_up_after_max_age(self):
+        index = Typeahead()
+        self.assertEqual([s['name'] for s in index.suggest('gibson')], ['Gibson Les Paul'])
+
+        # Changed by another process whose version bump never reached this one
+        InstrumentListing.objects.filter(pk=self.listing.pk).update(brand='Fender')
+        self.assertEqual(index.suggest('fender'), [])
+
+        with mock.patch('wafungi.typeahead_utils.time.monotonic', return_value=time.monotonic() + 301):
+            self.assertEqual([s['name'] for s in index.suggest('fender')], ['Fender Les Paul'])
+
+    def test_saves_update_suggestions_in_place(self):
+        self.names('warm up')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.brand = 'Fender'
+            self.listing.save()
+            Event.objects.create(
+                organizer=self.listing.owner, title='Gospel Night', description='Choir', event_type='concert',
+                date=timezone.now() + timedelta(days=7), duration_hours=3, location='Nakuru',
+                budget_min=Decimal('1000'), budget_max=Decimal('5000'),
+            )
+            self.guitarist.delete()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names('gosp'), [('event', 'Gospel Night'), ('genre', 'Gospel')])
+            self.assertEqual(self.names('fend'), [('instrument', 'Fender Les Paul')])
+            self.assertEqual(self.names('amani'), [])
+
+    def test_search_api_returns_suggestions(self):
+        self.client.force_login(self.listing.owner)
+        response = self.client.get(reverse('search_api'), {'q': 'Gib'})
+        self.assertEqual(response.json()['results'], [{
+            'type': 'instrument', 'id': self.listing.id, 'name': 'Gibson Les Paul',
+            'url': f'/instruments/{self.listing.id}/', 'image': None,
+        }])
+        self.assertIn('max-age', response['Cache-Control'])
+
+
+class FuzzySearchTests(TestCase):
+
+    def setUp(self):
+        guitar = Instrument.objects.create(name='Guitar', category='Strings')
+        saxophone = Instrument.objects.create(name='Saxophone', category='Wind')
+        user = User.objects.create_user('baraka', first_name='Baraka', last_name='Mwangi', user_type='musician')
+        self.guitarist = MusicianProfile.objects.create(user=user, stage_name='Baraka Guitar')
+        owner = User.objects.create_user('owner', user_type='instrument_owner')
+        self.saxophone = InstrumentListing.objects.create(
+            owner=owner, instrument=saxophone, brand='Yamaha', model='YAS-280', condition='good',
+            daily_rate=Decimal('1500.00'), description='Alto', location='Nairobi'
+        )
+        InstrumentListing.objects.create(
+            owner=owner, instrument=guitar, brand='Yamaha', model='C40', condition='fair',
+            daily_rate=Decimal('500.00'), description='Nylon strings', location='Mombasa'
+        )
+        fuzzy_utils.reset()
+
+    def test_misspelled_queries_fall_back_to_trigram_matches(self):
+        response = self.client.get(reverse('search_musicians'), {'q': 'guiter mwagi'})
+        self.assertEqual([m.pk for m in response.context['page_obj']], [self.guitarist.pk])
+
+        response = self.client.get(reverse('search_instruments'), {'q': 'yamah sax'})
+        self.assertEqual([i.pk for i in response.context['page_obj']], [self.saxophone.pk])
+
+        self.assertEqual(fuzzy_utils.fuzzy_search_ids('instrument', ['zither']), [])
+
+    def test_index_follows_changes(self):
+        self.assertEqual(fuzzy_utils.fuzzy_search_ids('musician', ['barak']), [self.guitarist.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.guitarist.stage_name = 'Kasuku'
+            self.guitarist.save()
+            self.guitarist.user.first_name = 'Brian'
+            self.guitarist.user.save()
+
+        self.assertEqual(fuzzy_utils.fuzzy_search_ids('musician', ['barak']), [])
+        self.assertEqual(fuzzy_utils.fuzzy_search_ids('musician', ['kasuko']), [self.guitarist.pk])
+
+    def test_python_index_catches_up_after_max_age(self):
+        backend = fuzzy_utils.PythonTrigramBackend()
+        self.assertEqual(backend.search('musician', ['barak'], 10, 0.3, 1), [self.guitarist.pk])
+
+        # Another process renamed the musician, but its version bump never reached this one
+        SearchDocument.objects.filter(kind='musician').update(title='Kasuku')
+        self.assertEqual(backend.search('musician', ['kasuko'], 10, 0.3, 1), [])
+
+        with mock.patch('wafungi.fuzzy_utils.time.monotonic', return_value=time.monotonic() + 301):
+            self.assertEqual(backend.search('musician', ['kasuko'], 10, 0.3, 1), [self.guitarist.pk])
+
+
+class FacetCountTests(TestCase):
+
+    def setUp(self):
+        self.jazz = Genre.objects.create(name='Jazz')
+        self.benga = Genre.objects.create(name='Benga')
+        self.guitar = Instrument.objects.create(name='Guitar', category='Strings')
+        self.drums = Instrument.objects.create(name='Drums', category='Percussion')
+
+        for username, location, genres, instruments in (
+            ('one', 'Nairobi', [self.jazz], [self.guitar]),
+            ('two', 'Nairobi', [self.jazz, self.benga], [self.drums]),
+            ('three', 'Kisumu', [self.benga], [self.guitar]),
+        ):
+            user = User.objects.create_user(username, user_type='musician', location=location)
+            profile = MusicianProfile.objects.create(user=user, stage_name=username.title())
+            profile.genres.set(genres)
+            profile.instruments.set(instruments)
+        hidden = User.objects.create_user('hidden', user_type='musician', location='Nairobi')
+        MusicianProfile.objects.create(user=hidden, availability_status=False).genres.add(self.jazz)
+
+        self.owner = User.objects.create_user('owner', user_type='instrument_owner')
+        for brand, condition, rate in (('Yamaha', 'good', '500'), ('Fender', 'excellent', '2500')):
+            InstrumentListing.objects.create(
+                owner=self.owner, instrument=self.guitar, brand=brand, model='X', condition=condition,
+                daily_rate=Decimal(rate), description='', location='Mombasa'
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_facets()
+
+    def counts(self, facets, name):
+        return {value['name']: value['count'] for value in facets[name]}
+
+    def test_counts_leave_out_own_filter(self):
+        facets = musician_facets(genre=str(self.jazz.pk), location='nairobi')
+
+        self.assertEqual(facets['total'], 2)
+        self.assertEqual(self.counts(facets, 'genre'), {'Benga': 1, 'Jazz': 2})
+        self.assertEqual(self.counts(facets, 'instrument'), {'Drums': 1, 'Guitar': 1})
+        self.assertEqual(self.counts(facets, 'location'), {'Nairobi': 2})
+
+        with self.assertNumQueries(0):
+            facets = musician_facets(instrument=str(self.guitar.pk))
+        self.assertEqual(self.counts(facets, 'location'), {'Kisumu': 1, 'Nairobi': 1})
+
+    def test_index_catches_up_after_max_age(self):
+        self.assertEqual(musician_facets()['total'], 3)
+
+        # Hidden by another process whose version bump never reached this one
+        MusicianProfile.objects.filter(user__username='three').update(availability_status=False)
+        self.assertEqual(musician_facets()['total'], 3)
+
+        with mock.patch('wafungi.facet_utils.time.monotonic', return_value=time.monotonic() + 301):
+            self.assertEqual(musician_facets()['total'], 2)
+
+    def test_instrument_facets_respect_price_and_search(self):
+        facets = instrument_facets(max_price=Decimal('1000'))
+        self.assertEqual(self.counts(facets, 'condition'), {'Excellent': 0, 'Good': 1, 'Fair': 0, 'Poor': 0})
+
+        response = self.client.get(reverse('search_instruments'), {'q': 'fender'})
+        facets = response.context['facets']
+        self.assertEqual(facets['total'], 1)
+        self.assertEqual(self.counts(facets, 'condition')['Excellent'], 1)
+
+    def test_changes_patch_counts_in_place(self):
+        self.assertEqual(self.counts(musician_facets(), 'genre'), {'Benga': 2, 'Jazz': 2})
+        self.assertEqual(instrument_facets()['total'], 2)
+        version = cache.get('facets:version')
+
+        three = MusicianProfile.objects.get(user__username='three')
+        yamaha = InstrumentListing.objects.get(brand='Yamaha')
+        with self.captureOnCommitCallbacks(execute=True):
+            three.genres.add(self.jazz)
+            Genre.objects.create(name='Rhumba')
+            User.objects.filter(username='one').update(location='Kisumu')
+            User.objects.get(username='one').save()
+            yamaha.daily_rate = Decimal('3000')
+            yamaha.save()
+            InstrumentListing.objects.get(brand='Fender').delete()
+            self.benga.delete()
+
+        with mock.patch.dict('wafungi.facet_utils.FACET_BUILDERS', {}):
+            musicians = musician_facets()
+            listings = instrument_facets(max_price=Decimal('2500'))
+        self.assertEqual(self.counts(musicians, 'genre'), {'Jazz': 3, 'Rhumba': 0})
+        self.assertEqual(self.counts(musicians, 'location'), {'Kisumu': 2, 'Nairobi': 1})
+        self.assertEqual(listings['total'], 0)
+        self.assertEqual(self.counts(instrument_facets(), 'condition')['Good'], 1)
+        # Other processes still hear about the changes
+        self.assertGreater(cache.get('facets:version'), version)
+
+    def test_result_count_is_not_taken_from_facets(self):
+        response = self.client.get(reverse('search_musicians'))
+        self.assertIsNone(response.context['page_obj'].count)
+        response = self.client.get(reverse('search_musicians'), {'count': '1'})
+        self.assertEqual(response.context['page_obj'].count, 3)
+
+
+class CursorPaginationTests(TestCase):
+
+    def setUp(self):
+        self.organizer = User.objects.create_user('organizer', user_type='client')
+        start = timezone.now() + timedelta(days=1)
+        # Pairs of events at the same time, so the id breaks ties
+        self.events = [
+            Event.objects.create(
+                organizer=self.organizer, title=f'Gig {i}', description='Live band', event_type='party',
+                date=start + timedelta(days=i // 2), duration_hours=2, location='Nairobi',
+                budget_min=Decimal('1000'), budget_max=Decimal('2000'),
+            )
+            for i in range(25)
+        ]
+
+    def walk(self, url, params=None):
+        ids, cursor = [], None
+        while True:
+            response = self.client.get(url, {**(params or {}), **({'cursor': cursor} if cursor else {})})
+            data = response.json()
+            ids.extend(result['id'] for result in data['results'])
+            cursor = data['next_cursor']
+            if not cursor:
+                return ids, data
+
+    def test_pages_follow_the_keyset_ordering_both_ways(self):
+        ids, last_page = self.walk(reverse('events_api'), {'limit': 10})
+        self.assertEqual(ids, [event.pk for event in sorted(self.events, key=lambda e: (e.date, e.pk))])
+        self.assertNotIn('count', last_page)
+
+        response = self.client.get(reverse('events_api'), {'cursor': last_page['previous_cursor'], 'limit': 10})
+        self.assertEqual([result['id'] for result in response.json()['results']], ids[10:20])
+
+    def test_pages_skip_count_and_offset(self):
+        first = self.client.get(reverse('events_api'), {'limit': 5}).json()
+        with self.assertNumQueries(1) as queries:
+            self.client.get(reverse('events_api'), {'limit': 5, 'cursor': first['next_cursor']})
+        sql = queries.captured_queries[0]['sql']
+        self.assertNotIn('COUNT', sql)
+        self.assertNotIn('OFFSET', sql)
+
+        data = self.client.get(reverse('events_api'), {'limit': 5, 'count': '1'}).json()
+        self.assertEqual(data['count'], 25)
+
+    def test_tampered_cursor_restarts(self):
+        first = self.client.get(reverse('events_api'), {'limit': 5}).json()
+        response = self.client.get(reverse('events_api'), {'limit': 5, 'cursor': first['next_cursor'][:-2] + 'xx'})
+        self.assertEqual(response.json()['results'], first['results'])
+
+    def test_search_results_page_by_rank(self):
+        ids, _ = self.walk(reverse('events_api'), {'q': 'gig band', 'limit': 7})
+        self.assertEqual(sorted(ids), sorted(event.pk for event in self.events))
+
+    def test_listing_pages_render_cursor_links(self):
+        response = self.client.get(reverse('browse_events'), {'event_type': 'party'})
+        self.assertEqual(len(response.context['page_obj']), 12)
+        self.assertContains(response, 'cursor=')
+        self.assertContains(response, 'event_type=party')
+
+        client = User.objects.create_user('client', user_type='client')
+        for event in self.events[:12]:
+            Booking.objects.create(client=client, event=event, start_date=event.date,
+                                   end_date=event.date + timedelta(hours=2), total_amount=Decimal('1000'))
+        self.client.force_login(client)
+        response = self.client.get(reverse('my_bookings'))
+        self.assertEqual(len(response.context['page_obj']), 10)
+        next_page = self.client.get(reverse('my_bookings'), {'cursor': response.context['page_obj'].next_cursor})
+        self.assertEqual(len(next_page.context['page_obj']), 2)
+
+
+class GeoSearchTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', user_type='instrument_owner')
+        guitar = Instrument.objects.create(name='Guitar', category='Strings')
+        self.listings = {}
+        for location in ('Westlands, Nairobi', 'Thika', 'Nakuru', 'Mombasa', 'Somewhere unknown'):
+            self.listings[location] = InstrumentListing.objects.create(
+                owner=self.owner, instrument=guitar, brand='Yamaha', model=location, condition='good',
+                daily_rate=Decimal('500'), description='', location=location
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_facets()
+
+    def ids(self, params):
+        return [result['id'] for result in self.client.get(reverse('instruments_api'), params).json()['results']]
+
+    def test_locations_are_normalized_on_save(self):
+        self.assertEqual(normalize_location('Nairobi CBD'), 'Nairobi')
+        self.assertEqual(normalize_location('nbi'), 'Nairobi')
+        self.assertEqual(normalize_location("Murang'a town"), "Murang'a")
+        self.assertIsNone(normalize_location('Somewhere unknown'))
+
+        listing = self.listings['Westlands, Nairobi']
+        self.assertEqual(listing.town, 'Nairobi')
+        self.assertEqual(listing.geo_cell, '-13:368')
+        self.assertEqual(self.listings['Somewhere unknown'].town, '')
+
+        user = User.objects.create_user('someone', user_type='client', location='MSA')
+        user.location = 'Kisumu'
+        user.save(update_fields=['location'])
+        user.refresh_from_db()
+        self.assertEqual(user.town, 'Kisumu')
+
+    def test_location_filter_matches_the_town(self):
+        self.assertEqual(self.ids({'location': 'nairobi cbd'}), [self.listings['Westlands, Nairobi'].pk])
+        self.assertEqual(self.ids({'location': 'unknown'}), [self.listings['Somewhere unknown'].pk])
+
+    def test_radius_search_sorts_by_distance(self):
+        results = self.client.get(reverse('instruments_api'), {'near': 'Nairobi', 'radius': '200'}).json()['results']
+        self.assertEqual([r['id'] for r in results],
+                         [self.listings[name].pk for name in ('Westlands, Nairobi', 'Thika', 'Nakuru')])
+        self.assertEqual(results[0]['distance_km'], 0)
+        self.assertAlmostEqual(results[1]['distance_km'], 40, delta=5)
+
+        # A radius alone searches around the location text
+        self.assertEqual(self.ids({'location': 'Thika', 'radius': '50'}),
+                         [self.listings[name].pk for name in ('Thika', 'Westlands, Nairobi')])
+
+        musician = User.objects.create_user('musician', user_type='musician', location='Ruiru')
+        profile = MusicianProfile.objects.create(user=musician, stage_name='Ruiru Band')
+        results = self.client.get(reverse('musicians_api'), {'near': 'Nairobi', 'radius': '25'}).json()['results']
+        self.assertEqual([(r['id'], r['town']) for r in results], [(profile.pk, 'Ruiru')])
+
+    def test_nearest_without_radius(self):
+        with override_settings(GEO_NEAREST_K=2):
+            self.assertEqual(self.ids({'near': '-4.05,39.67'}),
+                             [self.listings['Mombasa'].pk, self.listings['Westlands, Nairobi'].pk])
+
+    def test_distance_pages_and_facets(self):
+        ids = []
+        data = self.client.get(reverse('instruments_api'), {'near': 'Nakuru', 'radius': '1000', 'limit': 1}).json()
+        while True:
+            ids.extend(result['id'] for result in data['results'])
+            if not data['next_cursor']:
+                break
+            data = self.client.get(reverse('instruments_api'),
+                                   {'near': 'Nakuru', 'radius': '1000', 'limit': 1, 'cursor': data['next_cursor']}).json()
+        self.assertEqual(ids, [self.listings[name].pk for name in ('Nakuru', 'Thika', 'Westlands, Nairobi', 'Mombasa')])
+
+        response = self.client.get(reverse('search_instruments'), {'near': 'Nairobi', 'radius': '100'})
+        self.assertEqual(response.context['facets']['total'], 2)
+        self.assertContains(response, 'km')
+
+    def test_radius_keeps_the_nearest_matches(self):
+        with override_settings(SEARCH_MAX_RESULTS=2):
+            self.assertEqual(self.ids({'near': 'Nakuru', 'radius': '1000'}),
+                             [self.listings['Nakuru'].pk, self.listings['Thika'].pk])
+            response = self.client.get(reverse('search_instruments'), {'near': 'Nakuru', 'radius': '1000'})
+        self.assertEqual(response.context['facets']['total'], 2)
+
+    def test_large_radius_falls_back_to_coordinates(self):
+        self.assertIsNone(cells_within((-1.29, 36.82), 1500))
+        self.assertEqual(len(self.ids({'near': 'Lodwar', 'radius': '1500'})), 4)
+
+
+class AvailabilityTests(TestCase):
+
+    def setUp(self):
+        self.client_user = User.objects.create_user('client', password='pass', user_type='client')
+        self.musicians = [User.objects.create_user(f'musician{i}', user_type='musician') for i in range(3)]
+        self.profile = MusicianProfile.objects.create(user=self.musicians[0], hourly_rate=Decimal('1000'))
+        self.start = (timezone.now() + timedelta(days=3)).replace(minute=0, second=0, microsecond=0)
+        for musician, hours, status in (
+            (self.musicians[0], (0, 3), 'confirmed'),
+            (self.musicians[0], (2, 5), 'pending'),
+            (self.musicians[1], (10, 12), 'cancelled'),
+            (self.musicians[2], (4, 6), 'pending'),
+        ):
+            Booking.objects.create(
+                client=self.client_user, musician=musician, start_date=self.at(hours[0]),
+                end_date=self.at(hours[1]), total_amount=Decimal('1000'), status=status
+            )
+
+    def at(self, hours):
+        return self.start + timedelta(hours=hours)
+
+    def test_overlap_queries(self):
+        ids = [musician.pk for musician in self.musicians]
+        self.assertFalse(is_free('musician', ids[0], self.at(4), self.at(6)))
+        self.assertTrue(is_free('musician', ids[0], self.at(5), self.at(6)))  # back to back
+        self.assertTrue(is_free('musician', ids[1], self.at(10), self.at(11)))  # cancelled
+        with self.assertNumQueries(1):
+            self.assertEqual(free_among('musician', ids, self.at(4), self.at(5)), [ids[1]])
+
+    def test_interval_index_merges_and_bisects(self):
+        ids = [musician.pk for musician in self.musicians]
+        with self.assertNumQueries(1):
+            index = IntervalIndex.load('musician', ids, self.at(0), self.at(24))
+        self.assertEqual(index.busy_intervals(ids[0]), [(self.at(0), self.at(5))])
+        self.assertEqual(index.busy_intervals(ids[1]), [])
+        self.assertFalse(index.is_free(ids[0], self.at(4), self.at(6)))
+        self.assertTrue(index.is_free(ids[0], self.at(5), self.at(6)))
+        self.assertTrue(index.is_free(ids[2], self.at(1), self.at(4)))
+        self.assertFalse(index.is_free(ids[2], self.at(5), self.at(9)))
+
+    def test_overlapping_booking_is_refused(self):
+        self.client.force_login(self.client_user)
+        url = reverse('book_musician', args=[self.profile.pk])
+        response = self.client.post(url, {
+            'start_date': self.at(4).strftime('%Y-%m-%dT%H:%M'), 'end_date': self.at(6).strftime('%Y-%m-%dT%H:%M'),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'already booked')
+        self.assertEqual(Booking.objects.filter(musician=self.musicians[0]).count(), 2)
+
+        response = self.client.post(url, {
+            'start_date': self.at(5).strftime('%Y-%m-%dT%H:%M'), 'end_date': self.at(6).strftime('%Y-%m-%dT%H:%M'),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Booking.objects.filter(musician=self.musicians[0]).count(), 3)
+
+    def test_availability_api_answers_a_slot(self):
+        self.client.force_login(self.client_user)
+        url = reverse('musician_availability', args=[self.profile.pk])
+        data = self.client.get(url, {'start': self.at(1).isoformat(), 'end': self.at(2).isoformat()}).json()
+        self.assertFalse(data['is_free'])
+        self.assertEqual(data['bookings'], [{'start': self.at(0).isoformat(), 'end': self.at(5).isoformat()}])
+
+    def test_batch_availability_bitmaps(self):
+        other = MusicianProfile.objects.create(user=self.musicians[2])
+        self.client.force_login(self.client_user)
+        data = self.client.get(reverse('batch_availability'), {
+            'ids': f'{self.profile.pk},{other.pk}', 'start': self.start.date().isoformat(),
+            'days': 2, 'resolution': 'hour',
+        }).json()
+        self.assertEqual(data['slots'], 48)
+        offset = (self.start - timezone.make_aware(datetime.combine(self.start.date(), datetime.min.time()))) // timedelta(hours=1)
+        self.assertEqual(int(data['busy'][str(self.profile.pk)], 16), 0b11111 << offset)
+        self.assertEqual(int(data['busy'][str(other.pk)], 16), 0b11 << (offset + 4))
+
+        ids = [self.profile.pk, other.pk]
+        window = timezone.make_aware(datetime.combine(self.start.date(), datetime.min.time()))
+        with self.assertNumQueries(0):
+            cached = cached_busy_bitmaps('musician', ids, window, 48, 'hour')
+        self.assertEqual(cached[self.profile.pk], 0b11111 << offset)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Booking.objects.filter(musician=self.musicians[0]).update(status='cancelled')
+            invalidate_availability()
+        with self.assertNumQueries(1):
+            self.assertEqual(cached_busy_bitmaps('musician', ids, window, 48, 'hour')[self.profile.pk], 0)
+    def test_busy_days_follow_bookings(self):
+        day = timezone.localtime(self.at(0)).date()
+        self.assertTrue(BusyDay.objects.filter(musician=self.musicians[0], day=day).exists())
+        self.assertFalse(BusyDay.objects.filter(musician=self.musicians[1]).exists())  # cancelled
+
+        self.client.force_login(self.client_user)
+        for booking in Booking.objects.filter(musician=self.musicians[0]):
+            self.client.post(reverse('cancel_booking', args=[booking.pk]))
+        self.assertFalse(BusyDay.objects.filter(musician=self.musicians[0]).exists())
+
+        rental = Booking.objects.create(
+            client=self.client_user, instrument_listing=InstrumentListing.objects.create(
+                owner=self.musicians[1], instrument=Instrument.objects.create(name='Guitar', category='Strings'),
+                brand='Yamaha', model='C40', condition='good', daily_rate=Decimal('500'), description='', location='Nairobi'
+            ), start_date=self.start.replace(hour=12), end_date=self.start.replace(hour=12) + timedelta(days=3),
+            total_amount=Decimal('1500')
+        )
+        self.assertEqual(BusyDay.objects.filter(instrument_listing=rental.instrument_listing).count(), 4)
+
+        # Moved, then shortened: the days it left are free again
+        def listing_days():
+            return set(BusyDay.objects.filter(instrument_listing=rental.instrument_listing).values_list('day', flat=True))
+
+        first_day = timezone.localtime(rental.start_date).date()
+        rental.start_date += timedelta(days=7)
+        rental.end_date += timedelta(days=7)
+        rental.save()
+        self.assertEqual(listing_days(), {first_day + timedelta(days=offset) for offset in range(7, 11)})
+        rental.end_date = rental.start_date + timedelta(hours=2)
+        rental.save(update_fields=['end_date'])
+        self.assertEqual(listing_days(), {first_day + timedelta(days=7)})
+
+        # Handed to another musician
+        booking = Booking.objects.get(musician=self.musicians[2])
+        booking.musician = self.musicians[1]
+        booking.save()
+        self.assertFalse(BusyDay.objects.filter(musician=self.musicians[2]).exists())
+        self.assertTrue(BusyDay.objects.filter(musician=self.musicians[1]).exists())
+
+    def test_search_free_on_a_day(self):
+        other = MusicianProfile.objects.create(user=self.musicians[1])
+        day = timezone.localtime(self.at(0)).date().isoformat()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_facets()
+        response = self.client.get(reverse('search_musicians'), {'free_on': day})
+        self.assertEqual([musician.pk for musician in response.context['page_obj']], [other.pk])
+        self.assertEqual(response.context['facets']['total'], 1)
+
+class ConcurrentBookingTests(TransactionTestCase):
+
+    PARALLEL_BOOKINGS = 6
+
+    def test_parallel_bookings_of_one_slot_succeed_once(self):
+        client_user = User.objects.create_user('client', user_type='client')
+        musician = User.objects.create_user('musician', user_type='musician')
+        start = timezone.now() + timedelta(days=2)
+
+        def attempt(offset):
+            try:
+                book(Booking(
+                    client=client_user, musician=musician, start_date=start + timedelta(minutes=offset),
+                    end_date=start + timedelta(hours=2), total_amount=Decimal('1000')
+                ))
+                return True
+            except BookingConflict:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.PARALLEL_BOOKINGS) as pool:
+            results = list(pool.map(attempt, range(self.PARALLEL_BOOKINGS)))
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(Booking.objects.filter(musician=musician).count(), 1)
+
+
+class CalendarFeedTests(TestCase):
+
+    def setUp(self):
+        self.client_user = User.objects.create_user('client', first_name='Amina', user_type='client')
+        self.musician = User.objects.create_user('musician', user_type='musician')
+        start = timezone.now() + timedelta(days=5)
+        self.booking = Booking.objects.create(
+            client=self.client_user, musician=self.musician, start_date=start, end_date=start + timedelta(hours=3),
+            total_amount=Decimal('3000'), status='confirmed', notes='Bring the keyboard; sound check at 5, please'
+        )
+        self.url = reverse('calendar_feed', args=[feed_token(self.musician)])
+
+    def test_feed_lists_bookings(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        body = b''.join(response.streaming_content).decode()
+        self.assertTrue(body.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertIn(f'UID:booking-{self.booking.pk}@testserver', body)
+        self.assertIn('SUMMARY:Booking with Amina', body)
+        self.assertIn('STATUS:CONFIRMED', body)
+        self.assertIn('Bring the keyboard\\; sound check at 5\\, please', body.replace('\r\n ', ''))
+        self.assertTrue(all(len(line.encode()) <= 75 for line in body.split('\r\n')))
+
+        # Rendered once per ETag
+        self.assertEqual(self.client.get(self.url).content.decode(), body)
+
+    def test_unchanged_feed_is_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        self.booking.status = 'cancelled'
+        self.booking.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('STATUS:CANCELLED', b''.join(response.streaming_content).decode())
+
+    def test_feed_changes_with_the_rows_it_shows(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client_user.first_name = 'Wanjiru'
+        self.client_user.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('SUMMARY:Booking with Wanjiru', b''.join(response.streaming_content).decode())
+
+        event = Event.objects.create(
+            organizer=self.client_user, title='Gala', description='Dinner', event_type='corporate',
+            date=self.booking.start_date, duration_hours=3, location='Nairobi',
+            budget_min=Decimal('1000'), budget_max=Decimal('5000'),
+        )
+        self.booking.event = event
+        self.booking.save()
+        etag = self.client.get(self.url)['ETag']
+        event.location = 'Mombasa'
+        event.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('LOCATION:Mombasa', b''.join(response.streaming_content).decode())
+
+    def test_bad_token_is_not_found(self):
+        self.assertEqual(self.client.get(reverse('calendar_feed', args=['1:forged'])).status_code, 404)
+
+
+class DashboardSummaryTests(TestCase):
+
+    def setUp(self):
+        self.organizer = User.objects.create_user('organizer', password='pw', user_type='organizer')
+        self.musician = User.objects.create_user('musician', password='pw', user_type='musician')
+        MusicianProfile.objects.create(user=self.musician, hourly_rate=Decimal('1500'))
+        # Summaries exist before the changes below, so these exercise the incremental path
+        get_summary(self.organizer)
+        get_summary(self.musician)
+
+    def assertMatchesRebuild(self, user):
+        summary = DashboardSummary.objects.get(user=user)
+        rebuilt = build_summary(user.pk)
+        for field in ('total_earnings', 'bookings_made', 'bookings_received', 'pending_requests', 'events_created',
+                      'instruments_listed', 'applications_sent', 'pending_applications', 'unread_notifications'):
+            self.assertEqual(getattr(summary, field), getattr(rebuilt, field), field)
+        return summary
+
+    def make_booking(self, **fields):
+        start = timezone.now() + timedelta(days=3)
+        return Booking.objects.create(
+            client=self.organizer, musician=self.musician, start_date=start, end_date=start + timedelta(hours=2),
+            total_amount=Decimal('3000'), **fields
+        )
+
+    def test_counters_follow_changes(self):
+        event = Event.objects.create(
+            organizer=self.organizer, title='Gala', description='Dinner', event_type='corporate',
+            date=timezone.now() + timedelta(days=7), duration_hours=3, location='Nairobi',
+            budget_min=Decimal('1000'), budget_max=Decimal('5000'),
+        )
+        application = EventApplication.objects.create(
+            event=event, musician=self.musician, cover_letter='Hi', proposed_rate=Decimal('2000')
+        )
+        booking = self.make_booking()
+        notification = Notification.objects.create(user=self.musician, title='New booking', message='...')
+
+        summary = self.assertMatchesRebuild(self.musician)
+        self.assertEqual((summary.bookings_received, summary.pending_requests, summary.unread_notifications), (1, 1, 1))
+        summary = self.assertMatchesRebuild(self.organizer)
+        self.assertEqual((summary.bookings_made, summary.events_created, summary.pending_applications), (1, 1, 1))
+
+        booking.status = 'confirmed'
+        booking.payment_status = True
+        booking.save()
+        application.status = 'accepted'
+        application.save()
+        notification.is_read = True
+        notification.save()
+        summary = self.assertMatchesRebuild(self.musician)
+        self.assertEqual((summary.total_earnings, summary.pending_requests, summary.unread_notifications),
+                         (Decimal('3000'), 0, 0))
+        self.assertEqual(self.assertMatchesRebuild(self.organizer).pending_applications, 0)
+
+        event.delete()
+        booking.delete()
+        self.assertEqual(self.assertMatchesRebuild(self.musician).applications_sent, 0)
+        self.assertEqual(self.assertMatchesRebuild(self.organizer).events_created, 0)
+
+    def test_payments_update_counters(self):
+        bookings = [self.make_booking(status='confirmed') for _ in range(3)]
+        for number, booking in enumerate(bookings):
+            PaymentTransaction.objects.create(
+                booking=booking, checkout_request_id=f'ws_CO_SUMMARY_{number}',
+                phone_number='254712345678', amount=booking.total_amount
+            )
+        complete_payment('ws_CO_SUMMARY_0', 'RCPT0')
+        settle_payments_in_bulk(completed={'ws_CO_SUMMARY_1': 'RCPT1', 'ws_CO_SUMMARY_2': None})
+
+        summary = self.assertMatchesRebuild(self.musician)
+        self.assertEqual(summary.total_earnings, Decimal('9000'))
+        self.assertEqual(summary.unread_notifications, 3)
+        self.assertMatchesRebuild(self.organizer)
+
+    def test_admin_actions_and_read_notifications(self):
+        bookings = [self.make_booking() for _ in range(2)]
+        notifications = [Notification.objects.create(user=self.musician, title='Hi', message='...') for _ in range(2)]
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        self.client.post(reverse('admin:wafungi_booking_changelist'), {
+            'action': 'mark_as_confirmed', '_selected_action': [booking.pk for booking in bookings],
+        })
+        self.assertEqual(self.assertMatchesRebuild(self.musician).pending_requests, 0)
+
+        # Saves that leave every counted field alone skip the read-back
+        notifications[0].title = 'Hello'
+        with self.assertNumQueries(1):
+            notifications[0].save(update_fields=['title'])
+
+        self.client.login(username='musician', password='pw')
+        url = reverse('mark_notification_read', args=[notifications[1].pk])
+        for _ in range(2):
+            self.assertEqual(self.client.post(url).json(), {'success': True})
+            self.assertEqual(self.assertMatchesRebuild(self.musician).unread_notifications, 1)
+        response = self.client.post(reverse('mark_notification_read', args=[notifications[1].pk + 100]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_dashboard_reads_summary(self):
+        for _ in range(7):
+            self.make_booking()
+        DashboardSummary.objects.all().delete()  # built again on first visit
+        self.client.login(username='organizer', password='pw')
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['summary'].bookings_made, 7)
+        self.assertEqual(len(response.context['my_bookings']), 5)
+        self.assertContains(response, '<h4>7</h4>', html=True)
+
+
+class QueryCountTests(TestCase):
+    """Pages run the same number of queries however many rows they list"""
+
+    def setUp(self):
+        self.guitar = Instrument.objects.create(name='Guitar', category='Strings')
+        self.gospel = Genre.objects.create(name='Gospel')
+        self.client_user = User.objects.create_user('client', password='pw', user_type='client')
+        self.organizer = User.objects.create_user('organizer', password='pw', user_type='organizer')
+        self.owner = User.objects.create_user('owner', password='pw', user_type='instrument_owner')
+        self.musician = User.objects.create_user('musician', password='pw', user_type='musician')
+        self.profile = MusicianProfile.objects.create(user=self.musician, hourly_rate=Decimal('1500'))
+        self.profile.genres.add(self.gospel)
+        self.profile.instruments.add(self.guitar)
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.rounds = 0
+
+    def add_rows(self, count=3):
+        """Bookings, listings, events, applications, reviews and notifications touching every test user"""
+        start = timezone.now() + timedelta(days=3)
+        for _ in range(count):
+            self.rounds += 1
+            n = self.rounds
+            other = User.objects.create_user(f'musician{n}', first_name='Extra', user_type='musician')
+            MusicianProfile.objects.create(user=other, rating=Decimal('4.5')).genres.add(self.gospel)
+            listing = InstrumentListing.objects.create(
+                owner=self.owner, instrument=Instrument.objects.create(name=f'Drum {n}', category='Percussion'),
+                brand='Pearl', model=f'Export {n}', condition='good', daily_rate=Decimal('1000'),
+                description='Drum kit', location='Nairobi',
+            )
+            event = Event.objects.create(
+                organizer=self.organizer, title=f'Gala {n}', description='Dinner', event_type='corporate',
+                date=start, duration_hours=3, location='Nairobi', budget_min=Decimal('1000'), budget_max=Decimal('5000'),
+            )
+            EventApplication.objects.create(
+                event=event, musician=self.musician, cover_letter='Hi', proposed_rate=Decimal('2000')
+            )
+            for client in (self.client_user, self.organizer):
+                Booking.objects.create(
+                    client=client, musician=self.musician, start_date=start, end_date=start + timedelta(hours=2),
+                    total_amount=Decimal('3000'),
+                )
+                Booking.objects.create(
+                    client=client, instrument_listing=listing, start_date=start, end_date=start + timedelta(days=1),
+                    total_amount=Decimal('1000'),
+                )
+            completed = Booking.objects.create(
+                client=other, musician=self.musician, start_date=start, end_date=start + timedelta(hours=2),
+                total_amount=Decimal('3000'), status='completed',
+            )
+            Review.objects.create(booking=completed, reviewer=other, reviewee=self.musician, rating=5, comment='Great')
+            for user in (self.client_user, self.organizer, self.owner, self.musician):
+                Notification.objects.create(user=user, title='Update', message='Something happened')
+
+    def queries(self, url):
+        self.client.get(url)  # warm sessions, summaries and caches
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return len(context)
+
+    def assertConstantQueries(self, username, url):
+        self.client.login(username=username, password='pw')
+        self.add_rows()
+        before = self.queries(url)
+        self.add_rows()
+        self.assertEqual(self.queries(url), before, f'{url} as {username}')
+
+    def test_dashboards(self):
+        for username in ('client', 'organizer', 'owner', 'musician'):
+            with self.subTest(username=username):
+                self.assertConstantQueries(username, reverse('dashboard'))
+
+    def test_my_bookings(self):
+        for username in ('client', 'owner', 'musician'):
+            with self.subTest(username=username):
+                self.assertConstantQueries(username, reverse('my_bookings'))
+
+    def test_owner_dashboard_links_to_all_pending_requests(self):
+        self.add_rows(6)  # 12 pending rentals
+        self.client.login(username='owner', password='pw')
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(len(response.context['pending_requests']), 10)
+        self.assertContains(response, 'View all 12 pending requests')
+
+        accepted = Booking.objects.filter(instrument_listing__owner=self.owner).first()
+        accepted.status = 'confirmed'
+        accepted.save()
+        page = self.client.get(reverse('my_bookings'), {'status': 'pending'}).context['page_obj']
+        self.assertEqual({booking.status for booking in page}, {'pending'})
+        self.assertTrue(page.has_next)
+        self.assertEqual(len(self.client.get(reverse('my_bookings'), {'status': 'pending', 'cursor': page.next_cursor})
+                             .context['page_obj']), 1)
+
+    def test_listing_pages(self):
+        self.assertConstantQueries('musician', reverse('home'))
+        self.assertConstantQueries('musician', reverse('browse_events'))
+        self.assertConstantQueries('musician', reverse('my_applications'))
+        self.assertConstantQueries('client', reverse('musician_detail', args=[self.profile.pk]))
+        self.assertConstantQueries('admin', reverse('admin:wafungi_booking_changelist'))
+
+    def test_booking_detail(self):
+        self.add_rows(1)
+        self.client.login(username='client', password='pw')
+        for booking in Booking.objects.filter(client=self.client_user):
+            with self.subTest(booking=booking.pk), self.assertNumQueries(3):
+                self.client.get(reverse('booking_detail', args=[booking.pk]))
+
+
+class RequestBudgetTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('client', password='pw', user_type='client')
+        self.client.login(username='client', password='pw')
+
+    def timings(self, response):
+        return {part.split(';')[0].strip(): part for part in response['Server-Timing'].split(',')}
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('my_bookings'))
+        timings = self.timings(response)
+        self.assertEqual(set(timings), {'db', 'tpl', 'view', 'total'})
+        self.assertIn(f'desc="{len(context)} queries"', timings['db'])
+        self.assertNotIn('tpl;dur=0.0', timings['tpl'])
+
+    @override_settings(REQUEST_BUDGETS={'my_bookings': {'queries': 1}}, REQUEST_BUDGET_STRICT=False)
+    def test_over_budget_is_flagged(self):
+        with self.assertLogs('wafungi.middleware', 'WARNING') as logs:
+            response = self.client.get(reverse('my_bookings'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('budget;desc="over: queries', response['Server-Timing'])
+        self.assertEqual(logs.records[0].timings['url_name'], 'my_bookings')
+
+    @override_settings(REQUEST_BUDGETS={'my_bookings': {'queries': 1}}, REQUEST_BUDGET_STRICT=True)
+    def test_strict_budget_fails_request(self):
+        with self.assertLogs('wafungi.middleware', 'WARNING'), self.assertRaises(RequestBudgetExceeded):
+            self.client.get(reverse('my_bookings'))
+        # Within budget elsewhere
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+    async def test_async_requests_stay_on_the_event_loop(self):
+        async def view(request):
+            await User.objects.acount()
+            return HttpResponse()
+
+        middleware = RequestBudgetMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertTrue(iscoroutinefunction(middleware.process_view))
+        request = RequestFactory().get('/')
+        request.resolver_match = None
+
+        response = await middleware(request)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    def test_queries_in_other_threads_are_counted(self):
+        def query():
+            try:
+                User.objects.count()
+            finally:
+                connections.close_all()
+
+        with collect_timings() as timings:
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(query,))
+            thread.start()
+            thread.join()
+        self.assertEqual(timings.queries, 1)
+
+
+class GenerateFakeDataTests(TestCase):
+
+    def generate(self, prefix, seed=7):
+        call_command('generate_fake_data', scale=0.02, seed=seed, prefix=prefix, stdout=StringIO())
+        bookings = Booking.objects.filter(client__username__startswith=f'{prefix}_').order_by('pk')
+        return list(bookings.values_list('status', 'total_amount', 'payment_status'))
+
+    def test_dataset_is_seeded_and_consistent(self):
+        first = self.generate('one')
+        self.assertEqual(len(first), 200)
+        self.assertEqual(self.generate('two'), first)
+        self.assertNotEqual(self.generate('three', seed=8), first)
+
+        self.assertEqual(User.objects.filter(username__startswith='one_musician_').count(), 20)
+        self.assertTrue(MusicianProfile.objects.filter(user__username__startswith='one_', genres__isnull=False).exists())
+        self.assertEqual(
+            PaymentTransaction.objects.filter(booking__client__username__startswith='one_').count(),
+            sum(paid for *_, paid in first),
+        )
+        for booking in Booking.objects.filter(client__username__startswith='one_', status__in=('pending', 'confirmed')):
+            self.assertFalse(
+                Booking.objects.filter(
+                    musician_id=booking.musician_id, instrument_listing_id=booking.instrument_listing_id,
+                    start_date__lt=booking.end_date, end_date__gt=booking.start_date,
+                ).exclude(pk=booking.pk).exists()
+            )
+            resource = {'musician_id': booking.musician_id} if booking.musician_id else {
+                'instrument_listing_id': booking.instrument_listing_id
+            }
+            self.assertTrue(BusyDay.objects.filter(day=timezone.localtime(booking.start_date).date(), **resource).exists())
+
+        with self.assertRaises(CommandError):
+            self.generate('one')
+
+
+class BenchmarkTests(TestCase):
+
+    def test_baseline_round_trip_and_regressions(self):
+        call_command('generate_fake_data', scale=0.02, seed=3, prefix='bench', stdout=StringIO())
+        bookings = Booking.objects.count()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/baseline.json'
+            call_command('run_benchmarks', iterations=2, warmup=0, save=path, stdout=StringIO())
+            with open(path) as f:
+                saved = json.load(f)
+
+            self.assertEqual(Booking.objects.count(), bookings)
+            for name in ('home', 'browse_events', 'dashboard_client', 'dashboard_musician', 'search_api',
+                         'mpesa_callback', 'generate_payment_receipt_pdf', 'send_email_with_template'):
+                self.assertIn(name, saved['results'])
+            self.assertGreater(saved['results']['dashboard_client']['queries'], 0)
+
+            saved['results']['home']['queries'] -= 1
+            with open(path, 'w') as f:
+                json.dump(saved, f)
+            with self.assertRaisesMessage(CommandError, '1 regressions'):
+                call_command('run_benchmarks', iterations=2, warmup=0, only=['home'], compare=path, stdout=StringIO())
+
+    def test_compare_needs_relative_and_absolute_slowdown(self):
+        base = {'results': {'fast': {'p50_ms': 1.0, 'queries': 2}, 'slow': {'p50_ms': 100.0, 'queries': 2}}}
+        results = {'fast': {'p50_ms': 2.5, 'queries': 2}, 'slow': {'p50_ms': 130.0, 'queries': 2}}
+        self.assertEqual([name for name, _ in compare(results, base)], ['slow'])
+        self.assertEqual(compare(results, base, threshold=0.5), [])
 
-# Create your tests here.
@@ -0,0 +1,145 @@
+"""
+Where a request's time goes: SQL queries, template rendering and the view
+
+RequestTimings collects the numbers for the request being served. Queries
+are counted by a database execute wrapper and templates are timed by the
+TimedDjangoTemplates backend, both of which only read a clock and add to
+the active RequestTimings, so the bookkeeping stays cheap enough to leave on.
+The middleware in middleware.py reports and checks the totals.
+
+The active timings live in a context variable and the execute wrapper is
+installed on every connection as it connects, in whichever thread, so
+queries an async view runs through sync_to_async are counted too. Threads
+started without the caller's context (a plain ThreadPoolExecutor) are not.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates, Template
+
+# Every RequestTimings collecting in this context, innermost last
+_active = ContextVar('wafungi_request_timings', default=())
+
+
+class RequestTimings:
+    """Query count and durations (seconds) of one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.queries = 0
+        self.db = 0.0
+        self.template = 0.0
+        self.view = 0.0
+        self.total = 0.0
+        # Queries may finish in several sync_to_async threads at once
+        self._lock = threading.Lock()
+
+    def add_query(self, duration):
+        with self._lock:
+            self.db += duration
+            self.queries += 1
+
+    def start_view(self):
+        if self.view_started is None:
+            self.view_started = time.perf_counter()
+
+    def finish(self):
+        now = time.perf_counter()
+        self.total = now - self.started
+        if self.view_started is not None:
+            self.view = now - self.view_started
+
+    def as_dict(self):
+        """Totals in milliseconds, for logs"""
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db * 1000, 1),
+            'template_ms': round(self.template * 1000, 1),
+            'view_ms': round(self.view * 1000, 1),
+            'total_ms': round(self.total * 1000, 1),
+        }
+
+    def server_timing(self):
+        """Server-Timing header value"""
+        return ', '.join((
+            f'db;dur={self.db * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template * 1000:.1f}',
+            f'view;dur={self.view * 1000:.1f}',
+            f'total;dur={self.total * 1000:.1f}',
+        ))
+
+
+def current_timings():
+    """RequestTimings of the request being served, None outside one"""
+    active = _active.get()
+    return active[-1] if active else None
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding each query to the active timings"""
+    active = _active.get()
+    if not active:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        for timings in active:
+            timings.add_query(duration)
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def _install_on_connect(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+@contextmanager
+def collect_timings():
+    """Record queries on every database connection and template time while the block runs"""
+    timings = RequestTimings()
+    # Connections opened before this module was imported never sent connection_created
+    for connection in connections.all(initialized_only=True):
+        install_query_recorder(connection)
+    token = _active.set((*_active.get(), timings))
+    try:
+        yield timings
+    finally:
+        _active.reset(token)
+        timings.finish()
+
+
+class TimedTemplate(Template):
+
+    def render(self, context=None, request=None):
+        active = _active.get()
+        if not active:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            duration = time.perf_counter() - started
+            for timings in active:
+                timings.template += duration
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, adding render time to the request's timings"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
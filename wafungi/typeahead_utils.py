@@ -0,0 +1,247 @@
+"""
+In-memory typeahead suggestions for the search box
+
+Musicians, instrument listings, events, genres and instrument types are
+held in a sorted array of (word, entry) keys, so a prefix lookup is a binary
+search plus a short scan and never touches the database. The index is built
+in one pass on first use and patched in place by the save/delete signals;
+other processes see a bumped version in the cache and rebuild on their next
+lookup. Without a shared cache they never see it, so the index is also
+rebuilt after SEARCH_INDEX_MAX_AGE seconds. Responses are cached per
+normalized query and index version for TYPEAHEAD_CACHE_TIMEOUT seconds.
+"""
+import hashlib
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Event, Genre, Instrument, InstrumentListing, MusicianProfile
+from .search_utils import tokenize
+
+SUGGESTION_TYPES = ('musician', 'instrument', 'event', 'genre', 'instrument_type')
+SUGGESTIONS_PER_TYPE = 5
+
+
+# Suggestions
+
+def musician_suggestion(profile):
+    user = profile.user
+    full_name = f"{user.first_name} {user.last_name}"
+    suggestion = {
+        'type': 'musician',
+        'id': profile.id,
+        'name': profile.stage_name or full_name,
+        'url': f"/musicians/{profile.id}/",
+        'image': user.profile_picture.url if user.profile_picture else None,
+    }
+    return suggestion, f"{profile.stage_name} {full_name}"
+
+
+def instrument_suggestion(listing):
+    suggestion = {
+        'type': 'instrument',
+        'id': listing.id,
+        'name': f"{listing.brand} {listing.model}",
+        'url': f"/instruments/{listing.id}/",
+        'image': listing.image.url if listing.image else None,
+    }
+    return suggestion, f"{suggestion['name']} {listing.instrument.name}"
+
+
+def event_suggestion(event):
+    suggestion = {'type': 'event', 'id': event.id, 'name': event.title, 'url': f"/events/{event.id}/"}
+    return suggestion, event.title
+
+
+def genre_suggestion(genre):
+    suggestion = {'type': 'genre', 'id': genre.id, 'name': genre.name, 'url': f"/musicians/?genre={genre.id}"}
+    return suggestion, genre.name
+
+
+def instrument_type_suggestion(instrument):
+    suggestion = {
+        'type': 'instrument_type',
+        'id': instrument.id,
+        'name': instrument.name,
+        'url': f"/instruments/?instrument={instrument.id}",
+    }
+    return suggestion, instrument.name
+
+
+SUGGESTION_SOURCES = {
+    'musician': (lambda: MusicianProfile.objects.select_related('user'), musician_suggestion),
+    'instrument': (lambda: InstrumentListing.objects.select_related('instrument'), instrument_suggestion),
+    'event': (lambda: Event.objects.all(), event_suggestion),
+    'genre': (lambda: Genre.objects.all(), genre_suggestion),
+    'instrument_type': (lambda: Instrument.objects.all(), instrument_type_suggestion),
+}
+
+
+def normalize_query(query):
+    return ' '.join(tokenize(query))
+
+
+# Index
+
+class PrefixIndex:
+    """Suggestions of one type, looked up by word prefix in a sorted key array"""
+
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+
+    def add(self, object_id, suggestion, text):
+        self.remove(object_id)
+        words = tuple(dict.fromkeys(tokenize(text)))
+        self.entries[object_id] = (suggestion, words, suggestion['name'].lower())
+        for word in words:
+            insort(self.keys, (word, object_id))
+
+    def load(self, items):
+        """Bulk load (object_id, suggestion, text) items, sorting once"""
+        for object_id, suggestion, text in items:
+            words = tuple(dict.fromkeys(tokenize(text)))
+            self.entries[object_id] = (suggestion, words, suggestion['name'].lower())
+            self.keys.extend((word, object_id) for word in words)
+        self.keys.sort()
+
+    def remove(self, object_id):
+        entry = self.entries.pop(object_id, None)
+        if entry is None:
+            return
+        for word in entry[1]:
+            position = bisect_left(self.keys, (word, object_id))
+            if position < len(self.keys) and self.keys[position] == (word, object_id):
+                del self.keys[position]
+
+    def lookup(self, terms, limit):
+        """
+        Suggestions whose words start with every term
+
+        Names that start with the query come first, then alphabetical order.
+        """
+        # Scan the postings of the most selective term: the longest one
+        anchor = max(terms, key=len)
+        start = bisect_left(self.keys, (anchor,))
+        end = bisect_left(self.keys, (anchor + '\uffff',), start)
+        candidates = {object_id for _, object_id in self.keys[start:end]}
+
+        phrase = ' '.join(terms)
+        others = [term for term in terms if term != anchor]
+        matches = []
+        for object_id in candidates:
+            suggestion, words, name = self.entries[object_id]
+            if all(any(word.startswith(term) for word in words) for term in others):
+                matches.append((not name.startswith(phrase), name, object_id))
+        return [self.entries[object_id][0] for _, _, object_id in heapq.nsmallest(limit, matches)]
+
+
+class Typeahead:
+    """Prefix indexes for every suggestion type, shared by the process"""
+
+    VERSION_KEY = 'typeahead:index-version'
+
+    def __init__(self):
+        self.indexes = None
+        self.version = None
+        self.expires_at = 0.0
+        self.lock = threading.RLock()
+
+    def current_version(self):
+        return cache.get(self.VERSION_KEY, 0)
+
+    def ensure_loaded(self):
+        version = self.current_version()
+        with self.lock:
+            now = time.monotonic()
+            if self.indexes is None or version != self.version or now >= self.expires_at:
+                self.indexes = self.build()
+                self.version = version
+                self.expires_at = now + getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+
+    def build(self):
+        indexes = {}
+        for kind, (queryset, build) in SUGGESTION_SOURCES.items():
+            index = PrefixIndex()
+            index.load((obj.pk, *build(obj)) for obj in queryset().iterator(chunk_size=2000))
+            indexes[kind] = index
+        return indexes
+
+    def suggest(self, query, limit=SUGGESTIONS_PER_TYPE):
+        """Suggestions for ``query`` grouped in SUGGESTION_TYPES order"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        self.ensure_loaded()
+        results = []
+        with self.lock:
+            for kind in SUGGESTION_TYPES:
+                results.extend(self.indexes[kind].lookup(terms, limit))
+        return results
+
+    def bump_version(self):
+        if not cache.add(self.VERSION_KEY, 1, timeout=None):
+            try:
+                cache.incr(self.VERSION_KEY)
+            except ValueError:
+                cache.set(self.VERSION_KEY, 1, timeout=None)
+        # Our own indexes are already current
+        self.version = self.current_version()
+
+    def object_changed(self, kind, obj):
+        suggestion, text = SUGGESTION_SOURCES[kind][1](obj)
+        with self.lock:
+            if self.indexes is not None:
+                self.indexes[kind].add(obj.pk, suggestion, text)
+            self.bump_version()
+
+    def object_removed(self, kind, object_id):
+        with self.lock:
+            if self.indexes is not None:
+                self.indexes[kind].remove(object_id)
+            self.bump_version()
+
+    def reset(self):
+        with self.lock:
+            self.indexes = None
+            self.bump_version()
+
+
+typeahead = Typeahead()
+
+
+def suggestion_changed(kind, obj):
+    """Update an object's suggestion once the surrounding transaction commits"""
+    transaction.on_commit(lambda: typeahead.object_changed(kind, obj))
+
+
+def suggestion_removed(kind, object_id):
+    transaction.on_commit(lambda: typeahead.object_removed(kind, object_id))
+
+
+def get_suggestions(query):
+    """
+    Typeahead suggestions for a search box query, cached per normalized query
+
+    Args:
+        query (str): What the user has typed so far
+
+    Returns:
+        list: Suggestion dicts with type, id, name, url (and image)
+    """
+    normalized = normalize_query(query)
+    if not normalized:
+        return []
+
+    digest = hashlib.md5(normalized.encode()).hexdigest()
+    cache_key = f"typeahead:{typeahead.current_version()}:{digest}"
+    results = cache.get(cache_key)
+    if results is None:
+        results = typeahead.suggest(normalized)
+        cache.set(cache_key, results, getattr(settings, 'TYPEAHEAD_CACHE_TIMEOUT', 300))
+    return results
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from django.contrib.auth import views as auth_views
-from . import views, api_views 
+from . import views, api_views, async_views
 
 urlpatterns = [
     # Home and dashboard
@@ -44,6 +44,7 @@ urlpatterns = [
     
     # Bookings
     path('bookings/', views.my_bookings, name='my_bookings'),
+    path('bookings/calendar/<str:token>.ics', views.calendar_feed, name='calendar_feed'),
     path('bookings/<int:booking_id>/', views.booking_detail, name='booking_detail'),
     path('bookings/<int:booking_id>/accept/', views.accept_booking, name='accept_booking'),
     path('bookings/<int:booking_id>/decline/', views.decline_booking, name='decline_booking'),
@@ -53,6 +54,9 @@ urlpatterns = [
     # Payments
     path('bookings/<int:booking_id>/payment/', views.payment_process, name='payment_process'),
     path('bookings/<int:booking_id>/payment/status/<str:checkout_request_id>/', views.payment_status, name='payment_status'),
+    path('bookings/<int:booking_id>/payment/async/', async_views.payment_process_async, name='payment_process_async'),
+    path('bookings/<int:booking_id>/payment/async/status/<str:checkout_request_id>/', async_views.payment_status_async, name='payment_status_async'),
+    path('bookings/<int:booking_id>/payment/status/<str:checkout_request_id>/events/', async_views.payment_status_events, name='payment_status_events'),
     path('bookings/<int:booking_id>/payment/success/', views.payment_success, name='payment_success'),
     path('bookings/<int:booking_id>/payment/cancel/', views.payment_cancel, name='payment_cancel'),
     path('bookings/<int:booking_id>/receipt/download/', views.download_receipt, name='download_receipt'),
@@ -62,8 +66,15 @@ urlpatterns = [
     path('api/mark-notification-read/<int:notification_id>/', api_views.mark_notification_read, name='mark_notification_read'),
     path('api/musician/<int:musician_id>/availability/', api_views.get_musician_availability, name='musician_availability'),
     path('api/instrument/<int:instrument_id>/availability/', api_views.get_instrument_availability, name='instrument_availability'),
+    path('api/availability/', api_views.batch_availability, name='batch_availability'),
     path('api/search/', api_views.search_api, name='search_api'),
     path('api/send-message/', api_views.send_message_to_owner, name='send_message_to_owner'),
+    path('api/mpesa/pool-stats/', api_views.mpesa_pool_stats, name='mpesa_pool_stats'),
+    path('api/musicians/', api_views.musicians_api, name='musicians_api'),
+    path('api/instruments/', api_views.instruments_api, name='instruments_api'),
+    path('api/events/', api_views.events_api, name='events_api'),
+    path('api/bookings/', api_views.bookings_api, name='bookings_api'),
+    path('api/applications/', api_views.applications_api, name='applications_api'),
     
     # Password reset
     path('password-reset/', auth_views.PasswordResetView.as_view(template_name='registration/password_reset_form.html'), name='password_reset'),
@@ -1,11 +1,14 @@
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
-from django.core.paginator import Paginator
-from django.db.models import Q, Avg, Sum
+from django.http import JsonResponse, HttpResponse, Http404, StreamingHttpResponse
+from django.db.models import Avg
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.template.loader import render_to_string
@@ -24,11 +27,21 @@ from .forms import (
     EventApplicationForm
 )
 from .email_utils import (
-    send_booking_confirmation_email, send_payment_receipt_email,
+    send_booking_confirmation_email,
     send_booking_status_update_email, send_welcome_email
 )
-from .mpesa_utils import process_mpesa_payment, handle_mpesa_callback
+from .mpesa_utils import UNAVAILABLE_MESSAGE, payments_available, process_mpesa_payment
+from .payment_utils import complete_payment, process_callback_inbox, store_mpesa_callback
 from .pdf_utils import generate_payment_receipt_pdf
+from .availability_utils import BookingConflict, book
+from .calendar_utils import cached_feed, feed_token, feed_validators, user_for_token
+from .facet_utils import instrument_facets, musician_facets
+from .listing_utils import (
+    BOOKING_RELATED, application_listing, booking_listing, event_listing, instrument_listing, musician_listing,
+    parse_price,
+)
+from .pagination_utils import cursor_page
+from .summary_utils import get_summary
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +51,7 @@ def home(request):
     featured_musicians = MusicianProfile.objects.filter(
         user__is_active=True,
         availability_status=True
-    ).order_by('-rating', '-total_gigs')[:6]
+    ).select_related('user').prefetch_related('genres').order_by('-rating', '-total_gigs')[:6]
     
     # Get upcoming events
     upcoming_events = Event.objects.filter(
@@ -49,7 +62,7 @@ def home(request):
     # Get featured instruments
     featured_instruments = InstrumentListing.objects.filter(
         is_available=True
-    ).order_by('-created_at')[:6]
+    ).select_related('owner', 'instrument').order_by('-created_at')[:6]
     
     context = {
         'featured_musicians': featured_musicians,
@@ -62,30 +75,27 @@ def home(request):
 def dashboard(request):
     """User dashboard view"""
     user = request.user
-    context = {'user': user}
+    # Totals come from the user's running summary; only the short recent lists are queried
+    summary = get_summary(user)
+    context = {'user': user, 'summary': summary}
     
     # Get user-specific data based on user type
     if user.user_type == 'musician':
         try:
-            profile = user.musicianprofile
+            profile = MusicianProfile.objects.prefetch_related('genres', 'instruments').get(user=user)
             recent_bookings = Booking.objects.filter(
                 musician=user
-            ).order_by('-created_at')[:5]
-            
-            total_earnings = Booking.objects.filter(
-                musician=user,
-                payment_status=True
-            ).aggregate(total=Sum('total_amount'))['total'] or 0
+            ).select_related(*BOOKING_RELATED).order_by('-created_at')[:5]
             
             # Get event applications
             my_applications = EventApplication.objects.filter(
                 musician=user
-            ).order_by('-applied_at')[:5]
+            ).select_related('event', 'event__organizer').order_by('-applied_at')[:5]
             
             context.update({
                 'profile': profile,
                 'recent_bookings': recent_bookings,
-                'total_earnings': total_earnings,
+                'total_earnings': summary.total_earnings,
                 'my_applications': my_applications,
             })
         except MusicianProfile.DoesNotExist:
@@ -96,7 +106,7 @@ def dashboard(request):
         my_events = Event.objects.filter(organizer=user).order_by('-created_at')[:5]
         my_bookings = Booking.objects.filter(
             client=user
-        ).order_by('-created_at')[:5]
+        ).select_related(*BOOKING_RELATED).order_by('-created_at')[:5]
         
         # Get pending applications for organizer's events
         pending_applications = EventApplication.objects.filter(
@@ -113,30 +123,30 @@ def dashboard(request):
     elif user.user_type == 'instrument_owner':
         my_instruments = InstrumentListing.objects.filter(
             owner=user
-        ).order_by('-created_at')[:5]
+        ).select_related('instrument').order_by('-created_at')[:5]
         
-        # Get pending rental requests
+        # Get pending rental requests; the rest are listed on my_bookings?status=pending
         pending_requests = Booking.objects.filter(
             instrument_listing__owner=user,
             status='pending'
-        ).order_by('-created_at')
+        ).select_related(*BOOKING_RELATED).order_by('-created_at')[:10]
         
         # Get all instrument bookings
         instrument_bookings = Booking.objects.filter(
             instrument_listing__owner=user
-        ).order_by('-created_at')[:5]
+        ).select_related(*BOOKING_RELATED).order_by('-created_at')[:5]
         
         context.update({
             'my_instruments': my_instruments,
             'instrument_bookings': instrument_bookings,
             'pending_requests': pending_requests,
-            'pending_count': pending_requests.count(),
+            'pending_count': summary.pending_requests,
         })
     
     elif user.user_type == 'client':
         my_bookings = Booking.objects.filter(
             client=user
-        ).order_by('-created_at')[:5]
+        ).select_related(*BOOKING_RELATED).order_by('-created_at')[:5]
         
         context.update({
             'my_bookings': my_bookings,
@@ -228,66 +238,43 @@ def profile_edit(request):
 
 def search_musicians(request):
     """Search and filter musicians"""
-    musicians = MusicianProfile.objects.filter(
-        user__is_active=True,
-        availability_status=True
-    ).select_related('user').prefetch_related('genres', 'instruments')
-    
-    # Apply filters
-    genre_filter = request.GET.get('genre')
-    if genre_filter:
-        musicians = musicians.filter(genres__id=genre_filter)
-    
-    instrument_filter = request.GET.get('instrument')
-    if instrument_filter:
-        musicians = musicians.filter(instruments__id=instrument_filter)
-    
-    location_filter = request.GET.get('location')
-    if location_filter:
-        musicians = musicians.filter(user__location__icontains=location_filter)
-    
-    search_query = request.GET.get('q')
-    if search_query:
-        musicians = musicians.filter(
-            Q(user__first_name__icontains=search_query) |
-            Q(user__last_name__icontains=search_query) |
-            Q(stage_name__icontains=search_query) |
-            Q(user__bio__icontains=search_query)
-        )
+    listing = musician_listing(request.GET)
+    filters = listing.filters
+    facets = musician_facets(
+        filters['genre'], filters['instrument'], listing.location,
+        ids=listing.candidate_ids, exclude_ids=listing.busy_ids
+    )
     
-    # Pagination
-    paginator = Paginator(musicians, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset pagination; facet totals can lag, so the result count is only on ?count=1
+    page_obj = cursor_page(request, listing.queryset, listing.ordering, 12)
     
     context = {
         'page_obj': page_obj,
         'genres': Genre.objects.all(),
         'instruments': Instrument.objects.all(),
-        'current_filters': {
-            'genre': genre_filter,
-            'instrument': instrument_filter,
-            'location': location_filter,
-            'q': search_query,
-        }
+        'facets': facets,
+        'current_filters': filters,
     }
     
     return render(request, 'wafungi/search_musicians.html', context)
 
 def musician_detail(request, musician_id):
     """View musician profile details"""
-    musician = get_object_or_404(MusicianProfile, id=musician_id)
+    musician = get_object_or_404(
+        MusicianProfile.objects.select_related('user').prefetch_related('genres', 'instruments'),
+        id=musician_id,
+    )
     
     # Get reviews
     reviews = Review.objects.filter(
         reviewee=musician.user
-    ).order_by('-created_at')[:10]
+    ).select_related('reviewer').order_by('-created_at')[:10]
     
     # Get recent bookings (for portfolio)
     recent_bookings = Booking.objects.filter(
         musician=musician.user,
         status='completed'
-    ).order_by('-created_at')[:5]
+    ).select_related(*BOOKING_RELATED).order_by('-created_at')[:5]
     
     context = {
         'musician': musician,
@@ -321,13 +308,16 @@ def book_musician(request, musician_id):
             service_fee = base_amount * Decimal('0.05')  # 5% service fee
             booking.total_amount = base_amount + service_fee
             
-            booking.save()
-            
-            # Send confirmation email
-            send_booking_confirmation_email(booking)
-            
-            messages.success(request, 'Booking request sent successfully!')
-            return redirect('booking_detail', booking.id)
+            try:
+                book(booking)
+            except BookingConflict:
+                form.add_error(None, f"{musician_profile.stage_name or musician.username} is already booked for part of that time. Please choose another slot.")
+            else:
+                # Send confirmation email
+                send_booking_confirmation_email(booking)
+                
+                messages.success(request, 'Booking request sent successfully!')
+                return redirect('booking_detail', booking.id)
     else:
         form = BookingForm()
     
@@ -340,40 +330,16 @@ def book_musician(request, musician_id):
 
 def browse_events(request):
     """Browse available events"""
-    events = Event.objects.filter(
-        is_active=True,
-        date__gte=timezone.now()
-    ).order_by('date')
-    
-    # Apply filters
-    event_type_filter = request.GET.get('event_type')
-    if event_type_filter:
-        events = events.filter(event_type=event_type_filter)
-    
-    location_filter = request.GET.get('location')
-    if location_filter:
-        events = events.filter(location__icontains=location_filter)
-    
-    search_query = request.GET.get('q')
-    if search_query:
-        events = events.filter(
-            Q(title__icontains=search_query) |
-            Q(description__icontains=search_query)
-        )
+    listing = event_listing(request.GET)
+    events = listing.queryset.select_related('organizer').prefetch_related('required_genres', 'required_instruments')
     
-    # Pagination
-    paginator = Paginator(events, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset pagination
+    page_obj = cursor_page(request, events, listing.ordering, 12)
     
     context = {
         'page_obj': page_obj,
         'event_types': Event.EVENT_TYPES,
-        'current_filters': {
-            'event_type': event_type_filter,
-            'location': location_filter,
-            'q': search_query,
-        }
+        'current_filters': listing.filters,
     }
     
     return render(request, 'wafungi/browse_events.html', context)
@@ -464,16 +430,12 @@ def my_applications(request):
         messages.error(request, "Access denied.")
         return redirect('dashboard')
     
-    applications = EventApplication.objects.filter(
-        musician=request.user
-    ).select_related('event').order_by('-applied_at')
+    listing = application_listing(request.user)
     
-    # Pagination
-    paginator = Paginator(applications, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset pagination
+    page_obj = cursor_page(request, listing.queryset, listing.ordering, 10)
     
-    return render(request, 'wafungi/my_applications.html', {'page_obj': page_obj})
+    return render(request, 'wafungi/my_applications.html', {'page_obj': page_obj, 'applications': page_obj})
 
 @login_required
 def event_applications(request, event_id):
@@ -584,54 +546,22 @@ def join_event(request, event_id):
 
 def search_instruments(request):
     """Search and filter instruments"""
-    instruments = InstrumentListing.objects.filter(
-        is_available=True
-    ).select_related('owner', 'instrument')
-    
-    # Apply filters
-    instrument_filter = request.GET.get('instrument')
-    if instrument_filter:
-        instruments = instruments.filter(instrument__id=instrument_filter)
-    
-    condition_filter = request.GET.get('condition')
-    if condition_filter:
-        instruments = instruments.filter(condition=condition_filter)
-    
-    location_filter = request.GET.get('location')
-    if location_filter:
-        instruments = instruments.filter(location__icontains=location_filter)
-    
-    max_price = request.GET.get('max_price')
-    if max_price:
-        try:
-            instruments = instruments.filter(daily_rate__lte=Decimal(max_price))
-        except (ValueError, TypeError):
-            pass
-    
-    search_query = request.GET.get('q')
-    if search_query:
-        instruments = instruments.filter(
-            Q(brand__icontains=search_query) |
-            Q(model__icontains=search_query) |
-            Q(description__icontains=search_query)
-        )
+    listing = instrument_listing(request.GET)
+    filters = listing.filters
+    facets = instrument_facets(
+        filters['instrument'], filters['condition'], listing.location,
+        max_price=parse_price(filters['max_price']), ids=listing.candidate_ids, exclude_ids=listing.busy_ids
+    )
     
-    # Pagination
-    paginator = Paginator(instruments, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset pagination; facet totals can lag, so the result count is only on ?count=1
+    page_obj = cursor_page(request, listing.queryset, listing.ordering, 12)
     
     context = {
         'page_obj': page_obj,
         'instruments': Instrument.objects.all(),
         'conditions': InstrumentListing.CONDITION_CHOICES,
-        'current_filters': {
-            'instrument': instrument_filter,
-            'condition': condition_filter,
-            'location': location_filter,
-            'max_price': max_price,
-            'q': search_query,
-        }
+        'facets': facets,
+        'current_filters': filters,
     }
     
     return render(request, 'wafungi/search_instruments.html', context)
@@ -699,20 +629,23 @@ def rent_instrument(request, instrument_id):
             service_fee = base_amount * Decimal('0.05')  # 5% service fee
             booking.total_amount = base_amount + service_fee
             
-            booking.save()
-            
-            # Send confirmation email
-            send_booking_confirmation_email(booking)
-            
-            # Create notification for instrument owner
-            Notification.objects.create(
-                user=instrument.owner,
-                title='New Rental Request',
-                message=f'{request.user.get_full_name() or request.user.username} has requested to rent your {instrument.brand} {instrument.model} for {rental_days} days.'
-            )
-            
-            messages.success(request, 'Rental request sent successfully! The owner will review your request.')
-            return redirect('booking_detail', booking.id)
+            try:
+                book(booking)
+            except BookingConflict:
+                form.add_error(None, "This instrument is already rented out for part of those dates. Please choose other dates.")
+            else:
+                # Send confirmation email
+                send_booking_confirmation_email(booking)
+                
+                # Create notification for instrument owner
+                Notification.objects.create(
+                    user=instrument.owner,
+                    title='New Rental Request',
+                    message=f'{request.user.get_full_name() or request.user.username} has requested to rent your {instrument.brand} {instrument.model} for {rental_days} days.'
+                )
+                
+                messages.success(request, 'Rental request sent successfully! The owner will review your request.')
+                return redirect('booking_detail', booking.id)
     else:
         form = InstrumentRentalForm()
     
@@ -744,29 +677,53 @@ def add_instrument(request):
 
 @login_required
 def my_bookings(request):
-    """View user's bookings"""
-    if request.user.user_type == 'client':
-        bookings = Booking.objects.filter(client=request.user)
-    elif request.user.user_type == 'musician':
-        bookings = Booking.objects.filter(musician=request.user)
-    elif request.user.user_type == 'instrument_owner':
-        bookings = Booking.objects.filter(instrument_listing__owner=request.user)
-    else:
-        bookings = Booking.objects.none()
+    """View user's bookings, optionally only those with the ``status`` query parameter"""
+    listing = booking_listing(request.user)
+    bookings = listing.queryset
+    status = request.GET.get('status')
+    status_label = dict(Booking.STATUS_CHOICES).get(status)
+    if status_label:
+        bookings = bookings.filter(status=status)
     
-    bookings = bookings.order_by('-created_at')
+    # Keyset pagination
+    page_obj = cursor_page(request, bookings, listing.ordering, 10)
     
-    # Pagination
-    paginator = Paginator(bookings, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    context = {
+        'page_obj': page_obj,
+        'status_label': status_label,
+        'calendar_feed_url': request.build_absolute_uri(reverse('calendar_feed', args=[feed_token(request.user)])),
+    }
     
-    return render(request, 'wafungi/my_bookings.html', {'page_obj': page_obj})
+    return render(request, 'wafungi/my_bookings.html', context)
+
+def calendar_feed(request, token):
+    """iCalendar feed of a user's bookings; calendar apps poll it with conditional GETs"""
+    user = user_for_token(token)
+    if user is None:
+        raise Http404("Unknown calendar feed")
+    
+    etag, last_modified = feed_validators(user)
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        body = cached_feed(user, etag, request.get_host())
+        response_class = HttpResponse if isinstance(body, str) else StreamingHttpResponse
+        response = response_class(body, content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'inline; filename="wafungi-bookings.ics"'
+    
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'CALENDAR_FEED_MAX_AGE', 300))
+    return response
 
 @login_required
 def booking_detail(request, booking_id):
     """View booking details"""
-    booking = get_object_or_404(Booking, id=booking_id)
+    booking = get_object_or_404(
+        Booking.objects.select_related(*BOOKING_RELATED, 'musician__musicianprofile'),
+        id=booking_id,
+    )
     
     # Check if user has permission to view this booking
     if not (booking.client == request.user or 
@@ -945,6 +902,12 @@ def payment_process(request, booking_id):
         messages.error(request, 'This booking must be confirmed before payment.')
         return redirect('booking_detail', booking.id)
     
+    # Daraja is known to be down: answer straight away instead of waiting on timeouts
+    if not payments_available():
+        if request.method == 'POST':
+            messages.error(request, UNAVAILABLE_MESSAGE)
+        return render(request, 'wafungi/payment.html', {'booking': booking, 'payments_unavailable': True})
+    
     if request.method == 'POST':
         mpesa_number = request.POST.get('mpesa_number')
         
@@ -988,6 +951,9 @@ def payment_process(request, booking_id):
                 
                 # Redirect to payment status page
                 return redirect('payment_status', booking.id, transaction.checkout_request_id)
+            elif payment_result.get('error_code') == 'SERVICE_UNAVAILABLE':
+                messages.error(request, UNAVAILABLE_MESSAGE)
+                return render(request, 'wafungi/payment.html', {'booking': booking, 'payments_unavailable': True})
             else:
                 error_message = payment_result.get('error', 'Payment failed')
                 messages.error(request, f'Payment failed: {error_message}')
@@ -1007,6 +973,11 @@ def payment_status(request, booking_id, checkout_request_id):
                                   booking=booking, 
                                   checkout_request_id=checkout_request_id)
     
+    # Apply this payment's callback now if the worker has not got to it yet
+    if transaction.status == 'pending':
+        process_callback_inbox(checkout_request_id=checkout_request_id)
+        transaction.refresh_from_db()
+    
     # Check if payment is already completed
     if transaction.status == 'completed':
         return redirect('payment_success', booking.id)
@@ -1015,42 +986,10 @@ def payment_status(request, booking_id, checkout_request_id):
     # In production, this would be handled by M-Pesa callbacks
     if request.method == 'POST' and request.POST.get('simulate_payment'):
         # Simulate successful payment
-        transaction.status = 'completed'
-        transaction.transaction_id = f'MPESA{booking.id}{timezone.now().strftime("%Y%m%d%H%M%S")}'
-        transaction.save()
-        
-        # Update booking payment status
-        booking.payment_status = True
-        booking.save()
-        
-        # Send payment receipt email
-        send_payment_receipt_email(booking, {
-            'transaction_id': transaction.transaction_id,
-            'payment_date': timezone.now(),
-            'amount': booking.total_amount,
-            'phone_number': transaction.phone_number
-        })
-        
-        # Create notifications
-        service_provider = booking.get_service_provider()
-        if service_provider:
-            if booking.instrument_listing:
-                item_name = f"{booking.instrument_listing.brand} {booking.instrument_listing.model}"
-            else:
-                item_name = "musician booking"
-            
-            Notification.objects.create(
-                user=service_provider,
-                title='Payment Received',
-                message=f'Payment of KSH {booking.total_amount:,.0f} has been received for the {item_name} booking.'
-            )
-        
-        Notification.objects.create(
-            user=booking.client,
-            title='Payment Successful',
-            message=f'Your payment of KSH {booking.total_amount:,.0f} was successful. Receipt sent to your email.'
+        complete_payment(
+            transaction.checkout_request_id,
+            f'MPESA{booking.id}{timezone.now().strftime("%Y%m%d%H%M%S")}'
         )
-        
         return redirect('payment_success', booking.id)
     
     context = {
@@ -1117,47 +1056,9 @@ def mpesa_callback(request):
             callback_data = json.loads(request.body.decode('utf-8'))
             logger.info(f"M-Pesa callback received: {callback_data}")
             
-            # Process the callback
-            result = handle_mpesa_callback(callback_data)
-            
-            if result['success']:
-                # Find the transaction
-                checkout_request_id = result['checkout_request_id']
-                try:
-                    transaction = PaymentTransaction.objects.get(
-                        checkout_request_id=checkout_request_id
-                    )
-                    
-                    # Update transaction
-                    transaction.status = 'completed'
-                    transaction.transaction_id = result['transaction_id']
-                    transaction.save()
-                    
-                    # Update booking
-                    booking = transaction.booking
-                    booking.payment_status = True
-                    booking.save()
-                    
-                    # Send notifications and emails
-                    send_payment_receipt_email(booking, result)
-                    
-                    logger.info(f"Payment completed for booking {booking.id}")
-                    
-                except PaymentTransaction.DoesNotExist:
-                    logger.error(f"Transaction not found for checkout_request_id: {checkout_request_id}")
-            else:
-                # Handle failed payment
-                checkout_request_id = result.get('checkout_request_id')
-                if checkout_request_id:
-                    try:
-                        transaction = PaymentTransaction.objects.get(
-                            checkout_request_id=checkout_request_id
-                        )
-                        transaction.status = 'failed'
-                        transaction.save()
-                        logger.info(f"Payment failed for transaction {checkout_request_id}")
-                    except PaymentTransaction.DoesNotExist:
-                        pass
+            # Store the callback and acknowledge straight away; the
+            # process_mpesa_callbacks worker applies it to the booking
+            store_mpesa_callback(callback_data)
             
             return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
             
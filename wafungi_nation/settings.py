@@ -60,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'wafungi.middleware.RequestBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -74,7 +75,8 @@ ROOT_URLCONF = 'wafungi_nation.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # The Django backend, timing renders for RequestBudgetMiddleware
+        'BACKEND': 'wafungi.timing_utils.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -111,6 +113,28 @@ else:
         }
     }
 
+# Runs SQLite tests against a file database with IMMEDIATE transactions
+TEST_RUNNER = 'wafungi.test_runner.LockingTestRunner'
+
+# Cache. Set REDIS_URL in production so every worker shares circuit breaker,
+# payment status and invalidation state; without it each process has its own
+# in-memory cache (fine for local development)
+REDIS_URL = config('REDIS_URL', default='')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -191,7 +215,8 @@ if MPESA_ENVIRONMENT == 'sandbox':
     MPESA_CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='your_sandbox_secret')
     MPESA_BUSINESS_SHORT_CODE = config('MPESA_BUSINESS_SHORT_CODE', default='174379')
     MPESA_PASSKEY = config('MPESA_PASSKEY', default='your_sandbox_passkey')
-    MPESA_BASE_URL = 'https://sandbox.safaricom.co.ke'
+    # Override to point at a local fake Daraja (manage.py run_fake_daraja)
+    MPESA_BASE_URL = config('MPESA_BASE_URL', default='https://sandbox.safaricom.co.ke')
     NGROK_AUTH_TOKEN = config('NGROK_AUTH_TOKEN', default='')
 else:
     MPESA_CONSUMER_KEY = config('MPESA_CONSUMER_KEY')
@@ -200,13 +225,91 @@ else:
     MPESA_PASSKEY = config('MPESA_PASSKEY')
     MPESA_BASE_URL = 'https://api.safaricom.co.ke'
 
-#MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='http://localhost:8000/api/mpesa/callback/')
-MPESA_CALLBACK_URL = "http://localhost:8000/mpesa/callback/"
+MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='http://localhost:8000/mpesa/callback/')
+
+# Development only: expose the local server through one ngrok tunnel per process
+# and use it as the callback URL instead of MPESA_CALLBACK_URL
+MPESA_NGROK_ENABLED = get_bool_env('MPESA_NGROK_ENABLED', False)
+MPESA_NGROK_PORT = config('MPESA_NGROK_PORT', default=8000, cast=int)
 # M-Pesa API URLs
 MPESA_AUTH_URL = f'{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials'
 MPESA_STK_PUSH_URL = f'{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest'
 MPESA_QUERY_URL = f'{MPESA_BASE_URL}/mpesa/stkpushquery/v1/query'
 
+# OAuth token caching: refresh this many seconds before expiry, and optionally
+# share tokens between workers through a Django cache alias (e.g. 'default')
+MPESA_TOKEN_REFRESH_MARGIN = config('MPESA_TOKEN_REFRESH_MARGIN', default=300, cast=int)
+MPESA_TOKEN_CACHE_ALIAS = config('MPESA_TOKEN_CACHE_ALIAS', default='') or None
+
+# Keep-alive connection pool for Daraja calls; timeouts are in seconds
+MPESA_HTTP_POOL_CONNECTIONS = config('MPESA_HTTP_POOL_CONNECTIONS', default=4, cast=int)
+MPESA_HTTP_POOL_MAXSIZE = config('MPESA_HTTP_POOL_MAXSIZE', default=20, cast=int)
+MPESA_CONNECT_TIMEOUT = config('MPESA_CONNECT_TIMEOUT', default=5, cast=float)
+MPESA_READ_TIMEOUT = config('MPESA_READ_TIMEOUT', default=30, cast=float)
+
+# Callback inbox worker (manage.py process_mpesa_callbacks)
+MPESA_CALLBACK_MAX_ATTEMPTS = config('MPESA_CALLBACK_MAX_ATTEMPTS', default=8, cast=int)
+MPESA_CALLBACK_RETRY_DELAY = config('MPESA_CALLBACK_RETRY_DELAY', default=5, cast=int)
+MPESA_CALLBACK_LEASE_SECONDS = config('MPESA_CALLBACK_LEASE_SECONDS', default=300, cast=int)
+
+# Daraja circuit breaker and retries. Breaker state is shared between workers
+# only if MPESA_BREAKER_CACHE_ALIAS names a shared cache (Redis, Memcached, DB);
+# check warns (wafungi.W001) when it does not and DEBUG is off
+MPESA_BREAKER_CACHE_ALIAS = config('MPESA_BREAKER_CACHE_ALIAS', default='default')
+MPESA_BREAKER_FAILURE_THRESHOLD = config('MPESA_BREAKER_FAILURE_THRESHOLD', default=5, cast=int)
+MPESA_BREAKER_WINDOW = config('MPESA_BREAKER_WINDOW', default=60, cast=int)
+MPESA_BREAKER_COOLDOWN = config('MPESA_BREAKER_COOLDOWN', default=30, cast=int)
+MPESA_RETRY_ATTEMPTS = config('MPESA_RETRY_ATTEMPTS', default=2, cast=int)
+MPESA_RETRY_BASE_DELAY = config('MPESA_RETRY_BASE_DELAY', default=0.5, cast=float)
+MPESA_RETRY_MAX_DELAY = config('MPESA_RETRY_MAX_DELAY', default=4, cast=float)
+
+# Payment status push (long-poll / server-sent events). Other processes see
+# updates through MPESA_EVENTS_CACHE_ALIAS, so it should be a shared cache.
+# Requests only wait (up to the long-poll or stream timeout) under ASGI;
+# under WSGI they answer with the current status at once so no worker is held
+MPESA_EVENTS_CACHE_ALIAS = config('MPESA_EVENTS_CACHE_ALIAS', default='default')
+MPESA_STATUS_LONGPOLL_TIMEOUT = config('MPESA_STATUS_LONGPOLL_TIMEOUT', default=25, cast=float)
+MPESA_STATUS_STREAM_TIMEOUT = config('MPESA_STATUS_STREAM_TIMEOUT', default=300, cast=float)
+MPESA_STATUS_HEARTBEAT = config('MPESA_STATUS_HEARTBEAT', default=15, cast=float)
+MPESA_STATUS_POLL_INTERVAL = config('MPESA_STATUS_POLL_INTERVAL', default=0.25, cast=float)
+
+# Full-text search: 'auto' uses SQLite FTS5 / PostgreSQL tsvector when available,
+# otherwise an in-process inverted index ('python')
+SEARCH_BACKEND = config('SEARCH_BACKEND', default='auto')
+SEARCH_MAX_RESULTS = config('SEARCH_MAX_RESULTS', default=1000, cast=int)
+# The in-process indexes (python search and fuzzy backends, typeahead, facets)
+# hear about changes from other processes through the cache; without a shared
+# cache (REDIS_URL) they catch up after at most this many seconds
+SEARCH_INDEX_MAX_AGE = config('SEARCH_INDEX_MAX_AGE', default=300, cast=int)
+# Typo-tolerant fallback: minimum trigram similarity and time budget per query
+FUZZY_SEARCH_THRESHOLD = config('FUZZY_SEARCH_THRESHOLD', default=0.3, cast=float)
+FUZZY_SEARCH_BUDGET_MS = config('FUZZY_SEARCH_BUDGET_MS', default=50, cast=int)
+# Seconds a typeahead response is cached per normalized query
+TYPEAHEAD_CACHE_TIMEOUT = config('TYPEAHEAD_CACHE_TIMEOUT', default=300, cast=int)
+# Results of a "near" search without a radius
+GEO_NEAREST_K = config('GEO_NEAREST_K', default=50, cast=int)
+# Seconds a batch availability bitmap is cached (bookings expire it sooner)
+AVAILABILITY_CACHE_TIMEOUT = config('AVAILABILITY_CACHE_TIMEOUT', default=300, cast=int)
+# Calendar feeds: how long apps may reuse a feed, and how long a rendered feed is cached
+CALENDAR_FEED_MAX_AGE = config('CALENDAR_FEED_MAX_AGE', default=300, cast=int)
+CALENDAR_FEED_CACHE_TIMEOUT = config('CALENDAR_FEED_CACHE_TIMEOUT', default=3600, cast=int)
+
+# Per-request query/time reporting (Server-Timing header and logs) and budgets
+REQUEST_TIMING_ENABLED = config('REQUEST_TIMING_ENABLED', default=True, cast=bool)
+REQUEST_TIMING_HEADER = config('REQUEST_TIMING_HEADER', default=True, cast=bool)
+REQUEST_BUDGET_STRICT = config('REQUEST_BUDGET_STRICT', default=False, cast=bool)
+REQUEST_BUDGET_QUERIES = config('REQUEST_BUDGET_QUERIES', default=30, cast=int)
+REQUEST_BUDGET_DB_MS = config('REQUEST_BUDGET_DB_MS', default=250, cast=float)
+# URL name -> limits overriding the defaults ('queries', 'db_ms', 'total_ms')
+REQUEST_BUDGETS = {
+    'home': {'queries': 10},
+    'dashboard': {'queries': 20},
+    'my_bookings': {'queries': 12},
+    'booking_detail': {'queries': 8},
+    'musician_detail': {'queries': 12},
+    'my_applications': {'queries': 10},
+}
+
 if os.environ.get("VERCEL"):
     # ✅ Vercel-safe logging (console only)
     LOGGING = {